@@ -0,0 +1,206 @@
+# Copyright (c) 2021, the ElectrumX authors
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''Parsing of the asset payloads of output scripts.
+
+The payload of an asset output follows OP_RVN_ASSET.  It is b'rvn', a
+script type byte, the asset name and, for all but ownership assets, an
+8-byte amount and type-specific data.  Null asset scripts carry a
+shorter payload; see classify_script() in electrumx.lib.script.
+'''
+
+from collections import namedtuple
+from struct import error as struct_error
+
+from electrumx.lib.util import unpack_le_uint64_from
+
+
+# The value of an ownership asset
+OWNER_ASSET_VALUE = 100_000_000
+
+
+class AssetError(Exception):
+    '''Raised when an asset payload cannot be parsed.'''
+
+
+# All these have a name and a value in satoshis; the name is bytes.
+# An ownership asset has no metadata.
+OwnerAsset = namedtuple('OwnerAsset', 'name value')
+# has_ipfs is the raw byte; ipfs is the 34-byte hash, or None.
+NewAsset = namedtuple('NewAsset', 'name value divisions reissuable has_ipfs ipfs')
+# A divisions of 0xff leaves them unchanged.  ipfs is the new 34-byte hash,
+# or None.
+ReissueAsset = namedtuple('ReissueAsset', 'name value divisions reissuable ipfs')
+# data is the 34 bytes following the amount, if any, which are a message
+# when a message channel asset is sent to itself.
+TransferAsset = namedtuple('TransferAsset', 'name value data')
+
+# Null asset payloads.  Tags or untags the address with hash160 h160.
+AssetTag = namedtuple('AssetTag', 'h160 name flag')
+# The qualifiers, as bytes, a restricted asset's holders need.  An empty
+# qualifier stands for 'true', meaning none are needed.
+AssetVerifier = namedtuple('AssetVerifier', 'qualifiers')
+# Freezes or unfreezes all transfers of a restricted asset.
+AssetFreeze = namedtuple('AssetFreeze', 'name flag')
+
+# An entry in the current associations of a restricted asset or a
+# qualifier.  name is the other asset; idxs is the 13 bytes of
+# restricted output index, qualifier output index and tx_num of the
+# verifier that last changed it; associated is a bool.
+Association = namedtuple('Association', 'name idxs associated')
+
+
+def _read_name(payload, offset):
+    '''Return (name, offset after it) for the length-prefixed name at offset.'''
+    try:
+        length = payload[offset]
+    except IndexError:
+        raise AssetError('payload truncated before asset name') from None
+    end = offset + 1 + length
+    name = payload[offset + 1:end]
+    if len(name) != length:
+        raise AssetError('asset name truncated')
+    if not name or not name.isascii():
+        raise AssetError(f'bad asset name {name!r}')
+    return name, end
+
+
+def parse_asset(payload, lenient=False):
+    '''Parse an asset payload and return an OwnerAsset, NewAsset, ReissueAsset
+    or TransferAsset.  Raises AssetError if it cannot be parsed.
+
+    If lenient, optional trailing data that is too short is ignored
+    rather than an error.'''
+    if payload is None or payload[:3] != b'rvn' or len(payload) < 4:
+        raise AssetError('payload does not start with rvn')
+    script_type = payload[3]
+    name, offset = _read_name(payload, 4)
+    if script_type == 0x6f:  # b'o'
+        return OwnerAsset(name, OWNER_ASSET_VALUE)
+
+    try:
+        value, = unpack_le_uint64_from(payload, offset)
+    except struct_error:
+        raise AssetError('asset amount truncated') from None
+    offset += 8
+    rest = len(payload) - offset
+
+    if script_type == 0x74:  # b't'
+        if rest == 0 or (lenient and rest < 34):
+            return TransferAsset(name, value, None)
+        if rest < 34:
+            raise AssetError('transfer data truncated')
+        return TransferAsset(name, value, payload[offset:offset + 34])
+    if script_type == 0x71:  # b'q'
+        if rest < 3:
+            raise AssetError('issuance truncated')
+        has_ipfs = payload[offset + 2]
+        ipfs = None
+        if has_ipfs:
+            if rest < 37:
+                raise AssetError('issuance IPFS hash truncated')
+            ipfs = payload[offset + 3:offset + 37]
+        return NewAsset(name, value, payload[offset], payload[offset + 1], has_ipfs, ipfs)
+    if script_type == 0x72:  # b'r'
+        if rest < 2:
+            raise AssetError('reissuance truncated')
+        ipfs = None
+        if rest > 2:
+            if rest >= 36:
+                ipfs = payload[offset + 2:offset + 36]
+            elif not lenient:
+                raise AssetError('reissuance IPFS hash truncated')
+        return ReissueAsset(name, value, payload[offset], payload[offset + 1], ipfs)
+    raise AssetError(f'unknown asset type {script_type}')
+
+
+def parse_script_asset(script, asset_start, asset_script):
+    '''Return the asset in an output script whose payload asset_script, or
+    None if it was not found, follows OP_RVN_ASSET at asset_start.
+
+    Many early asset scripts are malformed, so if asset_script does not
+    parse, the payload is taken leniently from the first b'rvn' after
+    asset_start.  Raises AssetError if that fails too.'''
+    if asset_script is not None:
+        try:
+            return parse_asset(asset_script)
+        except AssetError:
+            pass
+    start = script.find(b'rvn', asset_start)
+    if start < 0:
+        raise AssetError('no asset payload found')
+    return parse_asset(script[start:], True)
+
+
+def parse_asset_tag(h160, payload):
+    '''Parse the payload of a null asset tag script.'''
+    name, offset = _read_name(payload, 0)
+    if offset >= len(payload):
+        raise AssetError('tag flag missing')
+    return AssetTag(h160, name, payload[offset])
+
+
+def parse_asset_verifier(payload):
+    '''Parse the payload of a null asset verifier script.'''
+    try:
+        length = payload[0]
+        verifier = payload[1:1 + length].decode('ascii')
+    except (IndexError, UnicodeDecodeError):
+        raise AssetError('bad verifier string') from None
+    if len(verifier) != length:
+        raise AssetError('verifier string truncated')
+    qualifiers = []
+    for qualifier in verifier.split('&'):
+        if not qualifier:
+            raise AssetError('empty qualifier')
+        if qualifier[0] != '#':
+            if 'A' <= qualifier[0] <= 'Z' or '0' <= qualifier[0] <= '9':
+                # This is a valid asset name
+                qualifier = '#' + qualifier
+            elif qualifier == 'true':
+                # No associated qualifiers
+                qualifier = ''
+            else:
+                raise AssetError(f'bad qualifier {qualifier}')
+        qualifiers.append(qualifier.encode('ascii'))
+    return AssetVerifier(qualifiers)
+
+
+def parse_asset_freeze(payload):
+    '''Parse the payload of a null asset global restriction script.'''
+    name, offset = _read_name(payload, 0)
+    if offset >= len(payload):
+        raise AssetError('freeze flag missing')
+    return AssetFreeze(name, payload[offset])
+
+
+def parse_associations(data):
+    '''Parse the current associations stored for a restricted asset or a
+    qualifier and return a list of Association.'''
+    try:
+        count = data[0]
+    except IndexError:
+        raise AssetError('associations truncated') from None
+    result = []
+    offset = 1
+    for _ in range(count):
+        name, offset = _read_name(data, offset)
+        end = offset + 13
+        if end >= len(data):
+            raise AssetError('association truncated')
+        if data[end] > 1:
+            raise AssetError(f'bad association flag {data[end]}')
+        result.append(Association(name, data[offset:end], data[end] == 1))
+        offset = end + 1
+    return result
+
+
+def pack_associations(associations):
+    '''Serialize a list of Association as parse_associations() reads it.'''
+    return bytes([len(associations)]) + b''.join(
+        bytes([len(name)]) + name + idxs + (b'\x01' if associated else b'\0')
+        for name, idxs, associated in associations)
@@ -203,6 +203,14 @@ class Coin:
         txs = cls.DESERIALIZER(raw_block, start=len(header)).read_tx_block()
         return Block(raw_block, header, txs)
 
+    @classmethod
+    def block_view(cls, raw_block, height):
+        '''Return a Block namedtuple given a raw block and its height, with
+        its transactions as TxView objects.'''
+        header = cls.block_header(raw_block, height)
+        txs = cls.DESERIALIZER(raw_block, start=len(header)).read_tx_view_block()
+        return Block(raw_block, header, txs)
+
     @classmethod
     def decimal_value(cls, value):
         '''Return the number of standard coin units as a Decimal given a
@@ -26,9 +26,10 @@
 
 '''Script-related classes and functions.'''
 import struct
+from collections import namedtuple
 from enum import IntEnum
 from electrumx.lib.util import unpack_le_uint16_from, unpack_le_uint32_from, \
-    pack_le_uint16, pack_le_uint32
+    pack_le_uint16, pack_le_uint32, DataParser
 
 
 class ScriptError(Exception):
@@ -312,3 +313,182 @@ class Script(object):
             else:
                 print('{} {} ({:d} bytes)'
                       .format(name, data.hex(), len(data)))
+
+
+class ScriptKind(IntEnum):
+    '''How an output script is indexed; see classify_script().'''
+    # Could not be parsed; indexed by the whole script
+    INVALID = 0
+    # Indexed by the script up to hash_end
+    PLAIN = 1
+    # Pay to the public key in data; indexed as its P2PKH address
+    P2PK = 2
+    # Null asset scripts, which are unspendable.  Tags the address whose
+    # hash160 is data with the asset in asset_script
+    NULL_TAG = 3
+    # Sets the qualifiers in asset_script of a restricted asset
+    NULL_VERIFIER = 4
+    # Freezes or unfreezes the restricted asset in asset_script
+    NULL_RESTRICTION = 5
+    # Starts with OP_RVN_ASSET but is none of the above
+    NULL_BAD = 6
+
+
+class ScriptInfo(namedtuple('ScriptInfo', 'kind hash_end asset_start asset_script data')):
+    '''The classification of an output script.
+
+    If the script carries an asset after OP_RVN_ASSET, asset_start is
+    the offset following that opcode and asset_script is the asset
+    payload, or None if it could not be found.  Otherwise asset_start is
+    None.'''
+    __slots__ = ()
+
+
+# Plain ints; looking up enum members is slow in the hot loop
+_OP_PUSHDATA1 = int(OpCodes.OP_PUSHDATA1)
+_OP_RESERVED = int(OpCodes.OP_RESERVED)
+_OP_DROP = int(OpCodes.OP_DROP)
+_OP_EQUAL = int(OpCodes.OP_EQUAL)
+_OP_CHECKSIG = int(OpCodes.OP_CHECKSIG)
+_OP_RVN_ASSET = int(OpCodes.OP_RVN_ASSET)
+_P2PKH_PREFIX = bytes((OpCodes.OP_DUP, OpCodes.OP_HASH160, 20))
+_P2PKH_SUFFIX = bytes((OpCodes.OP_EQUALVERIFY, OpCodes.OP_CHECKSIG))
+_P2SH_PREFIX = bytes((OpCodes.OP_HASH160, 20))
+_PLAIN, _P2PK = ScriptKind.PLAIN, ScriptKind.P2PK
+_NULL_TAG, _NULL_VERIFIER, _NULL_RESTRICTION = \
+    ScriptKind.NULL_TAG, ScriptKind.NULL_VERIFIER, ScriptKind.NULL_RESTRICTION
+_P2PKH_INFO = ScriptInfo(_PLAIN, 25, None, None, None)
+_P2SH_INFO = ScriptInfo(_PLAIN, 23, None, None, None)
+
+
+def _exact_push(script, offset, drop):
+    '''Return the data pushed at offset if the push ends the script, or is
+    followed only by OP_DROP if drop.  Otherwise return None.'''
+    length = len(script)
+    if offset >= length:
+        return None
+    op = script[offset]
+    if op < _OP_PUSHDATA1:
+        start = offset + 1
+    elif op == _OP_PUSHDATA1 and offset + 1 < length:
+        op = script[offset + 1]
+        start = offset + 2
+    else:
+        return None
+    end = start + op
+    if end == length or (drop and end == length - 1 and script[end] == _OP_DROP):
+        return script[start:end]
+    return None
+
+
+def classify_script(script):
+    '''Return a ScriptInfo for a spendable output script.
+
+    The common forms are recognised from their bytes: P2PKH, P2SH and
+    P2PK scripts, P2PKH and P2SH scripts followed by an asset, and the
+    null asset scripts.  Any other script is classified from its ops.'''
+    length = len(script)
+    if length == 25:
+        if script[:3] == _P2PKH_PREFIX and script[23:] == _P2PKH_SUFFIX:
+            return _P2PKH_INFO
+    elif length == 23:
+        if script[:2] == _P2SH_PREFIX and script[22] == _OP_EQUAL:
+            return _P2SH_INFO
+    elif length in (35, 67):
+        if script[0] == length - 2 and script[-1] == _OP_CHECKSIG:
+            return ScriptInfo(_P2PK, length, None, None, script[1:-1])
+
+    if length > 25 and script[25] == _OP_RVN_ASSET and \
+            script[:3] == _P2PKH_PREFIX and script[23:25] == _P2PKH_SUFFIX:
+        hash_end = 25
+    elif length > 23 and script[23] == _OP_RVN_ASSET and \
+            script[:2] == _P2SH_PREFIX and script[22] == _OP_EQUAL:
+        hash_end = 23
+    else:
+        hash_end = None
+    if hash_end:
+        asset_script = _exact_push(script, hash_end + 1, True)
+        if asset_script is not None:
+            return ScriptInfo(_PLAIN, hash_end, hash_end + 1, asset_script, None)
+    elif length > 2 and script[0] == _OP_RVN_ASSET:
+        if script[1] == 20:
+            asset_script = _exact_push(script, 22, False)
+            if asset_script is not None:
+                return ScriptInfo(_NULL_TAG, length, None, asset_script, script[2:22])
+        elif script[1] == _OP_RESERVED:
+            if script[2] == _OP_RESERVED:
+                kind, offset = _NULL_RESTRICTION, 3
+            else:
+                kind, offset = _NULL_VERIFIER, 2
+            asset_script = _exact_push(script, offset, False)
+            if asset_script is not None:
+                return ScriptInfo(kind, length, None, asset_script, None)
+
+    return _classify_ops(script)
+
+
+def _is_push(op, lengths=None):
+    '''Return True if op is an (op, end, data) push whose opcode is in lengths,
+    or is any push opcode if lengths is None.'''
+    if lengths is None:
+        return 0 <= op[0] <= OpCodes.OP_PUSHDATA4
+    return op[0] in lengths
+
+
+def _classify_ops(script):
+    '''Classify an unusual script from its ops.'''
+    ops = Script.get_ops(script)
+    length = len(script)
+    if not ops or ops[0][0] == -1:
+        return ScriptInfo(ScriptKind.INVALID, length, None, None, None)
+
+    # The position of OP_RVN_ASSET
+    op_ptr = -1
+    if len(ops) >= 2 and _is_push(ops[0], (33, 65)) and ops[1][0] == OpCodes.OP_CHECKSIG:
+        kind, hash_end, data = ScriptKind.P2PK, length, ops[0][2]
+        op_ptr = 2
+    else:
+        kind, hash_end, data = ScriptKind.PLAIN, length, None
+        for n, op in enumerate(ops):
+            if op[0] == OpCodes.OP_RVN_ASSET:
+                op_ptr = n
+                break
+            if op[0] == -1:
+                return ScriptInfo(ScriptKind.INVALID, length, None, None, None)
+
+        if op_ptr > 0:
+            # Everything before OP_RVN_ASSET is hashed
+            hash_end = ops[op_ptr - 1][1]
+        elif op_ptr == 0:
+            return _classify_null_ops(ops, length)
+
+    # A P2PK script followed by something other than an asset has none
+    if not 0 < op_ptr < len(ops) or ops[op_ptr][0] != OpCodes.OP_RVN_ASSET:
+        return ScriptInfo(kind, hash_end, None, None, data)
+
+    asset_start = ops[op_ptr][1]
+    try:
+        next_op = ops[op_ptr + 1]
+        if next_op[0] == -1:
+            # This contains the raw data
+            asset_script = DataParser(next_op[2]).read_var_bytes()
+        elif len(ops) > op_ptr + 4 and \
+                ops[op_ptr + 2][0] == b'r'[0] and \
+                ops[op_ptr + 3][0] == b'v'[0] and \
+                ops[op_ptr + 4][0] == b'n'[0]:
+            asset_script = DataParser(script[asset_start:]).read_var_bytes()
+        else:
+            asset_script = next_op[2]
+    except Exception:  # pylint:disable=W0703
+        asset_script = None
+    return ScriptInfo(kind, hash_end, asset_start, asset_script, data)
+
+
+def _classify_null_ops(ops, length):
+    if len(ops) >= 3 and ops[1][0] == 20 and _is_push(ops[2]):
+        return ScriptInfo(ScriptKind.NULL_TAG, length, None, ops[2][2], ops[1][2])
+    if len(ops) >= 3 and ops[1][0] == OpCodes.OP_RESERVED and _is_push(ops[2]):
+        return ScriptInfo(ScriptKind.NULL_VERIFIER, length, None, ops[2][2], None)
+    if len(ops) >= 4 and ops[1][0] == ops[2][0] == OpCodes.OP_RESERVED and _is_push(ops[3]):
+        return ScriptInfo(ScriptKind.NULL_RESTRICTION, length, None, ops[3][2], None)
+    return ScriptInfo(ScriptKind.NULL_BAD, length, None, None, None)
@@ -27,7 +27,9 @@
 
 '''Transaction-related classes and functions.'''
 
+from array import array
 from collections import namedtuple
+from hashlib import sha256
 
 from electrumx.lib.hash import double_sha256, hash_to_hex_str
 from electrumx.lib.util import (
@@ -54,6 +56,128 @@ class Tx(namedtuple("Tx", "version inputs outputs locktime")):
             pack_le_uint32(self.locktime)
         ))
 
+    def prevouts(self):
+        '''Return the (prev_hash, prev_idx) pairs of the non-generation inputs.'''
+        return [(txin.prev_hash, txin.prev_idx) for txin in self.inputs
+                if not txin.is_generation()]
+
+    def value_scripts(self):
+        '''Return the (value, pk_script) pairs of the outputs.'''
+        return [(txout.value, txout.pk_script) for txout in self.outputs]
+
+
+class TxView:
+    '''A transaction in a raw block or raw transaction, read lazily.
+
+    Only the offsets of the inputs and outputs are found when it is
+    deserialized.  Fields are read from the raw bytes on demand, and the
+    transaction is hashed in place without copying its serialization.
+    '''
+
+    __slots__ = ('raw', 'start', 'end', 'body_end', 'input_offsets', 'output_offsets')
+
+    def __init__(self, raw, start, end, body_end, input_offsets, output_offsets):
+        self.raw = raw
+        self.start = start
+        self.end = end
+        # The end of the outputs; short of end - 4 if there is witness data
+        self.body_end = body_end
+        self.input_offsets = input_offsets
+        self.output_offsets = output_offsets
+
+    def offsets(self):
+        '''Return the arguments other than raw that construct this view.'''
+        return (self.start, self.end, self.body_end, self.input_offsets, self.output_offsets)
+
+    def is_segwit(self):
+        return self.body_end != self.end - 4
+
+    @property
+    def version(self):
+        return unpack_le_int32_from(self.raw, self.start)[0]
+
+    @property
+    def locktime(self):
+        return unpack_le_uint32_from(self.raw, self.end - 4)[0]
+
+    def tx_hash(self):
+        '''Return the transaction hash in its natural serialized order.'''
+        view = memoryview(self.raw)
+        start, end = self.start, self.end
+        if not self.is_segwit():
+            return double_sha256(view[start:end])
+        # The hash omits the marker, flag and witness data
+        hasher = sha256(view[start: start + 4])
+        hasher.update(view[start + 6: self.body_end])
+        hasher.update(view[end - 4: end])
+        return sha256(hasher.digest()).digest()
+
+    def vsize(self):
+        size = self.end - self.start
+        if not self.is_segwit():
+            return size
+        # As DeserializerSegWit
+        return (3 * (self.body_end - self.start - 6) + size) // 4
+
+    def prevouts(self):
+        '''Return the (prev_hash, prev_idx) pairs of the non-generation inputs.'''
+        raw = self.raw
+        result = []
+        for offset in self.input_offsets:
+            prev_hash = raw[offset: offset + 32]
+            prev_idx, = unpack_le_uint32_from(raw, offset + 32)
+            if prev_idx != MINUS_1 or prev_hash != ZERO:
+                result.append((prev_hash, prev_idx))
+        return result
+
+    def pk_script_span(self, n):
+        '''Return the (start, end) offsets in raw of the pk_script of output n.'''
+        start, length = _read_varint(self.raw, self.output_offsets[n] + 8)
+        return start, start + length
+
+    def value(self, n):
+        return unpack_le_int64_from(self.raw, self.output_offsets[n])[0]
+
+    def value_scripts(self):
+        '''Return the (value, pk_script) pairs of the outputs.'''
+        raw = self.raw
+        result = []
+        for offset in self.output_offsets:
+            value, = unpack_le_int64_from(raw, offset)
+            start, length = _read_varint(raw, offset + 8)
+            result.append((value, raw[start: start + length]))
+        return result
+
+    @property
+    def inputs(self):
+        '''The inputs as TxInput objects.'''
+        result = []
+        for offset in self.input_offsets:
+            script_start, length = _read_varint(self.raw, offset + 36)
+            script_end = script_start + length
+            result.append(TxInput(self.raw[offset: offset + 32],
+                                  unpack_le_uint32_from(self.raw, offset + 32)[0],
+                                  self.raw[script_start: script_end],
+                                  unpack_le_uint32_from(self.raw, script_end)[0]))
+        return result
+
+    @property
+    def outputs(self):
+        '''The outputs as TxOutput objects.'''
+        return [TxOutput(value, pk_script) for value, pk_script in self.value_scripts()]
+
+
+def _read_varint(binary, offset):
+    '''Return a (value_offset, varint) pair for the varint at offset.'''
+    n = binary[offset]
+    if n < 253:
+        return offset + 1, n
+    if n == 253:
+        return offset + 3, unpack_le_uint16_from(binary, offset + 1)[0]
+    if n == 254:
+        return offset + 5, unpack_le_uint32_from(binary, offset + 1)[0]
+    return offset + 9, unpack_le_uint64_from(binary, offset + 1)[0]
+
 
 class TxInput(namedtuple("TxInput", "prev_hash prev_idx script sequence")):
     '''Class representing a transaction input.'''
@@ -89,7 +213,8 @@ class Deserializer(object):
     '''Deserializes blocks into transactions.
 
     External entry points are read_tx(), read_tx_and_hash(),
-    read_tx_and_vsize() and read_block().
+    read_tx_and_vsize(), read_tx_block(), read_tx_view() and
+    read_tx_view_block().
 
     This code is performance sensitive as it is executed 100s of
     millions of times during sync.
@@ -129,6 +254,42 @@ class Deserializer(object):
         # Some coins have excess data beyond the end of the transactions
         return [read() for _ in range(self._read_varint())]
 
+    def read_tx_view(self):
+        '''Return a TxView of the next transaction.'''
+        start = self.cursor
+        self.cursor += 4
+        input_offsets = self._skip_inputs()
+        output_offsets = self._skip_outputs()
+        self.cursor += 4
+        return TxView(self.binary, start, self.cursor, self.cursor - 4,
+                      input_offsets, output_offsets)
+
+    def read_tx_view_block(self):
+        '''Returns a list of (TxView, tx_hash) pairs.'''
+        read = self.read_tx_view
+        views = [read() for _ in range(self._read_varint())]
+        return [(view, view.tx_hash()) for view in views]
+
+    def _skip_inputs(self):
+        '''Return the offsets of the inputs, skipping over them.'''
+        offsets = array('I')
+        for _ in range(self._read_varint()):
+            offsets.append(self.cursor)
+            self.cursor += 36
+            script_len = self._read_varint()
+            self.cursor += script_len + 4
+        return offsets
+
+    def _skip_outputs(self):
+        '''Return the offsets of the outputs, skipping over them.'''
+        offsets = array('I')
+        for _ in range(self._read_varint()):
+            offsets.append(self.cursor)
+            self.cursor += 8
+            script_len = self._read_varint()
+            self.cursor += script_len
+        return offsets
+
     def _read_inputs(self):
         read_input = self._read_input
         return [read_input() for i in range(self._read_varint())]
@@ -214,6 +375,9 @@ class TxSegWit(namedtuple("Tx", "version marker flag inputs outputs "
                           "witness locktime")):
     '''Class representing a SegWit transaction.'''
 
+    prevouts = Tx.prevouts
+    value_scripts = Tx.value_scripts
+
 
 class DeserializerSegWit(Deserializer):
 
@@ -269,3 +433,20 @@ class DeserializerSegWit(Deserializer):
     def read_tx_and_vsize(self):
         tx, _tx_hash, vsize = self._read_tx_parts()
         return tx, vsize
+
+    def read_tx_view(self):
+        start = self.cursor
+        if self.binary[start + 4]:
+            return super().read_tx_view()
+
+        self.cursor += 6
+        input_offsets = self._skip_inputs()
+        output_offsets = self._skip_outputs()
+        body_end = self.cursor
+        for _ in input_offsets:
+            for _ in range(self._read_varint()):
+                item_len = self._read_varint()
+                self.cursor += item_len
+        self.cursor += 4
+        return TxView(self.binary, start, self.cursor, body_end,
+                      input_offsets, output_offsets)
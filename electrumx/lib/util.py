@@ -29,8 +29,11 @@
 import array
 import inspect
 import logging
+import mmap
 import sys
+import threading
 from collections.abc import Container, Mapping
+from hashlib import blake2b
 from ipaddress import ip_address
 from struct import Struct
 
@@ -229,6 +232,142 @@ class LogicalFile(object):
         return f
 
 
+class MappedLogicalFile(LogicalFile):
+    '''A LogicalFile whose files are read through persistent memory maps.
+
+    Reads slice the maps rather than opening, seeking and reading a file
+    each time.  Writes go through a persistent handle that is flushed
+    after each write; as the maps share the page cache overwrites are
+    visible to readers at once, and a map is replaced when a write
+    extends its file.  Maps
+    are never closed explicitly, so a reader in another thread holding
+    an old map is unaffected by its replacement.
+    '''
+
+    def __init__(self, prefix, digits, file_size):
+        super().__init__(prefix, digits, file_size)
+        self.maps = {}
+        self.write_file_num = None
+        self.write_handle = None
+        self.lock = threading.Lock()
+
+    def _map(self, file_num):
+        '''Return a map of the whole file, or None if it is missing or empty.'''
+        try:
+            with open(self.filename_fmt.format(file_num), 'rb') as f:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            # ValueError: empty files cannot be mapped
+            return None
+
+    def _get_map(self, file_num):
+        file_map = self.maps.get(file_num)
+        if file_map is None:
+            with self.lock:
+                file_map = self.maps.get(file_num)
+                if file_map is None:
+                    file_map = self._map(file_num)
+                    if file_map is not None:
+                        self.maps[file_num] = file_map
+        return file_map
+
+    def read(self, start, size=-1):
+        '''Read up to size bytes from the virtual file, starting at offset
+        start, and return them.
+
+        If size is -1 all bytes are read.'''
+        parts = []
+        while size != 0:
+            file_num, offset = divmod(start, self.file_size)
+            file_map = self._get_map(file_num)
+            if file_map is None:
+                break
+            part = file_map[offset:] if size < 0 else file_map[offset:offset + size]
+            if not part:
+                break
+            parts.append(part)
+            start += len(part)
+            if size > 0:
+                size -= len(part)
+        return parts[0] if len(parts) == 1 else b''.join(parts)
+
+    def write(self, start, b):
+        '''Write the bytes-like object, b, to the underlying virtual file.'''
+        with self.lock:
+            while b:
+                file_num, offset = divmod(start, self.file_size)
+                size = min(len(b), self.file_size - offset)
+                if file_num != self.write_file_num:
+                    self._close_write_handle()
+                    self.write_handle = open_file(self.filename_fmt.format(file_num), True)
+                    self.write_file_num = file_num
+                f = self.write_handle
+                f.seek(offset)
+                f.write(b if size == len(b) else b[:size])
+                f.flush()
+                # Extend the map if the write grew the file
+                file_map = self.maps.get(file_num)
+                if file_map is not None and offset + size > len(file_map):
+                    self.maps[file_num] = self._map(file_num)
+                b = b[size:]
+                start += size
+
+    def _close_write_handle(self):
+        if self.write_handle:
+            self.write_handle.close()
+            self.write_handle = None
+            self.write_file_num = None
+
+    def close(self):
+        '''Close the write handle and drop the maps.'''
+        with self.lock:
+            self._close_write_handle()
+            self.maps.clear()
+
+
+class BloomFilter(object):
+    '''A Bloom filter of byte strings.
+
+    Membership tests have no false negatives, and about 1% false
+    positives while no more than capacity items have been added.
+    Items cannot be removed.
+    '''
+
+    BITS_PER_ITEM = 10
+    HASH_COUNT = 7
+    # Bit positions are taken from 32-bit words of a blake2b digest
+    unpack_hashes = Struct(f'<{HASH_COUNT}I').unpack
+
+    def __init__(self, capacity, bits=None, count=0):
+        self.capacity = capacity
+        self.size = capacity * self.BITS_PER_ITEM
+        if bits is None:
+            bits = bytearray((self.size + 7) // 8)
+        assert self.size < 1 << 32 and len(bits) == (self.size + 7) // 8
+        self.bits = bits
+        self.count = count
+
+    def _positions(self, item):
+        size = self.size
+        return [value % size for value in self.unpack_hashes(
+            blake2b(item, digest_size=4 * self.HASH_COUNT).digest())]
+
+    def add(self, item):
+        bits = self.bits
+        for pos in self._positions(item):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        bits = self.bits
+        size = self.size
+        for pos in self.unpack_hashes(blake2b(item, digest_size=4 * self.HASH_COUNT).digest()):
+            pos %= size
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
 def open_file(filename, create=False):
     '''Open the file name.  Return its handle.'''
     try:
@@ -0,0 +1,126 @@
+# Copyright (c) 2021, the ElectrumX authors
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''Reading of raw blocks from a local daemon's blk*.dat files.'''
+
+import os
+import threading
+
+from electrumx.lib.util import unpack_le_uint32_from
+
+
+class BlockFiles:
+    '''Reads raw blocks from the blk*.dat files in a daemon's blocks directory.
+
+    Each record in a block file is the network magic, the 4-byte block
+    size and the block.  Blocks are written in the order they are
+    received, so they are not strictly in height order and the files
+    include stale blocks.  Rather than read the daemon's block index,
+    which it holds locked, the files are scanned lazily and blocks are
+    indexed by their previous block hash.  A block is found from its
+    header, which the caller gets from the daemon: of the blocks sharing
+    its previous hash, it is the one with the same header bytes.
+
+    The methods of this class block and are thread-safe.
+    '''
+
+    def __init__(self, blocks_dir):
+        self.blocks_dir = blocks_dir
+        self.lock = threading.Lock()
+        self.magic = None
+        # prev_hash -> list of (file_num, offset, size) of scanned and unread blocks
+        self.index = {}
+        # The next record to scan
+        self.file_num = 0
+        self.offset = 0
+        # The last file read from and its number
+        self.file = None
+        self.open_num = None
+
+    def file_path(self, file_num):
+        return os.path.join(self.blocks_dir, f'blk{file_num:05d}.dat')
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+            self.index.clear()
+
+    def read_blocks(self, headers):
+        '''Return the raw blocks with the given headers, or None if any of them
+        cannot be found.'''
+        with self.lock:
+            blocks = []
+            for header in headers:
+                location = self._find(header)
+                if location is None:
+                    return None
+                blocks.append(self._read(*location))
+            return blocks
+
+    def _read(self, file_num, offset, size):
+        if file_num != self.open_num:
+            if self.file:
+                self.file.close()
+            self.file = open(self.file_path(file_num), 'rb')
+            self.open_num = file_num
+        self.file.seek(offset)
+        return self.file.read(size)
+
+    def _find(self, header):
+        prev_hash = header[4:36]
+        while True:
+            locations = self.index.get(prev_hash, [])
+            for location in locations:
+                file_num, offset, _size = location
+                if self._read(file_num, offset, len(header)) == header:
+                    locations.remove(location)
+                    if not locations:
+                        del self.index[prev_hash]
+                    return location
+            if not self._scan():
+                return None
+
+    def _scan(self):
+        '''Index the blocks in the rest of the current file, moving on to the
+        next file if it exists.  Return True if any blocks were indexed.'''
+        while True:
+            try:
+                f = open(self.file_path(self.file_num), 'rb')
+            except FileNotFoundError:
+                return False
+            count = 0
+            with f:
+                file_size = os.fstat(f.fileno()).st_size
+                f.seek(self.offset)
+                while True:
+                    prefix = f.read(44)
+                    if len(prefix) < 44:
+                        break
+                    magic = prefix[:4]
+                    if self.magic is None and any(magic):
+                        self.magic = magic
+                    # The daemon pre-allocates files with zeroes
+                    if magic != self.magic:
+                        break
+                    size, = unpack_le_uint32_from(prefix, 4)
+                    if self.offset + 8 + size > file_size:
+                        # Not fully written yet
+                        break
+                    self.index.setdefault(prefix[12:44], []).append(
+                        (self.file_num, self.offset + 8, size))
+                    self.offset += 8 + size
+                    f.seek(self.offset)
+                    count += 1
+            if os.path.exists(self.file_path(self.file_num + 1)):
+                self.file_num += 1
+                self.offset = 0
+            elif not count:
+                return False
+            if count:
+                return True
@@ -13,23 +13,32 @@ import hashlib
 import itertools
 import logging
 import os
+import sys
 import time
 import traceback
 from asyncio import sleep
-from typing import Callable, Dict, Sequence, Optional, List
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Sequence, Optional, List
 
 from aiorpcx import TaskGroup, CancelledError
 
 import electrumx
 from electrumx.lib.addresses import public_key_to_address
+from electrumx.lib.assets import (
+    parse_script_asset, parse_asset_tag, parse_asset_verifier, parse_asset_freeze,
+    parse_associations, pack_associations, OwnerAsset, NewAsset, TransferAsset, Association
+)
 from electrumx.lib.hash import hash_to_hex_str, HASHX_LEN
 from electrumx.lib.script import is_unspendable_legacy, \
-    is_unspendable_genesis, OpCodes, Script, ScriptError
+    is_unspendable_genesis, classify_script, Script, ScriptKind
+from electrumx.lib.tx import TxView
 from electrumx.lib.util import (
     class_logger, pack_le_uint32, pack_le_uint64, unpack_le_uint64, base_encode, DataParser, deep_getsizeof
 )
+from electrumx.server.block_files import BlockFiles
 from electrumx.server.daemon import DaemonError
 from electrumx.server.db import FlushData
+from electrumx.server.utxo_cache import UTXOCache, SizedDict
 
 # We can safely assume that TX's to these addresses will never come out
 # Therefore we don't need to store them in the database
@@ -41,76 +50,68 @@ BURN_ADDRESSES = [
     'RXBurnXXXXXXXXXXXXXXXXXXXXXXWUo9FV',
 ]
 
+# The longest valid asset name.  Cached asset outputs with longer names
+# from malformed scripts take more memory.
+MAX_ASSET_NAME_LEN = 32
+
+# The memory taken by the 'h' and 'u' DB keys of a spent output, and
+# their pointers, in a list of deletes
+DELETE_PAIR_SIZE = 2 * 8 + sys.getsizeof(bytes(1 + 4 + 4 + 5)) + sys.getsizeof(
+    bytes(1 + HASHX_LEN + 4 + 5))
 
-class OPPushDataGeneric:
-    def __init__(self, pushlen: Callable = None):
-        if pushlen is not None:
-            self.check_data_len = pushlen
-
-    @classmethod
-    def check_data_len(cls, datalen: int) -> bool:
-        # Opcodes below OP_PUSHDATA4 all just push data onto stack, and are
-        return OpCodes.OP_PUSHDATA4 >= datalen >= 0
-
-    @classmethod
-    def is_instance(cls, item):
-        # accept objects that are instances of this class
-        # or other classes that are subclasses
-        return isinstance(item, cls) \
-               or (isinstance(item, type) and issubclass(item, cls))
-
-
-SCRIPTPUBKEY_TEMPLATE_P2PK = [OPPushDataGeneric(lambda x: x in (33, 65)), OpCodes.OP_CHECKSIG]
-
-# Marks an address as valid for restricted assets via qualifier or restricted itself.
-ASSET_NULL_TEMPLATE = [OpCodes.OP_RVN_ASSET, OPPushDataGeneric(lambda x: x == 20), OPPushDataGeneric()]
-# Used with creating restricted assets. Dictates the qualifier assets associated.
-ASSET_NULL_VERIFIER_TEMPLATE = [OpCodes.OP_RVN_ASSET, OpCodes.OP_RESERVED, OPPushDataGeneric()]
-# Stop all movements of a restricted asset.
-ASSET_GLOBAL_RESTRICTION_TEMPLATE = [OpCodes.OP_RVN_ASSET, OpCodes.OP_RESERVED, OpCodes.OP_RESERVED,
-                                     OPPushDataGeneric()]
-
-
-# -1 if doesn't match, positive if does. Indicates index in script
-def match_script_against_template(script, template) -> int:
-    """Returns whether 'script' matches 'template'."""
-    if script is None:
-        return -1
-    if len(script) < len(template):
-        return -1
-    ctr = 0
-    for i in range(len(template)):
-        ctr += 1
-        template_item = template[i]
-        script_item = script[i]
-        if OPPushDataGeneric.is_instance(template_item) and template_item.check_data_len(script_item[0]):
-            continue
-        if template_item != script_item[0]:
-            return -1
-    return ctr
+
+def _other_tag_history(data, key):
+    '''Return the entries of a serialized current tag history, of
+    qualifiers of an address or addresses of a qualifier, not for key.'''
+    ret = []
+    parser = DataParser(data)
+    for _ in range(parser.read_int()):
+        old_key_len, old_key = parser.read_var_bytes_tuple_bytes()
+        data = parser.read_bytes(4 + 5 + 1)
+        if key != old_key:
+            ret.append(old_key_len + old_key + data)
+    return ret
 
 
 class Prefetcher:
-    '''Prefetches blocks (in the forward direction only).'''
+    '''Prefetches blocks (in the forward direction only).
+
+    Several windows of blocks are fetched at once, spread across the
+    daemon URLs, and queued in height order.  The amount of block data
+    fetched ahead adapts to whether the block processor or the daemons
+    are the bottleneck.
 
-    def __init__(self, daemon, coin, blocks_event):
+    If given block_files, blocks more than reorg_limit below the daemon's
+    height are read from the daemon's block files rather than over RPC.
+    '''
+
+    def __init__(self, daemon, coin, blocks_event, block_files=None, reorg_limit=0):
         self.logger = class_logger(__name__, self.__class__.__name__)
         self.daemon = daemon
         self.coin = coin
         self.blocks_event = blocks_event
+        self.block_files = block_files
+        self.reorg_limit = reorg_limit
         self.blocks = []
         self.caught_up = False
         # Access to fetched_height should be protected by the semaphore
         self.fetched_height = None
         self.semaphore = asyncio.Semaphore()
         self.refill_event = asyncio.Event()
-        # The prefetched block cache size.  The min cache size has
-        # little effect on sync time.
+        # The prefetched block cache size, and the size it is filled to.
+        # The target grows while the block processor is kept waiting, and
+        # shrinks while the cache is full.
         self.cache_size = 0
         self.min_cache_size = 10 * 1024 * 1024
+        self.max_cache_size = 16 * self.min_cache_size
+        self.target_cache_size = self.min_cache_size
         # This makes the first fetch be 10 blocks
         self.ave_size = self.min_cache_size // 10
         self.polling_delay = 5
+        # Per daemon URL: bytes requested and not yet received, and the
+        # observed rate in bytes per second
+        self.url_pending = {}
+        self.url_rates = {}
 
     async def main_loop(self, bp_height):
         '''Loop forever polling for more blocks.'''
@@ -131,12 +132,25 @@ class Prefetcher:
 
     def get_prefetched_blocks(self):
         '''Called by block processor when it is processing queued blocks.'''
+        if not self.caught_up:
+            self._adapt_cache_size()
         blocks = self.blocks
         self.blocks = []
         self.cache_size = 0
         self.refill_event.set()
         return blocks
 
+    def _adapt_cache_size(self):
+        '''Grow the cache target if the block processor takes blocks before the
+        cache is half full, as it is waiting on the daemons; shrink it if the
+        cache filled, as the block processor is the bottleneck.'''
+        target = self.target_cache_size
+        if self.cache_size >= target:
+            target = max(target * 3 // 4, self.min_cache_size)
+        elif self.cache_size < target // 2:
+            target = min(target * 5 // 4, self.max_cache_size)
+        self.target_cache_size = target
+
     async def reset_height(self, height):
         '''Reset to prefetch blocks from the block processor's height.
 
@@ -167,46 +181,211 @@ class Prefetcher:
         '''
         daemon = self.daemon
         daemon_height = await daemon.height()
+        # Blocks up to this height are read from the block files
+        files_height = daemon_height - self.reorg_limit if self.block_files else -1
+        # Two windows per daemon keeps each busy while the last is received
+        max_windows = 2 * len(daemon.urls)
+        windows = {}
         async with self.semaphore:
-            while self.cache_size < self.min_cache_size:
-                first = self.fetched_height + 1
-                # Try and catch up all blocks but limit to room in cache.
-                cache_room = max(self.min_cache_size // self.ave_size, 1)
-                count = min(daemon_height - self.fetched_height, cache_room)
-                # Don't make too large a request
-                count = min(self.coin.max_fetch_blocks(first), max(count, 0))
-                if not count:
+            try:
+                next_height = self.fetched_height + 1
+                while True:
+                    # Request windows while there is room in the cache
+                    room = self.target_cache_size - self.cache_size
+                    window_size = max(self.target_cache_size // max_windows, 1)
+                    while (len(windows) < max_windows and next_height <= daemon_height
+                           and room > len(windows) * window_size):
+                        from_files = next_height <= files_height
+                        last_height = files_height if from_files else daemon_height
+                        count = min(max(window_size // self.ave_size, 1),
+                                    last_height - next_height + 1,
+                                    self.coin.max_fetch_blocks(next_height))
+                        windows[next_height] = asyncio.ensure_future(
+                            self._fetch_window(next_height, count, from_files))
+                        next_height += count
+
+                    if not windows:
+                        break
+                    # Queue the windows in height order
+                    first = self.fetched_height + 1
+                    blocks = await windows.pop(first)
+                    self._queue_blocks(blocks)
+                    if self.block_files and self.fetched_height >= files_height:
+                        self._close_block_files(f'fetching blocks from the daemon from '
+                                                f'height {self.fetched_height + 1:,d}')
+
+                if next_height > daemon_height:
                     self.caught_up = True
                     return False
+            finally:
+                for window in windows.values():
+                    window.cancel()
 
-                hex_hashes = await daemon.block_hex_hashes(first, count)
-                if self.caught_up:
-                    self.logger.info('new block height {:,d} hash {}'
-                                     .format(first + count - 1, hex_hashes[-1]))
-                blocks = await daemon.raw_blocks(hex_hashes)
+        self.refill_event.clear()
+        return True
 
-                assert count == len(blocks)
+    def _queue_blocks(self, blocks):
+        count = len(blocks)
+        # Update our recent average block size estimate
+        size = sum(len(block) for block in blocks)
+        if count >= 10:
+            self.ave_size = size // count
+        else:
+            self.ave_size = (size + (10 - count) * self.ave_size) // 10
 
-                # Special handling for genesis block
-                if first == 0:
-                    blocks[0] = self.coin.genesis_block(blocks[0])
-                    self.logger.info('verified genesis block with hash {}'
-                                     .format(hex_hashes[0]))
+        self.blocks.extend(blocks)
+        self.cache_size += size
+        self.fetched_height += count
+        self.blocks_event.set()
 
-                # Update our recent average block size estimate
-                size = sum(len(block) for block in blocks)
-                if count >= 10:
-                    self.ave_size = size // count
-                else:
-                    self.ave_size = (size + (10 - count) * self.ave_size) // 10
+    def _choose_url(self):
+        '''Return the daemon URL expected to finish a request soonest.'''
+        def finish_time(url):
+            # Unmeasured URLs are tried first
+            return self.url_pending.get(url, 0) / self.url_rates.get(url, 1e12)
+
+        return min(self.daemon.urls, key=finish_time)
+
+    def _close_block_files(self, reason):
+        self.logger.info(reason)
+        self.block_files.close()
+        self.block_files = None
+
+    async def _read_block_files(self, hex_hashes):
+        '''Return the raw blocks with the given hex hashes read from the block
+        files, or None if they cannot all be found there.'''
+        headers = await self.daemon.block_headers(hex_hashes)
+        block_files = self.block_files
+        if block_files is None:
+            return None
+        loop = asyncio.get_event_loop()
+        blocks = await loop.run_in_executor(None, block_files.read_blocks, headers)
+        if blocks is None and self.block_files:
+            self._close_block_files(f'block {hex_hashes[0]} or a successor not found '
+                                    f'in block files; fetching blocks from the daemon')
+        return blocks
 
-                self.blocks.extend(blocks)
-                self.cache_size += size
-                self.fetched_height += count
-                self.blocks_event.set()
+    async def _fetch_window(self, first, count, from_files=False):
+        '''Return the count raw blocks from height first.'''
+        hex_hashes = await self.daemon.block_hex_hashes(first, count)
+        if self.caught_up:
+            self.logger.info('new block height {:,d} hash {}'
+                             .format(first + count - 1, hex_hashes[-1]))
+
+        blocks = None
+        if from_files and self.block_files:
+            blocks = await self._read_block_files(hex_hashes)
+        if blocks is None:
+            blocks = await self._fetch_raw_blocks(hex_hashes)
+        assert count == len(blocks)
+
+        # Special handling for genesis block
+        if first == 0:
+            blocks[0] = self.coin.genesis_block(blocks[0])
+            self.logger.info('verified genesis block with hash {}'
+                             .format(hex_hashes[0]))
+        return blocks
 
-        self.refill_event.clear()
-        return True
+    async def _fetch_raw_blocks(self, hex_hashes):
+        '''Return the raw blocks with the given hex hashes from the daemons.'''
+        daemon = self.daemon
+        count = len(hex_hashes)
+        # Block hashes come from the current daemon; any of them can serve
+        # the blocks
+        url = self._choose_url()
+        expected_size = count * self.ave_size
+        self.url_pending[url] = self.url_pending.get(url, 0) + expected_size
+        start = time.monotonic()
+        try:
+            blocks = await daemon.raw_blocks(hex_hashes, url)
+        except DaemonError:
+            # Perhaps that daemon does not have the blocks yet
+            if url == daemon.current_url():
+                raise
+            blocks = await daemon.raw_blocks(hex_hashes)
+        else:
+            elapsed = max(time.monotonic() - start, 0.001)
+            rate = sum(len(block) for block in blocks) / elapsed
+            prior_rate = self.url_rates.get(url)
+            self.url_rates[url] = rate if prior_rate is None else (prior_rate + rate) / 2
+        finally:
+            self.url_pending[url] -= expected_size
+        return blocks
+
+
+def _deserialize_block(coin, raw_block, height):
+    '''Run in a worker process.  Returns a (header_hash, tx_offsets) pair,
+    so only the offsets of each TxView and not the raw block come back.'''
+    block = coin.block_view(raw_block, height)
+    return (coin.header_hash(block.header),
+            [(tx.offsets(), tx_hash) for tx, tx_hash in block.transactions])
+
+
+class BlockDeserializer:
+    '''Deserializes and hashes prefetched blocks ahead of the block processor.
+
+    With a pool of worker processes, transaction parsing and hashing of a
+    batch of blocks happens in parallel with the processing of its earlier
+    blocks, so the block processor only waits on blocks that are not yet
+    ready.  Without a pool blocks are deserialized in-process.
+    '''
+
+    def __init__(self, coin, processes):
+        self.logger = class_logger(__name__, self.__class__.__name__)
+        self.coin = coin
+        self.processes = processes
+        self.executor = None
+        # Deferred as the coins module imports this one
+        from electrumx.lib.coins import Block
+        self.block_class = Block
+        # Transactions deserialized, and seconds spent waiting for them
+        self.tx_count = 0
+        self.wait_time = 0.0
+
+    def start(self):
+        if self.processes > 0:
+            self.executor = ProcessPoolExecutor(max_workers=self.processes)
+            self.logger.info(f'deserializing blocks in {self.processes:,d} processes')
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def _rebuild_block(self, raw_block, height, result):
+        header_hash, tx_offsets = result
+        txs = [(TxView(raw_block, *offsets), tx_hash) for offsets, tx_hash in tx_offsets]
+        return self.block_class(raw_block, self.coin.block_header(raw_block, height), txs), header_hash
+
+    async def blocks(self, raw_blocks, first):
+        '''Asynchronously yield (block, header_hash) pairs in order for raw
+        blocks starting at height first.'''
+        coin = self.coin
+        if not self.executor:
+            for n, raw_block in enumerate(raw_blocks):
+                start = time.monotonic()
+                block = coin.block_view(raw_block, first + n)
+                header_hash = coin.header_hash(block.header)
+                self.wait_time += time.monotonic() - start
+                self.tx_count += len(block.transactions)
+                yield block, header_hash
+            return
+
+        loop = asyncio.get_event_loop()
+        futures = [loop.run_in_executor(self.executor, _deserialize_block,
+                                        coin, raw_block, first + n)
+                   for n, raw_block in enumerate(raw_blocks)]
+        try:
+            for n, (raw_block, future) in enumerate(zip(raw_blocks, futures)):
+                start = time.monotonic()
+                block, header_hash = self._rebuild_block(raw_block, first + n, await future)
+                self.wait_time += time.monotonic() - start
+                self.tx_count += len(block.transactions)
+                yield block, header_hash
+        finally:
+            # Blocks not yet yielded are not wanted if processing stopped early
+            for future in futures:
+                future.cancel()
 
 
 class ChainError(Exception):
@@ -220,6 +399,11 @@ class BlockProcessor:
     Coordinate backing up in case of chain reorganisations.
     '''
 
+    # Bytes of history read by each batch of a background compaction, and the
+    # seconds between batches
+    COMPACTION_BATCH_SIZE = 4_000_000
+    COMPACTION_PAUSE = 1.0
+
     def __init__(self, env, db, daemon, notifications):
         self.env = env
         self.db = db
@@ -240,11 +424,18 @@ class BlockProcessor:
         self.backed_up_event = asyncio.Event()
 
         self.coin = env.coin
-        self.prefetcher = Prefetcher(daemon, env.coin, self.blocks_event)
+        block_files = BlockFiles(env.daemon_blocks_dir) if env.daemon_blocks_dir else None
+        self.prefetcher = Prefetcher(daemon, env.coin, self.blocks_event, block_files,
+                                     env.reorg_limit)
+        self.deserializer = BlockDeserializer(env.coin, env.deserialize_processes)
         self.logger = class_logger(__name__, self.__class__.__name__)
 
         # Meta
         self.next_cache_check = 0
+        # Seconds spent advancing blocks, and the (tx count, advance time,
+        # deserializer wait time) when the sync rate was last reported
+        self.advance_time = 0.0
+        self.last_rate_report = (0, 0.0, 0.0)
         self.touched = set()
         self.reorg_count = None
         self.height = -1
@@ -255,26 +446,39 @@ class BlockProcessor:
 
         # Caches of unflushed items.
         self.headers = []
+        self.block_hashes = []
         self.tx_hashes = []
+        # The memory taken by the bytes objects in tx_hashes
+        self.tx_hashes_size = 0
         self.undo_infos = []
 
         # UTXO cache
-        self.utxo_cache = {}
+        self.utxo_cache = self._utxo_cache()
         self.db_deletes = []
 
+        # Spends of the block being advanced that were looked up on disk
+        # in advance, keyed by tx_hash + tx_idx.  See _prefetch_spends().
+        self.prefetched_utxos = {}
+        self.prefetched_assets = {}
+
+        # The flush being committed in a background thread and the future of
+        # its commit.  flushing is None unless the flush includes the UTXOs.
+        self.flushing = None
+        self.flush_future = None
+
         # Asset cache
 
         # Same as utxo cache but for assets.
         # All keys in this dict will also be in the
         # utxo_cache because assets are normal tx's with no RVN value
-        self.asset_cache = {}
+        self.asset_cache = self._asset_cache()
         # Same as above.
         self.asset_deletes = []
         self.asset_undo_infos = []
 
         # A dict of the asset name -> asset data
-        self.asset_data_new = {}
-        self.asset_data_reissued = {}
+        self.asset_data_new = SizedDict()
+        self.asset_data_reissued = SizedDict()
 
         self.asset_data_undo_infos = []
         self.asset_data_deletes = []
@@ -284,23 +488,23 @@ class BlockProcessor:
 
         # For qualifier assets
 
-        self.restricted_to_qualifier = {}
+        self.restricted_to_qualifier = SizedDict(deep_getsizeof)
 
         # Most up-to-date qualifier-restricted associations
-        self.qr_associations = {}
+        self.qr_associations = SizedDict()
 
         self.restricted_to_qualifier_deletes = []
         self.restricted_to_qualifier_undos = []
 
-        self.global_freezes = {}
+        self.global_freezes = SizedDict()
         # asset : T/F
-        self.is_frozen = {}
+        self.is_frozen = SizedDict()
         self.global_freezes_deletes = []
         self.global_freezes_undos = []
 
-        self.tag_to_address = {}
+        self.tag_to_address = SizedDict()
         # asset + pubkey : T/F
-        self.is_qualified = {}
+        self.is_qualified = SizedDict()
         self.tag_to_address_deletes = []
         self.tag_to_address_undos = []
 
@@ -310,24 +514,12 @@ class BlockProcessor:
         self.qualifiers_idx = b''
 
         # Asset broadcasts
-        self.asset_broadcast = {}
+        self.asset_broadcast = SizedDict()
         self.asset_broadcast_undos = []
         self.asset_broadcast_dels = []
 
-        self.reset_size_cache()
-
-    def reset_size_cache(self):
-        self.restricted_to_qualifier_size = 0
-        self.restricted_to_qualifier_len = 0
-
-        self.qr_associations_size = 0
-        self.qr_associations_len = 0
-
-        self.tag_to_address_size = 0
-        self.tag_to_address_len = 0
-
-        self.is_qualified_size = 0
-        self.is_qualified_len = 0
+        # The memory taken by the caches of the flush in progress
+        self.flushing_size = 0
 
     async def run_with_lock(self, coro):
         # Shielded so that cancellations from shutdown don't lose work.  Cancellation will
@@ -361,7 +553,7 @@ class BlockProcessor:
                 block = self.db.read_raw_block(height)
                 self.logger.info(f'read block {hex_hash} at height {height:,d} from disk')
             except FileNotFoundError:
-                block = await self.daemon.raw_blocks([hex_hash])[0]
+                block = (await self.daemon.raw_blocks([hex_hash]))[0]
                 self.logger.info(f'obtained block {hex_hash} at height {height:,d} from daemon')
             return block
 
@@ -443,7 +635,7 @@ class BlockProcessor:
         '''The data for a flush.  The lock must be taken.'''
         assert self.state_lock.locked()
         return FlushData(self.height, self.tx_count, self.headers,
-                         self.tx_hashes, self.undo_infos, self.utxo_cache,
+                         self.block_hashes, self.tx_hashes, self.undo_infos, self.utxo_cache,
                          self.db_deletes, self.tip,
                          self.asset_cache, self.asset_deletes,
                          self.asset_data_new, self.asset_data_reissued,
@@ -458,88 +650,195 @@ class BlockProcessor:
                          self.asset_broadcast, self.asset_broadcast_undos, self.asset_broadcast_dels)
 
     async def flush(self, flush_utxos):
+        '''Flush and wait for the flush to be committed.'''
+        await self.start_flush(flush_utxos)
+        await self.wait_for_flush()
+
+    async def start_flush(self, flush_utxos):
+        '''Start committing the cached state in a background thread.
+
+        The caches flushed are swapped for fresh ones that blocks processed
+        meanwhile go into; lookups consult the frozen caches until the commit
+        completes.  A flush first waits for the one before it, so the DBs are
+        written in the same order, and are as crash consistent, as a
+        synchronous flush.
+        '''
+        await self.wait_for_flush()
+        cache_size = sum(self.cache_sizes().values())
+        flush_data = self.flush_data()
+        flush_data.history = self.db.history.take_unflushed()
+        self._swap_caches(flush_utxos)
+        self.flushing_size = cache_size - sum(self.cache_sizes().values())
         if flush_utxos:
-            self.reset_size_cache()
-        self.db.flush_dbs(self.flush_data(), flush_utxos, self.estimate_txs_remaining)
+            self.flushing = flush_data
+        self.flush_future = asyncio.get_event_loop().run_in_executor(
+            None, self.db.flush_dbs, flush_data, flush_utxos, self.estimate_txs_remaining)
         self.next_cache_check = time.monotonic() + 30
 
-    def check_cache_size(self):
-        '''Flush a cache if it gets too big.'''
-        # Good average estimates based on traversal of subobjects and
-        # requesting size from Python (see deep_getsizeof).
+    async def wait_for_flush(self):
+        '''Wait for a flush in progress to be committed.  Raises if it failed.'''
+        if self.flush_future:
+            # Shielded as the commit runs to completion regardless
+            await asyncio.shield(self.flush_future)
+            self.flush_future = None
+            self.flushing = None
+            self.flushing_size = 0
+
+    async def release_flush(self):
+        '''Release the caches of a background flush as soon as it is
+        committed, so they do not outlive their commit.  Raises if the
+        commit failed.'''
+        if self.flush_future and self.flush_future.done():
+            await self.wait_for_flush()
+
+    def _swap_caches(self, flush_utxos):
+        '''Replace the caches of a flush with empty ones.'''
+        self.headers = []
+        self.block_hashes = []
+        self.tx_hashes = []
+        self.tx_hashes_size = 0
+        if not flush_utxos:
+            return
+        self.undo_infos = []
+        # Blocks to the next flush likely create as many UTXOs
+        self.utxo_cache = self._utxo_cache(len(self.utxo_cache))
+        self.db_deletes = []
 
-        # Undo info is only appended after sync; ignore here
-        # Deletes are only during rollbacks; ignore here
+        self.asset_cache = self._asset_cache(len(self.asset_cache))
+        self.asset_deletes = []
+        self.asset_undo_infos = []
+        self.asset_data_new = SizedDict()
+        self.asset_data_reissued = SizedDict()
+        self.asset_data_undo_infos = []
+        self.asset_data_deletes = []
 
+        self.restricted_to_qualifier = SizedDict(deep_getsizeof)
+        self.qr_associations = SizedDict()
+        self.restricted_to_qualifier_deletes = []
+        self.restricted_to_qualifier_undos = []
+
+        self.global_freezes = SizedDict()
+        self.is_frozen = SizedDict()
+        self.global_freezes_deletes = []
+        self.global_freezes_undos = []
+
+        self.tag_to_address = SizedDict()
+        self.is_qualified = SizedDict()
+        self.tag_to_address_deletes = []
+        self.tag_to_address_undos = []
+
+        self.asset_broadcast = SizedDict()
+        self.asset_broadcast_undos = []
+        self.asset_broadcast_dels = []
+
+    @staticmethod
+    def _utxo_cache(capacity=0):
+        # Keys are tx_hash + tx_idx; values hashX + tx_num + value
+        return UTXOCache(32 + 4, HASHX_LEN + 5 + 8, capacity=capacity)
+
+    @staticmethod
+    def _asset_cache(capacity=0):
+        # Values are hashX + tx_num + value + the length-prefixed asset name
+        return UTXOCache(32 + 4, HASHX_LEN + 5 + 8 + 1 + MAX_ASSET_NAME_LEN, False, capacity)
+
+    def cache_sizes(self):
+        '''Return a dict of the memory, in bytes, taken by each cache of
+        unflushed data.  Those of a flush in progress are not included;
+        see flushing_size.
+
+        Undo information is only kept after initial sync, and deletes
+        other than of spent outputs only in reorgs, so they are ignored.
+        '''
+        return {
+            'utxos': self.utxo_cache.nbytes,
+            'utxo deletes': sys.getsizeof(self.db_deletes)
+            + len(self.db_deletes) // 2 * DELETE_PAIR_SIZE,
+            'history': self.db.history.unflushed_memsize(),
+            'tx hashes': sys.getsizeof(self.tx_hashes) + self.tx_hashes_size,
+            'assets': self.asset_cache.nbytes,
+            'asset deletes': sys.getsizeof(self.asset_deletes)
+            + len(self.asset_deletes) // 2 * DELETE_PAIR_SIZE,
+            'asset data new': self.asset_data_new.nbytes,
+            'asset data reissued': self.asset_data_reissued.nbytes,
+            'asset broadcasts': self.asset_broadcast.nbytes,
+            'tag history': self.tag_to_address.nbytes,
+            'tags current': self.is_qualified.nbytes,
+            'freeze history': self.global_freezes.nbytes,
+            'freezes current': self.is_frozen.nbytes,
+            'verifier history': self.restricted_to_qualifier.nbytes,
+            'verifiers current': self.qr_associations.nbytes,
+        }
+
+    def check_cache_size(self):
+        '''Flush a cache if it gets too big.'''
         one_MB = 1000 * 1000
-        utxo_cache_size = len(self.utxo_cache) * 205
-        db_deletes_size = len(self.db_deletes) * 57
-        hist_cache_size = self.db.history.unflushed_memsize()
-        # Roughly ntxs * 32 + nblocks * 42
-        tx_hash_size = ((self.tx_count - self.db.fs_tx_count) * 32
-                        + (self.height - self.db.fs_height) * 42)
-
-        # TODO Fix/add these approximations
-        # These are average case approximations
-        asset_cache_size = len(self.asset_cache) * 235  # Added 30 bytes for the max name length
-        asset_data_new_size = len(self.asset_data_new) * 160
-        asset_data_reissue_size = len(self.asset_data_reissued) * 180
-        asset_broadcast_size = len(self.asset_broadcast) * 170
-
-        # These have a 1v1 correspondance, so average case is acceptable
-        asset_tag_history = len(self.tag_to_address) * 120
-        asset_history_freezes = len(self.global_freezes) * 230
-        asset_current_freezes = len(self.is_frozen) * 130
-
-        # The rest are variable length and will grow as the chain grows;
-        # on-spot size checks are needed
-        if self.restricted_to_qualifier_len != len(self.restricted_to_qualifier):
-            self.restricted_to_qualifier_size = deep_getsizeof(self.restricted_to_qualifier)
-            self.restricted_to_qualifier_len = len(self.restricted_to_qualifier)
-
-        if self.qr_associations_len != len(self.qr_associations):
-            self.qr_associations_size = deep_getsizeof(self.qr_associations)
-            self.qr_associations_len = len(self.qr_associations)
-
-        if self.tag_to_address_len != len(self.tag_to_address):
-            self.tag_to_address_size = deep_getsizeof(self.tag_to_address)
-            self.tag_to_address_len = len(self.tag_to_address)
-
-        if self.is_qualified_len != len(self.is_qualified):
-            self.is_qualified_size = deep_getsizeof(self.is_qualified)
-            self.is_qualified_len = len(self.is_qualified)
-
-        utxo_MB = (db_deletes_size + utxo_cache_size) // one_MB
-        hist_MB = (hist_cache_size + tx_hash_size) // one_MB
-        asset_MB = (asset_data_new_size + asset_data_reissue_size +
-                    asset_cache_size + asset_broadcast_size +
-                    asset_tag_history + asset_history_freezes +
-                    asset_current_freezes + self.restricted_to_qualifier_size +
-                    self.qr_associations_size + self.tag_to_address_size +
-                    self.is_qualified_size) // one_MB
+        sizes = self.cache_sizes()
+        utxo_MB = (sizes.pop('utxos') + sizes.pop('utxo deletes')) // one_MB
+        hist_MB = (sizes.pop('history') + sizes.pop('tx hashes')) // one_MB
+        asset_MB = sum(sizes.values()) // one_MB
+        flushing_MB = self.flushing_size // one_MB
 
         self.logger.info('our height: {:,d} daemon: {:,d} '
-                         'UTXOs {:,d}MB hist {:,d}MB assets {:,d}MB'
+                         'UTXOs {:,d}MB hist {:,d}MB assets {:,d}MB flushing {:,d}MB'
                          .format(self.height, self.daemon.cached_height(),
-                                 utxo_MB, hist_MB, asset_MB))
+                                 utxo_MB, hist_MB, asset_MB, flushing_MB))
+        self.log_sync_rate()
 
         # Flush history if it takes up over 20% of cache memory.
-        # Flush UTXOs once they take up 80% of cache memory.
+        # Flush UTXOs once they take up 80% of cache memory, or a checkpoint is due.
+        # The caches of a flush in progress count towards the UTXOs until it is
+        # committed; a flush waits for it, so memory stays within the cache.
         cache_MB = self.env.cache_MB
-        if asset_MB + utxo_MB + hist_MB >= cache_MB or hist_MB >= cache_MB // 5:
-            return (utxo_MB + asset_MB) >= cache_MB * 4 // 5
+        if self.db.checkpoint_due():
+            return True
+        utxo_MB += asset_MB + flushing_MB
+        if utxo_MB + hist_MB >= cache_MB or hist_MB >= cache_MB // 5:
+            return utxo_MB >= cache_MB * 4 // 5
         return None
 
+    def log_sync_rate(self):
+        '''Log the txs processed per second of block processing since the
+        last report.
+
+        The time advancing blocks includes deserializing them when that is
+        done in-process, so the rates with and without a pool compare.'''
+        deserializer = self.deserializer
+        tx_count, wait_time = deserializer.tx_count, deserializer.wait_time
+        last_tx_count, last_advance_time, last_wait_time = self.last_rate_report
+        self.last_rate_report = (tx_count, self.advance_time, wait_time)
+        txs = tx_count - last_tx_count
+        secs = self.advance_time - last_advance_time
+        if txs and secs > 0:
+            if deserializer.executor:
+                mode = f'{deserializer.processes:,d} deserializer processes'
+            else:
+                mode = 'deserializing in-process'
+            self.logger.info(f'processed {txs:,d} txs in {secs:.1f}s, {txs / secs:,.0f} tx/s '
+                             f'({mode}; {wait_time - last_wait_time:.1f}s of it deserializing)')
+
     async def _advance_blocks(self, raw_blocks):
         '''Process the list of raw blocks passed.  Detects and handles reorgs.'''
         start = time.monotonic()
-        first = self.height + 1
-        for n, raw_block in enumerate(raw_blocks):
-            block = self.coin.block(raw_block, first + n)
-            if self.coin.header_prevhash(block.header) != self.tip:
-                self.schedule_reorg(-1)
+        blocks = self.deserializer.blocks(raw_blocks, self.height + 1)
+        # The spends of each block are looked up while the one before it is advanced
+        pending = None
+        try:
+            async for block, header_hash in blocks:
+                # Spends are looked up in the DB, not the frozen caches, once committed
+                await self.release_flush()
+                prior = pending
+                pending = (block, header_hash,
+                           self._prefetch_spends(block, prior[0] if prior else None))
+                if prior and not await self._advance_prefetched(*prior):
+                    return
+            if pending and not await self._advance_prefetched(*pending):
                 return
-            await self._advance_block(block)
+            pending = None
+        finally:
+            if pending and pending[2]:
+                pending[2].cancel()
+            await blocks.aclose()
+            self.advance_time += time.monotonic() - start
         end = time.monotonic()
 
         if not self.db.first_sync:
@@ -554,9 +853,10 @@ class BlockProcessor:
             await self.flush(True)
             await self._on_caught_up()
         elif end > self.next_cache_check:
+            await self.release_flush()
             flush_arg = self.check_cache_size()
             if flush_arg is not None:
-                await self.flush(flush_arg)
+                await self.start_flush(flush_arg)
 
         if self._caught_up_event.is_set():
             await self.notifications.on_block(self.touched, self.height, self.asset_touched)
@@ -564,7 +864,64 @@ class BlockProcessor:
         self.touched = set()
         self.asset_touched = set()
 
-    async def _advance_block(self, block):
+    async def _advance_prefetched(self, block, header_hash, prefetch):
+        '''Advance a block given the future of its spends lookup.  Return False
+        if it does not connect to our tip, in which case a reorg is scheduled.'''
+        if self.coin.header_prevhash(block.header) != self.tip:
+            if prefetch:
+                prefetch.cancel()
+            self.schedule_reorg(-1)
+            return False
+        if prefetch:
+            self.prefetched_utxos, self.prefetched_assets = await prefetch
+        try:
+            await self._advance_block(block, header_hash)
+        finally:
+            self.prefetched_utxos = {}
+            self.prefetched_assets = {}
+        return True
+
+    def _prefetch_spends(self, block, prior_block):
+        '''Start looking up on disk the outputs spent by block and return a
+        future of the result, or None if there is nothing to look up.
+
+        prior_block, if not None, is advanced before block, so outputs it
+        creates are not on disk yet.  Only outputs missing from the UTXO
+        cache and any flush in progress now can be on disk when block is
+        advanced.
+        '''
+        exclude = {tx_hash for _tx, tx_hash in block.transactions}
+        if prior_block:
+            exclude.update(tx_hash for _tx, tx_hash in prior_block.transactions)
+        utxo_cache = self.utxo_cache
+        flushing_adds = self.flushing.adds if self.flushing else {}
+        keys = set()
+        for tx, _tx_hash in block.transactions:
+            for prev_hash, prev_idx in tx.prevouts():
+                if prev_hash in exclude:
+                    continue
+                key = prev_hash + pack_le_uint32(prev_idx)
+                if key not in utxo_cache and key not in flushing_adds:
+                    keys.add(key)
+        if not keys:
+            return None
+        # Sorted as the 'h' keys are for locality
+        keys = sorted(keys, key=lambda key: key[:4] + key[32:])
+        return asyncio.get_event_loop().run_in_executor(None, self._lookup_spends, keys)
+
+    def _lookup_spends(self, keys):
+        '''Return a pair of dicts mapping each key to its UTXO DB and asset DB
+        entries.  Outputs not in the UTXO DB are omitted; outputs not in
+        the asset DB map to None.  Run in a thread.'''
+        utxos = {}
+        for key in keys:
+            entry = self._lookup_spend(self.db.utxo_db, key[:32], key[32:])
+            if entry:
+                utxos[key] = entry
+        assets = {key: self._lookup_asset_spend(key[:32], key[32:]) for key in keys}
+        return utxos, assets
+
+    async def _advance_block(self, block, header_hash):
         '''Advance once block.  It is already verified they correctly connect onto our tip.'''
         min_height = self.db.min_undo_height(self.daemon.cached_height())
         height = self.height + 1
@@ -588,13 +945,16 @@ class BlockProcessor:
 
         self.height = height
         self.headers.append(block.header)
-        self.tip = self.coin.header_hash(block.header)
+        self.block_hashes.append(header_hash)
+        self.tip = header_hash
 
         await sleep(0)
 
     # TODO: Clean up this mess
     def advance_txs(self, txs, is_unspendable):
-        self.tx_hashes.append(b''.join(tx_hash for tx, tx_hash in txs))
+        tx_hashes = b''.join(tx_hash for tx, tx_hash in txs)
+        self.tx_hashes.append(tx_hashes)
+        self.tx_hashes_size += sys.getsizeof(tx_hashes)
 
         # Use local vars for speed in the loops
         undo_info = []
@@ -648,427 +1008,263 @@ class BlockProcessor:
             self.current_restricted_asset = None
             self.current_qualifiers = []
             # Spend the inputs
-            for txin in tx.inputs:
-                if txin.is_generation():  # Don't spend block rewards
-                    continue
-                cache_value = spend_utxo(txin.prev_hash, txin.prev_idx)
-                asset_cache_value = spend_asset(txin.prev_hash, txin.prev_idx)
+            for prev_hash, prev_idx in tx.prevouts():  # Not block rewards
+                cache_value = spend_utxo(prev_hash, prev_idx)
+                asset_cache_value = spend_asset(prev_hash, prev_idx)
                 undo_info_append(cache_value)
                 asset_undo_info_append(asset_cache_value)
                 append_hashX(cache_value[:-13])
 
             # Add the new UTXOs
-            for idx, txout in enumerate(tx.outputs):
+            for idx, (value, pk_script) in enumerate(tx.value_scripts()):
                 # Ignore unspendable outputs
-                if is_unspendable(txout.pk_script):
+                if is_unspendable(pk_script):
                     continue
 
-                # Many scripts are malformed. This is very problematic...
-                # We cannot assume scripts are valid just because they are from a node
-                # We need to check for:
-                # Bitcoin PUSHOPs
-                # Standard VARINTs
-
-                # deserialize the script pubkey
-                ops = Script.get_ops(txout.pk_script)
+                info = classify_script(pk_script)
+                kind = info.kind
 
-                if ops[0][0] == -1:
-                    # Quick check for invalid script.
+                if kind == ScriptKind.INVALID:
+                    # Many scripts are malformed; we cannot assume scripts are
+                    # valid just because they are from a node.
                     # Hash as-is for possible spends and continue.
-                    hashX = script_hashX(txout.pk_script)
+                    hashX = script_hashX(pk_script)
                     append_hashX(hashX)
                     put_utxo(tx_hash + to_le_uint32(idx),
-                             hashX + tx_numb + to_le_uint64(txout.value))
+                             hashX + tx_numb + to_le_uint64(value))
                     if self.env.write_bad_vouts_to_file:
                         b = bytearray(tx_hash)
                         b.reverse()
-                        file_name = base_encode(hashlib.md5(tx_hash + txout.pk_script).digest(), 58)
+                        file_name = base_encode(hashlib.md5(tx_hash + pk_script).digest(), 58)
                         with open(os.path.join(self.bad_vouts_path, str(self.height) + '_BADOPS_' + file_name),
                                   'w') as f:
                             f.write('TXID : {}\n'.format(b.hex()))
-                            f.write('SCRIPT : {}\n'.format(txout.pk_script.hex()))
-                            f.write('OPS : {}\n'.format(str(ops)))
+                            f.write('SCRIPT : {}\n'.format(pk_script.hex()))
+                            f.write('OPS : {}\n'.format(str(Script.get_ops(pk_script))))
                     continue
 
-                # This variable represents the op tuple where the OP_RVN_ASSET would be
-                op_ptr = match_script_against_template(ops, SCRIPTPUBKEY_TEMPLATE_P2PK)
-
-                if op_ptr > -1:
+                if kind == ScriptKind.P2PK:
                     # This is a P2PK script. Not used in favor of P2PKH. Convert to P2PKH for hashing DB Purposes.
-
-                    # Get the address bytes.
-                    addr_bytes = ops[0][2]
-                    addr = public_key_to_address(addr_bytes, self.coin.P2PKH_VERBYTE)
+                    addr = public_key_to_address(info.data, self.coin.P2PKH_VERBYTE)
                     hashX = self.coin.address_to_hashX(addr)
+                elif kind == ScriptKind.PLAIN:
+                    # If the script has OP_RVN_ASSET, everything before it is hashed
+                    if info.hash_end == len(pk_script):
+                        hashX = script_hashX(pk_script)
+                    else:
+                        hashX = script_hashX(pk_script[:info.hash_end])
                 else:
-                    invalid_script = False
-                    for i in range(len(ops)):
-                        op = ops[i][0]  # The OpCode
-                        if op == OpCodes.OP_RVN_ASSET:
-                            op_ptr = i
-                            break
-                        if op == -1:
-                            invalid_script = True
-                            break
-
-                    if invalid_script:
-                        # This script could not be parsed properly before any OP_RVN_ASSETs.
-                        # Hash as-is for possible spends and continue.
-                        hashX = script_hashX(txout.pk_script)
-                        append_hashX(hashX)
-                        put_utxo(tx_hash + to_le_uint32(idx),
-                                 hashX + tx_numb + to_le_uint64(txout.value))
+                    # This is an asset tag
+                    # These are verifiably unspendable
+
+                    # continue is called after this block
+
+                    idx = to_le_uint32(idx)
+
+                    try:
+                        if kind == ScriptKind.NULL_TAG:
+                            h160, asset_name, flag = parse_asset_tag(info.data, info.asset_script)
+                            name_byte_len = bytes([len(asset_name)])
+                            flag = bytes([flag])
+
+                            current_key = name_byte_len + asset_name + bytes([len(h160)]) + h160
+
+                            # Add tag history
+                            put_qualified_history(current_key +
+                                                  idx + tx_numb,
+                                                  flag)
+
+                            # b't' h160 -> asset
+                            # b'Q' asset -> h160
+                            old_qual_hist = []
+                            old_h160_hist = []
+
+                            qual_cached = pop_qualified_current(b'Q' + asset_name)
+                            if qual_cached:
+                                old_qual_hist = _other_tag_history(qual_cached, h160)
+                            else:
+                                qual_writed = self._asset_db_get(b'Q' + asset_name)
+                                if qual_writed:
+                                    old_qual_hist = _other_tag_history(qual_writed, h160)
+
+                            h160_cached = pop_qualified_current(b't' + h160)
+                            if h160_cached:
+                                old_h160_hist = _other_tag_history(h160_cached, asset_name)
+                            else:
+                                h160_writed = self._asset_db_get(b't' + h160)
+                                if h160_writed:
+                                    old_h160_hist = _other_tag_history(h160_writed, asset_name)
+
+                            qualified_undo_info.append(
+                                idx + tx_numb +
+                                name_byte_len + asset_name + bytes([len(old_qual_hist)]) + b''.join(old_qual_hist) +
+                                bytes([len(h160)]) + h160 + bytes([len(old_h160_hist)]) + b''.join(old_h160_hist)
+                            )
+
+                            old_qual_hist.append(bytes([len(h160)]) + h160 + idx + tx_numb + flag)
+                            old_h160_hist.append(name_byte_len + asset_name + idx + tx_numb + flag)
+
+                            put_qualified_current(
+                                b'Q' + asset_name,
+                                bytes([len(old_qual_hist)]) + b''.join(old_qual_hist)
+                            )
+
+                            put_qualified_current(
+                                b't' + h160,
+                                bytes([len(old_h160_hist)]) + b''.join(old_h160_hist)
+                            )
+
+                        elif kind == ScriptKind.NULL_VERIFIER:
+                            verifier = parse_asset_verifier(info.asset_script)
+                            self.current_qualifiers.extend(verifier.qualifiers)
+                            self.qualifiers_idx = idx
+                        elif kind == ScriptKind.NULL_RESTRICTION:
+                            asset_name, flag = parse_asset_freeze(info.asset_script)
+                            asset_name_len = bytes([len(asset_name)])
+                            flag = bytes([flag])
+
+                            put_freeze_history(
+                                asset_name_len + asset_name + idx + tx_numb, flag
+                            )
+
+                            old_frozen_info = b''
+                            cached_f = pop_freeze_current(asset_name)
+                            if cached_f:
+                                old_frozen_info = cached_f
+                            else:
+                                writed_f = self._asset_db_get(b'l' + asset_name)
+                                if writed_f:
+                                    old_frozen_info = writed_f
+
+                            freeze_undo_info.append(
+                                asset_name_len + asset_name + idx + tx_numb +
+                                (b'\x01' if len(old_frozen_info) > 0 else b'\0') + old_frozen_info
+                            )
+
+                            put_freeze_current(
+                                asset_name,
+                                idx + tx_numb + flag
+                            )
+
+                        else:
+                            raise Exception('Bad null asset script ops')
+                    except Exception as e:
                         if self.env.write_bad_vouts_to_file:
                             b = bytearray(tx_hash)
                             b.reverse()
-                            file_name = base_encode(hashlib.md5(tx_hash + txout.pk_script).digest(), 58)
-                            with open(os.path.join(self.bad_vouts_path, str(self.height) + '_BADOPS_' + file_name),
-                                      'w') as f:
+                            file_name = base_encode(hashlib.md5(tx_hash + pk_script).digest(), 58)
+                            with open(os.path.join(self.bad_vouts_path,
+                                                   str(self.height) + '_NULLASSET_' + file_name), 'w') as f:
                                 f.write('TXID : {}\n'.format(b.hex()))
-                                f.write('SCRIPT : {}\n'.format(txout.pk_script.hex()))
-                                f.write('OPS : {}\n'.format(str(ops)))
-                        continue
-
-                    if op_ptr > 0:
-                        # This script has OP_RVN_ASSET. Use everything before this for the script hash.
-                        # Get the raw script bytes ending ptr from the previous opcode.
-                        script_hash_end = ops[op_ptr - 1][1]
-                        hashX = script_hashX(txout.pk_script[:script_hash_end])
-                    elif op_ptr == 0:
-                        # This is an asset tag
-                        # These are verifiably unspendable
-
-                        # continue is called after this block
-
-                        idx = to_le_uint32(idx)
-
-                        try:
-                            if match_script_against_template(ops, ASSET_NULL_TEMPLATE) > -1:
-                                h160 = ops[1][2]
-                                asset_portion = ops[2][2]
-                                asset_portion_deserializer = DataParser(asset_portion)
-                                name_byte_len, asset_name = asset_portion_deserializer.read_var_bytes_tuple_bytes()
-                                flag = asset_portion_deserializer.read_byte()
-
-                                current_key = name_byte_len + asset_name + bytes([len(h160)]) + h160
-
-                                # Add tag history
-                                put_qualified_history(current_key +
-                                                      idx + tx_numb,
-                                                      flag)
-
-                                def parse_current_qualifier_history(data: bytes):
-                                    ret = []
-                                    parser = DataParser(data)
-                                    for _ in range(parser.read_int()):
-                                        old_h160_len, old_h160 = parser.read_var_bytes_tuple_bytes()
-                                        data = parser.read_bytes(4 + 5 + 1)
-                                        if h160 != old_h160:
-                                            ret.append(
-                                                old_h160_len + old_h160 +
-                                                data
-                                            )
-                                    return ret
-
-                                def parse_current_160_history(data: bytes):
-                                    ret = []
-                                    parser = DataParser(data)
-                                    for _ in range(parser.read_int()):
-                                        old_qualifier_len, old_qualifier = parser.read_var_bytes_tuple_bytes()
-                                        data = parser.read_bytes(4 + 5 + 1)
-                                        if asset_name != old_qualifier:
-                                            ret.append(
-                                                old_qualifier_len + old_qualifier +
-                                                data
-                                            )
-                                    return ret
-
-                                # b't' h160 -> asset
-                                # b'Q' asset -> h160
-                                old_qual_hist = []
-                                old_h160_hist = []
-
-                                qual_cached = pop_qualified_current(b'Q' + asset_name)
-                                if qual_cached:
-                                    old_qual_hist = parse_current_qualifier_history(qual_cached)
-                                else:
-                                    qual_writed = self.db.asset_db.get(b'Q' + asset_name)
-                                    if qual_writed:
-                                        old_qual_hist = parse_current_qualifier_history(qual_writed)
-
-                                h160_cached = pop_qualified_current(b't' + h160)
-                                if h160_cached:
-                                    old_h160_hist = parse_current_160_history(h160_cached)
-                                else:
-                                    h160_writed = self.db.asset_db.get(b't' + h160)
-                                    if h160_writed:
-                                        old_h160_hist = parse_current_160_history(h160_writed)
-
-                                qualified_undo_info.append(
-                                    idx + tx_numb +
-                                    name_byte_len + asset_name + bytes([len(old_qual_hist)]) + b''.join(old_qual_hist) +
-                                    bytes([len(h160)]) + h160 + bytes([len(old_h160_hist)]) + b''.join(old_h160_hist)
-                                )
-
-                                old_qual_hist.append(bytes([len(h160)]) + h160 + idx + tx_numb + flag)
-                                old_h160_hist.append(name_byte_len + asset_name + idx + tx_numb + flag)
-
-                                put_qualified_current(
-                                    b'Q' + asset_name,
-                                    bytes([len(old_qual_hist)]) + b''.join(old_qual_hist)
-                                )
-
-                                put_qualified_current(
-                                    b't' + h160,
-                                    bytes([len(old_h160_hist)]) + b''.join(old_h160_hist)
-                                )
-
-                            elif match_script_against_template(ops, ASSET_NULL_VERIFIER_TEMPLATE) > -1:
-                                qualifiers_b = ops[2][2]
-                                qualifiers_deserializer = DataParser(qualifiers_b)
-                                asset_name = qualifiers_deserializer.read_var_bytes_as_ascii()
-                                for asset in asset_name.split('&'):
-                                    if asset[0] != '#':
-                                        if 'A' <= asset[0] <= 'Z' or '0' <= asset[0] <= '9':
-                                            # This is a valid asset name
-                                            asset = '#' + asset
-                                        elif asset == 'true':
-                                            # No associated qualifiers
-                                            # Dummy data
-                                            asset = ''
-                                        else:
-                                            raise Exception('Bad qualifier')
-
-                                    self.current_qualifiers.append(asset.encode('ascii'))
-                                self.qualifiers_idx = idx
-                            elif match_script_against_template(ops, ASSET_GLOBAL_RESTRICTION_TEMPLATE) > -1:
-                                asset_portion = ops[3][2]
-
-                                asset_portion_deserializer = DataParser(asset_portion)
-                                asset_name_len, asset_name = asset_portion_deserializer.read_var_bytes_tuple_bytes()
-                                flag = asset_portion_deserializer.read_byte()
-
-                                put_freeze_history(
-                                    asset_name_len + asset_name + idx + tx_numb, flag
-                                )
-
-                                old_frozen_info = b''
-                                cached_f = pop_freeze_current(asset_name)
-                                if cached_f:
-                                    old_frozen_info = cached_f
-                                else:
-                                    writed_f = self.db.asset_db.get(b'l' + asset_name)
-                                    if writed_f:
-                                        old_frozen_info = writed_f
-
-                                freeze_undo_info.append(
-                                    asset_name_len + asset_name + idx + tx_numb +
-                                    (b'\x01' if len(old_frozen_info) > 0 else b'\0') + old_frozen_info
-                                )
-
-                                put_freeze_current(
-                                    asset_name,
-                                    idx + tx_numb + flag
-                                )
-
-                            else:
-                                raise Exception('Bad null asset script ops')
-                        except Exception as e:
-                            if self.env.write_bad_vouts_to_file:
-                                b = bytearray(tx_hash)
-                                b.reverse()
-                                file_name = base_encode(hashlib.md5(tx_hash + txout.pk_script).digest(), 58)
-                                with open(os.path.join(self.bad_vouts_path,
-                                                       str(self.height) + '_NULLASSET_' + file_name), 'w') as f:
-                                    f.write('TXID : {}\n'.format(b.hex()))
-                                    f.write('SCRIPT : {}\n'.format(txout.pk_script.hex()))
-                                    f.write('OpCodes : {}\n'.format(str(ops)))
-                                    f.write('Exception : {}\n'.format(repr(e)))
-                                    f.write('Traceback : {}\n'.format(traceback.format_exc()))
-                            if isinstance(e, (DataParser.ParserException, KeyError)):
-                                raise e
-                        continue
-                    else:
-                        # There is no OP_RVN_ASSET. Hash as-is.
-                        hashX = script_hashX(txout.pk_script)
+                                f.write('SCRIPT : {}\n'.format(pk_script.hex()))
+                                f.write('OpCodes : {}\n'.format(str(Script.get_ops(pk_script))))
+                                f.write('Exception : {}\n'.format(repr(e)))
+                                f.write('Traceback : {}\n'.format(traceback.format_exc()))
+                        if isinstance(e, (DataParser.ParserException, KeyError)):
+                            raise e
+                    continue
 
                 # Add UTXO info to the database
                 append_hashX(hashX)
                 put_utxo(tx_hash + to_le_uint32(idx),
-                         hashX + tx_numb + to_le_uint64(txout.value))
+                         hashX + tx_numb + to_le_uint64(value))
 
                 # Now try and add asset info
-                def try_parse_asset(asset_deserializer: DataParser, second_loop=False):
-                    op = asset_deserializer.read_bytes(3)
-                    if op != b'rvn':
-                        raise Exception("Expected {}, was {}".format(b'rvn', op))
-                    script_type = asset_deserializer.read_byte()
-                    asset_name_len, asset_name = asset_deserializer.read_var_bytes_tuple_bytes()
-                    if asset_name[0] == b'$'[0]:
+                if info.asset_start is None:
+                    continue
+                try:
+                    asset = parse_script_asset(pk_script, info.asset_start, info.asset_script)
+                    asset_type = type(asset)
+                    asset_name = asset.name
+                    asset_name_len = bytes([len(asset_name)])
+                    idx_b = to_le_uint32(idx)
+                    sats = to_le_uint64(asset.value)
+                    if asset_name[0] == 0x24:  # b'$'
                         self.current_restricted_asset = asset_name
-                        self.restricted_idx = to_le_uint32(idx)
-                    if script_type == b'o':
+                        self.restricted_idx = idx_b
+
+                    if asset_type is TransferAsset:
+                        put_asset(tx_hash + idx_b,
+                                  hashX + tx_numb + sats + asset_name_len + asset_name)
+
+                        # This hashX was also in the inputs; we are sending to ourself; this is a broadcast
+                        if asset.data is not None and b'~' in asset_name and hashX in hashXs:
+                            put_asset_broadcast(asset_name_len + asset_name + idx_b + tx_numb,
+                                                asset.data)
+                            asset_broadcast_undo_info.append(
+                                asset_name_len + asset_name + idx_b + tx_numb)
+                    elif asset_type is OwnerAsset:
                         # This is an ownership asset. It does not have any metadata.
                         # Just assign it with a value of 1
-                        put_asset(tx_hash + to_le_uint32(idx),
-                                  hashX + tx_numb + to_le_uint64(100_000_000) +
-                                  asset_name_len + asset_name)
-                        put_asset_data_new(asset_name, to_le_uint64(100_000_000) + b'\0\0\0' + to_le_uint32(idx) + tx_numb + b'\0')
+                        put_asset(tx_hash + idx_b,
+                                  hashX + tx_numb + sats + asset_name_len + asset_name)
+                        put_asset_data_new(asset_name, sats + b'\0\0\0' + idx_b + tx_numb + b'\0')
                         asset_meta_undo_info_append(  # Set previous meta to null in case of roll back
                             asset_name_len + asset_name + b'\0')
                         self.asset_touched.add(asset_name.decode('ascii'))
-                    else:  # Not an owner asset; has a sat amount
-                        sats = asset_deserializer.read_bytes(8)
-                        if script_type == b'q':  # A new asset issuance
-                            asset_data = asset_deserializer.read_bytes(2)
-                            has_meta = asset_deserializer.read_byte()
-                            asset_data += has_meta
-                            if has_meta != b'\0':
-                                asset_data += asset_deserializer.read_bytes(34)
-
-                            # To tell the client where this data came from
-                            asset_data += to_le_uint32(idx) + tx_numb + b'\0'
-
-                            # Put DB functions at the end to prevent them from pushing before any errors
-                            put_asset_data_new(asset_name, sats + asset_data)  # Add meta for this asset
-                            asset_meta_undo_info_append(  # Set previous meta to null in case of roll back
-                                asset_name_len + asset_name + b'\0')
-                            put_asset(tx_hash + to_le_uint32(idx),
-                                      hashX + tx_numb + sats +
-                                      asset_name_len + asset_name)
-                            self.asset_touched.add(asset_name.decode('ascii'))
-                        elif script_type == b'r':  # An asset re-issuance
-                            divisions = asset_deserializer.read_byte()
-                            reissuable = asset_deserializer.read_byte()
-
-                            # Quicker check, but it's far more likely to be in the db
-                            old_data = self.asset_data_new.pop(asset_name, None)
-                            if old_data is None:
-                                old_data = self.asset_data_reissued.pop(asset_name, None)
-                            if old_data is None:
-                                old_data = self.db.asset_info_db.get(asset_name)
-                            assert old_data is not None  # If reissuing, we should have it
-
-                            asset_data = b''
-
-                            old_sats = int.from_bytes(old_data[:8], 'little')
-                            new_sats = int.from_bytes(sats, 'little')
-
-                            total_sats = old_sats + new_sats
-
-                            if divisions == b'\xff':  # Unchanged division amount
-                                asset_data += old_data[8].to_bytes(1, 'big')
-                            else:
-                                asset_data += divisions
+                    elif asset_type is NewAsset:  # A new asset issuance
+                        asset_data = bytes((asset.divisions, asset.reissuable, asset.has_ipfs))
+                        if asset.ipfs:
+                            asset_data += asset.ipfs
 
-                            asset_data += reissuable
-                            if asset_deserializer.is_finished():
-                                # No more data
-                                asset_data += b'\0'
-                            else:
-                                if second_loop:
-                                    if asset_deserializer.cursor + 34 <= asset_deserializer.length:
-                                        asset_data += b'\x01'
-                                        asset_data += asset_deserializer.read_bytes(34)
-                                    else:
-                                        asset_data += b'\0'
-                                else:
-                                    asset_data += b'\x01'
-                                    asset_data += asset_deserializer.read_bytes(34)
-
-                            asset_data += to_le_uint32(idx) + tx_numb
-                            if divisions == b'\xff':
-                                # We need to tell the client the original tx for reissues
-                                asset_data += b'\x01' + old_data[-(4 + 5) - 1:-1] + b'\0'
-                            else:
-                                asset_data += b'\0'
-
-                            # Put DB functions at the end to prevent them from pushing before any errors
-
-                            self.asset_touched.add(asset_name.decode('ascii'))
-
-                            put_asset_data_reissued(asset_name, total_sats.to_bytes(8, 'little', signed=False) + asset_data)
-                            asset_meta_undo_info_append(
-                                asset_name_len + asset_name +
-                                bytes([len(old_data)]) + old_data)
-                            put_asset(tx_hash + to_le_uint32(idx),
-                                      hashX + tx_numb + sats +
-                                      asset_name_len + asset_name)
-                        elif script_type == b't':
-                            # Put DB functions at the end to prevent them from pushing before any errors
-                            put_asset(tx_hash + to_le_uint32(idx),
-                                      hashX + tx_numb + sats +
-                                      asset_name_len + asset_name)
-
-                            if not asset_deserializer.is_finished():
-                                if b'~' in asset_name and hashX in hashXs:  # This hashX was also in the inputs; we are sending to ourself; this is a broadcast
-                                    if second_loop:
-                                        if asset_deserializer.cursor + 34 <= asset_deserializer.length:
-                                            data = asset_deserializer.read_bytes(34)
-                                            # This is a message broadcast
-                                            put_asset_broadcast(
-                                                asset_name_len + asset_name + to_le_uint32(idx) + tx_numb, data)
-                                            asset_broadcast_undo_info.append(
-                                                asset_name_len + asset_name + to_le_uint32(idx) + tx_numb)
-                                    else:
-                                        data = asset_deserializer.read_bytes(34)
-                                        # This is a message broadcast
-                                        put_asset_broadcast(asset_name_len + asset_name + to_le_uint32(idx) + tx_numb,
-                                                            data)
-                                        asset_broadcast_undo_info.append(
-                                            asset_name_len + asset_name + to_le_uint32(idx) + tx_numb)
+                        # To tell the client where this data came from
+                        asset_data += idx_b + tx_numb + b'\0'
+
+                        put_asset_data_new(asset_name, sats + asset_data)  # Add meta for this asset
+                        asset_meta_undo_info_append(  # Set previous meta to null in case of roll back
+                            asset_name_len + asset_name + b'\0')
+                        put_asset(tx_hash + idx_b,
+                                  hashX + tx_numb + sats + asset_name_len + asset_name)
+                        self.asset_touched.add(asset_name.decode('ascii'))
+                    else:  # An asset re-issuance
+                        # Quicker check, but it's far more likely to be in the db
+                        old_data = self.asset_data_new.pop(asset_name, None)
+                        if old_data is None:
+                            old_data = self.asset_data_reissued.pop(asset_name, None)
+                        if old_data is None:
+                            old_data = self._asset_info_get(asset_name)
+                        assert old_data is not None  # If reissuing, we should have it
+
+                        total_sats = int.from_bytes(old_data[:8], 'little') + asset.value
+
+                        if asset.divisions == 0xff:  # Unchanged division amount
+                            divisions = old_data[8]
+                        else:
+                            divisions = asset.divisions
+                        asset_data = bytes((divisions, asset.reissuable))
+                        if asset.ipfs:
+                            asset_data += b'\x01' + asset.ipfs
                         else:
-                            raise Exception('Unknown asset type: {}'.format(script_type))
+                            asset_data += b'\0'
 
-                # function for malformed asset
-                def try_parse_asset_iterative(script: bytes):
-                    while script[:3] != b'rvn' and len(script) > 0:
-                        script = script[1:]
-                    assert script[:3] == b'rvn'
-                    return try_parse_asset(DataParser(script), True)
+                        asset_data += idx_b + tx_numb
+                        if asset.divisions == 0xff:
+                            # We need to tell the client the original tx for reissues
+                            asset_data += b'\x01' + old_data[-(4 + 5) - 1:-1] + b'\0'
+                        else:
+                            asset_data += b'\0'
 
-                # Me @ core devs
-                # https://www.youtube.com/watch?v=iZlpsneDGBQ
+                        self.asset_touched.add(asset_name.decode('ascii'))
 
-                if 0 < op_ptr < len(ops):
-                    assert ops[op_ptr][0] == OpCodes.OP_RVN_ASSET  # Sanity check
-                    try:
-                        next_op = ops[op_ptr + 1]
-                        if next_op[0] == -1:
-                            # This contains the raw data. Deserialize.
-                            asset_script_deserializer = DataParser(next_op[2])
-                            asset_script = asset_script_deserializer.read_var_bytes()
-                        elif len(ops) > op_ptr + 4 and \
-                                ops[op_ptr + 2][0] == b'r'[0] and \
-                                ops[op_ptr + 3][0] == b'v'[0] and \
-                                ops[op_ptr + 4][0] == b'n'[0]:
-                            asset_script_portion = txout.pk_script[ops[op_ptr][1]:]
-                            asset_script_deserializer = DataParser(asset_script_portion)
-                            asset_script = asset_script_deserializer.read_var_bytes()
-                        else:
-                            # Hurray! This i̶s̶ ̶a̶ COULD BE A properly formatted asset script
-                            asset_script = next_op[2]
-
-                        asset_deserializer = DataParser(asset_script)
-                        try_parse_asset(asset_deserializer)
-                        is_asset = True
-
-                    except:
-                        try:
-                            try_parse_asset_iterative(txout.pk_script[ops[op_ptr][1]:])
-                            is_asset = True
-                        except Exception as e:
-                            if self.env.write_bad_vouts_to_file:
-                                b = bytearray(tx_hash)
-                                b.reverse()
-                                file_name = base_encode(hashlib.md5(tx_hash + txout.pk_script).digest(), 58)
-                                with open(os.path.join(self.bad_vouts_path, str(self.height) + '_' + file_name),
-                                          'w') as f:
-                                    f.write('TXID : {}\n'.format(b.hex()))
-                                    f.write('SCRIPT : {}\n'.format(txout.pk_script.hex()))
-                                    f.write('OpCodes : {}\n'.format(str(ops)))
-                                    f.write('Exception : {}\n'.format(repr(e)))
-                                    f.write('Traceback : {}\n'.format(traceback.format_exc()))
+                        put_asset_data_reissued(asset_name, total_sats.to_bytes(8, 'little', signed=False) + asset_data)
+                        asset_meta_undo_info_append(
+                            asset_name_len + asset_name +
+                            bytes([len(old_data)]) + old_data)
+                        put_asset(tx_hash + idx_b,
+                                  hashX + tx_numb + sats + asset_name_len + asset_name)
+                    is_asset = True
+                except Exception as e:
+                    if self.env.write_bad_vouts_to_file:
+                        b = bytearray(tx_hash)
+                        b.reverse()
+                        file_name = base_encode(hashlib.md5(tx_hash + pk_script).digest(), 58)
+                        with open(os.path.join(self.bad_vouts_path, str(self.height) + '_' + file_name),
+                                  'w') as f:
+                            f.write('TXID : {}\n'.format(b.hex()))
+                            f.write('SCRIPT : {}\n'.format(pk_script.hex()))
+                            f.write('OpCodes : {}\n'.format(str(Script.get_ops(pk_script))))
+                            f.write('Exception : {}\n'.format(repr(e)))
+                            f.write('Traceback : {}\n'.format(traceback.format_exc()))
 
             if self.current_restricted_asset and self.current_qualifiers:
                 res = self.current_restricted_asset  # type: bytes
@@ -1076,147 +1272,58 @@ class BlockProcessor:
 
                 tag_historical = self.restricted_to_qualifier.__setitem__
                 tag_current = self.qr_associations.__setitem__
-
-                def pop_current(x):
-                    return self.qr_associations.pop(x, None)
-
+                current_associations = self._current_associations
                 undo_append = association_undo_info.append
 
-                res_idx = self.restricted_idx
-                qual_idx = self.qualifiers_idx
-
-                def get_current_association_data(data: bytes):
-                    parser = DataParser(data)
-                    ret = []
-                    for _ in range(parser.read_int()):
-                        ret.append((
-                            parser.read_var_bytes(),  # asset
-                            parser.read_bytes(4 + 4 + 5),  # res idx, qual idx, tx_num
-                            parser.read_boolean(),  # Associated or un-associated
-                        ))
-                    return ret
-
-                old_res_info = []
-                cached_f = pop_current(b'r' + res)
-                if cached_f:
-                    old_res_info = get_current_association_data(cached_f)
-                else:
-                    writed_f = self.db.asset_db.get(b'r' + res)
-                    if writed_f:
-                        old_res_info = get_current_association_data(writed_f)
+                idxs = self.restricted_idx + self.qualifiers_idx + tx_numb
+
+                old_res_info = current_associations(b'r' + res)
 
-                qual_removals = set(tup[0] for tup in old_res_info) - set(quals)
+                old_quals = {assoc.name for assoc in old_res_info}
+                qual_removals = old_quals - set(quals)
 
                 tag_historical(
-                    bytes([len(res)]) + res + res_idx + qual_idx + tx_numb,
+                    bytes([len(res)]) + res + idxs,
                     (quals, qual_removals)
                 )
 
-                undo_append(bytes([len(res)]) + res + res_idx + qual_idx + tx_numb +
+                undo_append(bytes([len(res)]) + res + idxs +
                             bytes([len(quals) + len(qual_removals)]) +
                             b''.join([bytes([len(q)]) + q for q in quals]) +
                             b''.join([bytes([len(q)]) + q for q in qual_removals]))
 
-                new_checked = set()
-
-                def check_name(name: bytes) -> bool:
-                    nonlocal new_checked
-                    if name in quals:
-                        new_checked.add(name)
-                        return True
-                    else:
-                        return False
-
-                new_res_info = [
-                    ((tup[0], res_idx + qual_idx + tx_numb, True) if check_name(tup[0])
-                     else (tup[0], res_idx + qual_idx + tx_numb, False))
-                    for tup in old_res_info
-                ]
+                new_checked = set(quals) & old_quals
+                new_res_info = [Association(assoc.name, idxs, assoc.name in new_checked)
+                                for assoc in old_res_info]
+                new_res_info.extend(Association(qual, idxs, True)
+                                    for qual in set(quals) - new_checked)
 
-                for qual in set(quals) - new_checked:
-                    new_res_info.append((
-                        qual,
-                        res_idx + qual_idx + tx_numb,
-                        True
-                    ))
+                undo_append(pack_associations(old_res_info))
 
-                new_res_info = [bytes([len(tup[0])]) +
-                                tup[0] + tup[1] + (b'\x01' if tup[2] else b'\0')
-                                for tup in new_res_info]
-
-                undo_append(bytes([len(old_res_info)]) + b''.join([bytes([len(tup[0])]) +
-                            tup[0] + tup[1] + (b'\x01' if tup[2] else b'\0')
-                            for tup in old_res_info]))
-
-                tag_current(b'r' + res, bytes([len(new_res_info)]) + b''.join(new_res_info))
+                tag_current(b'r' + res, pack_associations(new_res_info))
 
                 qual_undos = []
 
                 for qual in quals:
-                    old_qual_info = []
-                    cached_q = pop_current(b'c' + qual)
-                    if cached_q:
-                        old_qual_info = get_current_association_data(cached_q)
-                    else:
-                        writed_q = self.db.asset_db.get(b'c' + qual)
-                        if writed_q:
-                            old_qual_info = get_current_association_data(writed_q)
-
-                    has_res = False
-
-                    def check_name(name: bytes) -> bool:
-                        nonlocal has_res
-                        b = name == res
-                        if not has_res:
-                            has_res = b
-                        return b
-
-                    new_qual_info = [
-                        ((tup[0], res_idx + qual_idx + tx_numb, True) if check_name(tup[0])
-                         else tup)
-                        for tup in old_qual_info
-                    ]
+                    old_qual_info = current_associations(b'c' + qual)
+                    new_qual_info = [Association(res, idxs, True) if assoc.name == res else assoc
+                                     for assoc in old_qual_info]
+                    if not any(assoc.name == res for assoc in old_qual_info):
+                        new_qual_info.append(Association(res, idxs, True))
 
-                    if not has_res:
-                        new_qual_info.append((res, res_idx + qual_idx + tx_numb, True))
+                    qual_undos.append(bytes([len(qual)]) + qual + pack_associations(old_qual_info))
 
-                    new_qual_info = [bytes([len(tup[0])]) +
-                                    tup[0] + tup[1] + (b'\x01' if tup[2] else b'\0')
-                                    for tup in new_qual_info]
-
-                    qual_undos.append(bytes([len(qual)]) + qual +
-                                      bytes([len(old_qual_info)]) + b''.join([bytes([len(tup[0])]) +
-                                      tup[0] + tup[1] + (b'\x01' if tup[2] else b'\0')
-                                      for tup in old_qual_info]))
-
-                    tag_current(b'c' + qual, bytes([len(new_qual_info)]) + b''.join(new_qual_info))
+                    tag_current(b'c' + qual, pack_associations(new_qual_info))
 
                 for qual in qual_removals:
-                    old_qual_info = []
-                    cached_q = pop_current(b'c' + qual)
-                    if cached_q:
-                        old_qual_info = get_current_association_data(cached_q)
-                    else:
-                        writed_q = self.db.asset_db.get(b'c' + qual)
-                        if writed_q:
-                            old_qual_info = get_current_association_data(writed_q)
-                    new_qual_info = [
-                        ((tup[0], res_idx + qual_idx + tx_numb, False) if tup[0] == res
-                         else tup)
-                        for tup in old_qual_info
-                    ]
-                    new_qual_info = [bytes([len(tup[0])]) +
-                                     tup[0] + tup[1] + (b'\x01' if tup[2] else b'\0')
-                                     for tup in new_qual_info]
-                    qual_undos.append(bytes([len(qual)]) + qual +
-                                      bytes([len(old_qual_info)]) + b''.join([bytes([len(tup[0])]) +
-                                                                              tup[0] + tup[1] + (
-                                                                                  b'\x01' if tup[2] else b'\0')
-                                                                              for tup in old_qual_info]))
+                    old_qual_info = current_associations(b'c' + qual)
+                    new_qual_info = [Association(res, idxs, False) if assoc.name == res else assoc
+                                     for assoc in old_qual_info]
+                    qual_undos.append(bytes([len(qual)]) + qual + pack_associations(old_qual_info))
 
                     undo_append(bytes([len(qual_undos)]) + b''.join(qual_undos))
 
-                    tag_current(b'c' + qual, bytes([len(new_qual_info)]) + b''.join(new_qual_info))
+                    tag_current(b'c' + qual, pack_associations(new_qual_info))
 
             append_hashXs(hashXs)
             update_touched(hashXs)
@@ -1516,23 +1623,24 @@ class BlockProcessor:
     performance during initial sync, because then it is possible to
     spend UTXOs without ever going to the database (other than as an
     entry in the address history, and there is only one such entry per
-    TX not per UTXO).  So store them in a Python dictionary with
-    binary keys and values.
+    TX not per UTXO).  So store them in a UTXOCache, a hash table whose
+    buckets pack their binary keys and values into one bytes object.
 
       Key:    TX_HASH + TX_IDX           (32 + 4 = 36 bytes)
       Value:  HASHX + TX_NUM + VALUE     (11 + 5 + 8 = 24 bytes)
 
-    That's 60 bytes of raw data in-memory.  Python dictionary overhead
-    means each entry actually uses about 205 bytes of memory.  So
-    almost 5 million UTXOs can fit in 1GB of RAM.  There are
-    approximately 42 million UTXOs on bitcoin mainnet at height
-    433,000.
+    That's 60 bytes of raw data in-memory.  With its share of the
+    bucket overhead each entry uses about 63 bytes of memory, against
+    about 170 bytes in a Python dictionary.  So almost 16 million UTXOs
+    can fit in 1GB of RAM.  The price is that adding or spending a UTXO
+    rewrites its bucket, taking about 3us rather than the 0.5us of a
+    dictionary; a few microseconds per transaction.
 
     Semantics:
 
-      add:   Add it to the cache dictionary.
+      add:   Add it to the cache.
 
-      spend: Remove it if in the cache dictionary.  Otherwise it's
+      spend: Remove it if in the cache.  Otherwise it's
              been flushed to the DB.  Each UTXO is responsible for two
              entries in the DB.  Mark them for deletion in the next
              cache flush.
@@ -1563,26 +1671,14 @@ class BlockProcessor:
     collision rate is low (<0.1%).
     '''
 
-    def spend_utxo(self, tx_hash, tx_idx):
-        '''Spend a UTXO and return the 33-byte value.
-
-        If the UTXO is not in the cache it must be on disk.  We store
-        all UTXOs so not finding one indicates a logic error or DB
-        corruption.
-        '''
-        # Fast track is it being in the cache
-        idx_packed = pack_le_uint32(tx_idx)
-        cache_value = self.utxo_cache.pop(tx_hash + idx_packed, None)
-        if cache_value:
-            return cache_value
-
-        # Spend it from the DB.
-
+    def _lookup_spend(self, db, tx_hash, idx_packed):
+        '''Look up an unspent output in the UTXO or asset DB.  Return a
+        (hdb_key, udb_key, hashX, db_value) tuple, or None if not found.'''
         # Key: b'h' + compressed_tx_hash + tx_idx + tx_num
         # Value: hashX
         prefix = b'h' + tx_hash[:4] + idx_packed
         candidates = {db_key: hashX for db_key, hashX
-                      in self.db.utxo_db.iterator(prefix=prefix)}
+                      in db.iterator(prefix=prefix)}
 
         for hdb_key, hashX in candidates.items():
             tx_num_packed = hdb_key[-5:]
@@ -1595,54 +1691,126 @@ class BlockProcessor:
                     continue
 
             # Key: b'u' + address_hashX + tx_idx + tx_num
-            # Value: the UTXO value as a 64-bit unsigned integer
             udb_key = b'u' + hashX + hdb_key[-9:]
-            utxo_value_packed = self.db.utxo_db.get(udb_key)
-            if utxo_value_packed:
-                # Remove both entries for this UTXO
-                self.db_deletes.append(hdb_key)
-                self.db_deletes.append(udb_key)
-                return hashX + tx_num_packed + utxo_value_packed
+            db_value = db.get(udb_key)
+            if db_value:
+                return hdb_key, udb_key, hashX, db_value
+        return None
 
-        raise ChainError('UTXO {} / {:,d} not found in "h" table'
-                         .format(hash_to_hex_str(tx_hash), tx_idx))
+    def _lookup_asset_spend(self, tx_hash, idx_packed):
+        '''As for _lookup_spend() on the asset DB, but skip the lookup if the
+        asset outpoint filter rules the outpoint out.'''
+        if not self.db.asset_outpoint_may_exist(tx_hash, idx_packed):
+            return None
+        entry = self._lookup_spend(self.db.asset_db, tx_hash, idx_packed)
+        if entry is None:
+            self.db.asset_filter_false_positives += 1
+        return entry
+
+    @staticmethod
+    def _flushing_db_keys(key, cache_value):
+        '''Return the 'h' and 'u' DB keys an output cached with cache_value
+        is flushed to.'''
+        hashX = cache_value[:HASHX_LEN]
+        suffix = key[-4:] + cache_value[HASHX_LEN:HASHX_LEN + 5]
+        return b'h' + key[:4] + suffix, b'u' + hashX + suffix
+
+    def _asset_db_get(self, key):
+        '''Get the current value of key from any flush in progress or else
+        the asset DB.'''
+        flushing = self.flushing
+        if flushing:
+            prefix = key[:1]
+            if prefix in (b'Q', b't'):
+                value = flushing.asset_tag2pub_current.get(key)
+            elif prefix in (b'r', b'c'):
+                value = flushing.asset_current_associations.get(key)
+            else:
+                assert prefix == b'l'
+                value = flushing.asset_restricted_freezes_current.get(key[1:])
+            if value is not None:
+                return value
+        return self.db.asset_db.get(key)
+
+    def _current_associations(self, key):
+        '''Remove and return the current associations of the restricted
+        asset or qualifier under key as a list of Association.'''
+        data = self.qr_associations.pop(key, None) or self._asset_db_get(key)
+        return parse_associations(data) if data else []
+
+    def _asset_info_get(self, asset_name):
+        '''Get the metadata of an asset from any flush in progress or else
+        the asset info DB.'''
+        flushing = self.flushing
+        if flushing:
+            value = flushing.asset_meta_adds.get(asset_name)
+            if value is None:
+                value = flushing.asset_meta_reissues.get(asset_name)
+            if value is not None:
+                return value
+        return self.db.asset_info_db.get(asset_name)
 
-    def spend_asset(self, tx_hash, tx_idx):
-        # TODO: Find a way to make this faster
+    def spend_utxo(self, tx_hash, tx_idx):
+        '''Spend a UTXO and return the 33-byte value.
+
+        If the UTXO is not in the cache it must be on disk.  We store
+        all UTXOs so not finding one indicates a logic error or DB
+        corruption.
+        '''
         # Fast track is it being in the cache
         idx_packed = pack_le_uint32(tx_idx)
-        cache_value = self.asset_cache.pop(tx_hash + idx_packed, None)
+        key = tx_hash + idx_packed
+        cache_value = self.utxo_cache.pop(key, None)
         if cache_value:
-            return tx_hash + idx_packed + cache_value
-
-        # Spend it from the DB.
+            return cache_value
 
-        # Key: b'h' + compressed_tx_hash + tx_idx + tx_num
-        # Value: hashX
-        prefix = b'h' + tx_hash[:4] + idx_packed
-        candidates = {db_key: hashX for db_key, hashX
-                      in self.db.asset_db.iterator(prefix=prefix)}
+        # Spend it from a flush in progress; the next flush deletes it
+        if self.flushing:
+            cache_value = self.flushing.adds.get(key)
+            if cache_value:
+                self.db_deletes.extend(self._flushing_db_keys(key, cache_value))
+                return cache_value
 
-        for hdb_key, hashX in candidates.items():
-            tx_num_packed = hdb_key[-5:]
+        # Spend it from the DB.
+        entry = self.prefetched_utxos.pop(key, None)
+        if entry is None:
+            entry = self._lookup_spend(self.db.utxo_db, tx_hash, idx_packed)
+        if entry:
+            # Value: the UTXO value as a 64-bit unsigned integer
+            hdb_key, udb_key, hashX, utxo_value_packed = entry
+            # Remove both entries for this UTXO
+            self.db_deletes.append(hdb_key)
+            self.db_deletes.append(udb_key)
+            return hashX + hdb_key[-5:] + utxo_value_packed
 
-            if len(candidates) > 1:
-                tx_num, = unpack_le_uint64(tx_num_packed + bytes(3))
-                # Assets are on txs
-                fs_hash, _height = self.db.fs_tx_hash(tx_num)
-                if fs_hash != tx_hash:
-                    assert fs_hash is not None  # Should always be found
-                    continue
+        raise ChainError('UTXO {} / {:,d} not found in "h" table'
+                         .format(hash_to_hex_str(tx_hash), tx_idx))
 
-            # Key: b'u' + address_hashX + tx_idx + tx_num
+    def spend_asset(self, tx_hash, tx_idx):
+        # Fast track is it being in the cache
+        idx_packed = pack_le_uint32(tx_idx)
+        key = tx_hash + idx_packed
+        cache_value = self.asset_cache.pop(key, None)
+        if cache_value:
+            return key + cache_value
+
+        if self.flushing:
+            cache_value = self.flushing.asset_adds.get(key)
+            if cache_value:
+                self.asset_deletes.extend(self._flushing_db_keys(key, cache_value))
+                return key + cache_value
+
+        # Spend it from the DB.  A prefetched None means it is not an asset.
+        entry = self.prefetched_assets.pop(key, False)
+        if entry is False:
+            entry = self._lookup_asset_spend(tx_hash, idx_packed)
+        if entry:
             # Value: the asset amt and name
-            udb_key = b'u' + hashX + hdb_key[-9:]
-            value = self.db.asset_db.get(udb_key)
-            if value:
-                # Remove both entries for this Asset
-                self.asset_deletes.append(hdb_key)
-                self.asset_deletes.append(udb_key)
-                return tx_hash + idx_packed + hashX + tx_num_packed + value
+            hdb_key, udb_key, hashX, value = entry
+            # Remove both entries for this Asset
+            self.asset_deletes.append(hdb_key)
+            self.asset_deletes.append(udb_key)
+            return key + hashX + hdb_key[-5:] + value
 
         # Asset doesn't need to be found
         # raise ChainError('UTXO {} / {:,d} not found in "h" table'
@@ -1663,13 +1831,39 @@ class BlockProcessor:
 
         # This must be done to set state before the main loop
         if self.height == self.daemon.cached_height():
-            await self._on_caught_up()
+            await self.run_with_lock(self._on_caught_up())
 
         while True:
             await self.blocks_event.wait()
             self.blocks_event.clear()
             await self.run_with_lock(process_event())
 
+    async def _compact_history(self):
+        '''Compact the history DB in the background once caught up.
+
+        Each batch is done with the state lock held, between block
+        flushes, and when no history has been flushed since the UTXOs
+        were.  A new compaction starts HISTORY_COMPACTION_HOURS after
+        the last one completed.
+        '''
+        hours = self.env.history_compaction_hours
+        if not hours:
+            return
+        await self._caught_up_event.wait()
+
+        async def compact_batch():
+            await self.wait_for_flush()
+            if self.db.history.flush_count != self.db.utxo_flush_count:
+                return False
+            return await asyncio.get_event_loop().run_in_executor(
+                None, self.db.compact_history, self.COMPACTION_BATCH_SIZE)
+
+        while True:
+            await sleep(self.COMPACTION_PAUSE)
+            if await self.run_with_lock(compact_batch()):
+                self.logger.info('history compaction complete')
+                await sleep(hours * 3600)
+
     async def _on_caught_up(self):
         if not self._caught_up_event.is_set():
             self._caught_up_event.set()
@@ -1709,10 +1903,12 @@ class BlockProcessor:
 
         self._caught_up_event = caught_up_event
         await self._first_open_dbs()
+        self.deserializer.start()
         try:
             async with TaskGroup() as group:
                 await group.spawn(self.prefetcher.main_loop(self.height))
                 await group.spawn(self._process_blocks())
+                await group.spawn(self._compact_history())
 
                 async for task in group:
                     if not task.cancelled():
@@ -1727,6 +1923,8 @@ class BlockProcessor:
         except Exception:
             logging.exception('Critical Block Processor Error:')
             raise
+        finally:
+            self.deserializer.shutdown()
 
     def force_chain_reorg(self, count):
         '''Force a reorg of the given number of blocks.
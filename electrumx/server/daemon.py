@@ -38,7 +38,8 @@ class Daemon(object):
     WARMING_UP = -28
     id_counter = itertools.count()
 
-    def __init__(self, coin, url, *, max_workqueue=10, init_retry=0.25, max_retry=4.0):
+    def __init__(self, coin, url, *, max_workqueue=10, init_retry=0.25, max_retry=4.0,
+                 rest=False):
         self.coin = coin
         self.logger = class_logger(__name__, self.__class__.__name__)
         self.url_index = None
@@ -52,6 +53,10 @@ class Daemon(object):
         self._height = None
         self.available_rpcs = {}
         self.session = None
+        # If True raw blocks and transactions are fetched in binary over the
+        # daemon's REST interface where it is enabled; see _rest_available()
+        self.rest = rest
+        self.rest_urls = {}
 
     async def __aenter__(self):
         self.session = aiohttp.ClientSession(connector=self.connector())
@@ -95,9 +100,9 @@ class Daemon(object):
             return True
         return False
 
-    async def _send_data(self, data):
+    async def _send_data(self, data, url=None):
         async with self.workqueue_semaphore:
-            async with self.session.post(self.current_url(), data=data) as resp:
+            async with self.session.post(url or self.current_url(), data=data) as resp:
                 kind = resp.headers.get('Content-Type', None)
                 if kind == 'application/json':
                     return await resp.json()
@@ -105,20 +110,26 @@ class Daemon(object):
                 text = text.strip() or resp.reason
                 raise ServiceRefusedError(text)
 
-    async def _send(self, payload, processor):
+    async def _send(self, payload, processor, url=None):
         '''Send a payload to be converted to JSON.
 
         Handles temporary connection issues.  Daemon reponse errors
-        are raise through DaemonError.
+        are raise through DaemonError.  If url is given the payload is
+        sent to it rather than the current URL, until it fails
+        repeatedly.
         '''
         def log_error(error):
-            nonlocal last_error_log, retry
+            nonlocal last_error_log, retry, url
             now = time.monotonic()
             if now - last_error_log > 60:
                 last_error_log = now
                 self.logger.error(f'{error}.  Retrying occasionally...')
-            if retry == self.max_retry and self.failover():
-                retry = 0
+            if retry == self.max_retry:
+                if url:
+                    url = None
+                    retry = 0
+                elif self.failover():
+                    retry = 0
 
         on_good_message = None
         last_error_log = -1000   # Monotonic time starts at 0
@@ -126,7 +137,7 @@ class Daemon(object):
         retry = self.init_retry
         while True:
             try:
-                result = await self._send_data(data)
+                result = await self._send_data(data, url)
                 result = processor(result)
                 if on_good_message:
                     self.logger.info(on_good_message)
@@ -170,7 +181,7 @@ class Daemon(object):
             payload['params'] = params
         return await self._send(payload, processor)
 
-    async def _send_vector(self, method, params_iterable, replace_errs=False):
+    async def _send_vector(self, method, params_iterable, replace_errs=False, url=None):
         '''Send several requests of the same method.
 
         The result will be an array of the same length as params_iterable.
@@ -187,7 +198,7 @@ class Daemon(object):
         payload = [{'method': method, 'params': p, 'id': next(self.id_counter)}
                    for p in params_iterable]
         if payload:
-            return await self._send(payload, processor)
+            return await self._send(payload, processor, url)
         return []
 
     async def _is_rpc_available(self, method):
@@ -207,19 +218,67 @@ class Daemon(object):
             self.available_rpcs[method] = available
         return available
 
+    async def _rest_available(self, url):
+        '''Return whether the REST interface of the daemon at url is enabled.
+        The result is cached.'''
+        available = self.rest_urls.get(url)
+        if available is None:
+            try:
+                async with self.session.get(url + 'rest/chaininfo.json') as resp:
+                    available = resp.status == 200
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                return False
+            self.rest_urls[url] = available
+            status = 'enabled' if available else 'not enabled; using JSON RPC'
+            self.logger.info(f'REST interface of {self.logged_url(url)} {status}')
+        return available
+
+    async def _rest_binaries(self, kind, hex_hashes, url=None):
+        '''Return the binary REST resources of the given kind and hex hashes,
+        with None for those the daemon does not have.  Returns None if the
+        REST interface is not used or cannot be reached.'''
+        url = url or self.current_url()
+        if not self.rest or not await self._rest_available(url):
+            return None
+
+        async def get(hex_hash):
+            async with self.workqueue_semaphore:
+                async with self.session.get(f'{url}rest/{kind}/{hex_hash}.bin') as resp:
+                    if resp.status == 200:
+                        return await resp.read()
+                    return None
+
+        try:
+            return await asyncio.gather(*(get(hex_hash) for hex_hash in hex_hashes))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.logger.warning(f'REST request failed ({e}); using JSON RPC')
+            return None
+
     async def block_hex_hashes(self, first, count):
         '''Return the hex hashes of count block starting at height first.'''
         params_iterable = ((h, ) for h in range(first, first + count))
         return await self._send_vector('getblockhash', params_iterable)
 
+    async def block_headers(self, hex_hashes):
+        '''Return the raw binary headers of the blocks with the given hex hashes.'''
+        params_iterable = ((h, False) for h in hex_hashes)
+        headers = await self._send_vector('getblockheader', params_iterable)
+        # Convert hex string to bytes
+        return [hex_to_bytes(header) for header in headers]
+
     async def deserialised_block(self, hex_hash):
         '''Return the deserialised block with the given hex hash.'''
         return await self._send_single('getblock', (hex_hash, True))
 
-    async def raw_blocks(self, hex_hashes):
-        '''Return the raw binary blocks with the given hex hashes.'''
+    async def raw_blocks(self, hex_hashes, url=None):
+        '''Return the raw binary blocks with the given hex hashes.  If url is
+        given they are requested from that daemon URL.'''
+        blocks = await self._rest_binaries('block', hex_hashes, url)
+        if blocks is not None and all(blocks):
+            return blocks
+        # Missing blocks are left to JSON RPC to report
         params_iterable = ((h, False) for h in hex_hashes)
-        blocks = await self._send_vector('getblock', params_iterable)
+        blocks = await self._send_vector('getblock', params_iterable, url=url)
         # Convert hex string to bytes
         return [hex_to_bytes(block) for block in blocks]
 
@@ -241,11 +300,19 @@ class Daemon(object):
         '''Return the serialized raw transactions with the given hashes.
 
         Replaces errors with None by default.'''
-        params_iterable = ((hex_hash, 0) for hex_hash in hex_hashes)
-        txs = await self._send_vector('getrawtransaction', params_iterable,
-                                      replace_errs=replace_errs)
-        # Convert hex strings to bytes
-        return [hex_to_bytes(tx) if tx else None for tx in txs]
+        txs = await self._rest_binaries('tx', hex_hashes)
+        if txs is None:
+            txs = [None] * len(hex_hashes)
+        # Those not found over REST, e.g. without -txindex, are asked for over JSON RPC
+        missing = [n for n, tx in enumerate(txs) if tx is None]
+        if missing:
+            params_iterable = ((hex_hashes[n], 0) for n in missing)
+            hex_txs = await self._send_vector('getrawtransaction', params_iterable,
+                                              replace_errs=replace_errs)
+            # Convert hex strings to bytes
+            for n, hex_tx in zip(missing, hex_txs):
+                txs[n] = hex_to_bytes(hex_tx) if hex_tx else None
+        return txs
 
     async def broadcast_transaction(self, raw_tx):
         '''Broadcast a transaction to the network.'''
@@ -12,13 +12,20 @@
 import array
 import ast
 import os
+import struct
 import time
 from bisect import bisect_right
-from collections import namedtuple
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
 from glob import glob
 
 import attr
-from aiorpcx import run_in_thread, sleep
+from aiorpcx import run_in_thread
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from electrumx.lib import util
 from electrumx.lib.hash import hash_to_hex_str, HASHX_LEN
@@ -39,6 +46,7 @@ class FlushData(object):
     height = attr.ib()
     tx_count = attr.ib()
     headers = attr.ib()
+    block_hashes = attr.ib()
     block_tx_hashes = attr.ib()
     # The following are flushed to the UTXO DB if undo_infos is not None
     undo_infos = attr.ib()
@@ -76,6 +84,29 @@ class FlushData(object):
     asset_broadcasts_undo = attr.ib()
     asset_broadcasts_del = attr.ib()
 
+    # History taken with History.take_unflushed(), or None to flush all unflushed history
+    history = attr.ib(default=None)
+
+    def clear_utxos(self):
+        '''Clear the UTXO and asset data once committed.  The flush functions leave
+        them intact as a flush in a background thread is read from meanwhile.'''
+        for field in attr.fields(FlushData):
+            value = getattr(self, field.name)
+            if field.name != 'history' and hasattr(value, 'clear'):
+                value.clear()
+
+
+@attr.s(slots=True)
+class ReadView(object):
+    '''Snapshots of the DBs taken together after a UTXO flush, for queries.
+    None of them holds data above height.'''
+    height = attr.ib()
+    # The DB's backup count when taken.  A reorg since makes the view stale.
+    generation = attr.ib()
+    utxo_db = attr.ib()
+    asset_db = attr.ib()
+    history_db = attr.ib()
+
 
 class DB(object):
     '''Simple wrapper of the backend database for querying.
@@ -85,6 +116,11 @@ class DB(object):
     '''
 
     DB_VERSIONS = [6, 7, 8]
+    ASSET_FILTER_FILE = 'meta/assetfilter'
+    ASSET_FILTER_MIN_CAPACITY = 1 << 20
+    # fs_tx_hashes() reads the hashes of tx numbers at most this far
+    # apart with a single read
+    TX_HASHES_READ_GAP = 256
 
     class DBError(Exception):
         '''Raised on general DB errors generally indicating corruption.'''
@@ -101,7 +137,10 @@ class DB(object):
         os.chdir(env.db_dir)
 
         self.db_class = db_class(self.env.db_engine)
+        self.db_class.configure(env)
         self.history = History()
+        # Commits the history, asset and asset info DBs of a flush in parallel
+        self.flush_executor = ThreadPoolExecutor(max_workers=3)
         self.utxo_db = None
         self.utxo_flush_count = 0
         self.fs_height = -1
@@ -112,7 +151,14 @@ class DB(object):
         self.db_asset_count = 0
         self.db_tip = None
         self.tx_counts = None
+        # A (backup count, numpy array, length) copy of the flushed tx_counts
+        self.tx_counts_array = None
+        self.backup_count = 0
+        # The ReadView queries read through
+        self.read_view = None
         self.last_flush = time.time()
+        # The time of the last UTXO flush, a durable checkpoint when syncing
+        self.last_checkpoint = self.last_flush
         self.last_flush_tx_count = 0
         self.last_flush_asset_count = 0
         self.wall_time = 0
@@ -121,6 +167,18 @@ class DB(object):
 
         self.asset_db = None
         self.asset_info_db = None
+        # Counts commits of UTXO data to the asset DB.  Identifies the
+        # asset outpoint filter snapshot matching the DB.
+        self.asset_flush_count = 0
+
+        # A Bloom filter of the outpoints in the asset DB, keyed by
+        # compressed tx hash + tx_idx like the 'h' table.  Spent
+        # outpoints cannot be removed so they are counted as stale.
+        self.asset_filter = None
+        self.asset_filter_stale = 0
+        self.asset_filter_probes = 0
+        self.asset_filter_passes = 0
+        self.asset_filter_false_positives = 0
 
         self.logger.info(f'using {self.env.db_engine} for DB backend')
 
@@ -128,9 +186,10 @@ class DB(object):
         self.merkle = Merkle()
         self.header_mc = MerkleCache(self.merkle, self.fs_block_hashes)
 
-        self.headers_file = util.LogicalFile('meta/headers', 2, 16000000)
-        self.tx_counts_file = util.LogicalFile('meta/txcounts', 2, 2000000)
-        self.hashes_file = util.LogicalFile('meta/hashes', 4, 16000000)
+        self.headers_file = util.MappedLogicalFile('meta/headers', 2, 16000000)
+        self.tx_counts_file = util.MappedLogicalFile('meta/txcounts', 2, 2000000)
+        self.hashes_file = util.MappedLogicalFile('meta/hashes', 4, 16000000)
+        self.block_hashes_file = util.MappedLogicalFile('meta/blockhashes', 2, 16000000)
 
     async def _read_tx_counts(self):
         if self.tx_counts is not None:
@@ -146,7 +205,7 @@ class DB(object):
         else:
             assert self.db_tx_count == 0
 
-    async def _open_dbs(self, for_sync, compacting):
+    async def _open_dbs(self, for_sync):
         assert self.utxo_db is None
         assert self.asset_db is None
         assert self.asset_info_db is None
@@ -167,19 +226,64 @@ class DB(object):
         # Asset DB
         self.asset_db = self.db_class('asset', for_sync)
         self.read_asset_state()
+        self.open_asset_filter()
         self.asset_info_db = self.db_class('asset_info', for_sync)
 
-        # Then history DB
-        self.utxo_flush_count = self.history.open_db(self.db_class, for_sync,
-                                                     self.utxo_flush_count,
-                                                     compacting)
+        # Then history DB.  Its flush count is lower if a compaction completed but
+        # the UTXO DB was not updated
+        flush_count = self.history.open_db(self.db_class, for_sync, self.utxo_flush_count)
+        if flush_count < self.utxo_flush_count:
+            self.set_flush_count(flush_count)
+        self.utxo_flush_count = flush_count
         self.clear_excess_undo_info()
 
         # Read TX counts (requires meta directory)
         await self._read_tx_counts()
+        self._backfill_block_hashes()
+        self.refresh_read_view()
+
+    def _backfill_block_hashes(self):
+        '''Hash the headers on disk missing from the block hashes file.
+
+        Only DBs created before block hashes were stored need this, and
+        only once.
+        '''
+        count = self.db_height + 1
+        # The file is written in height order, so the hashes present are a
+        # prefix of the chain
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if len(self.block_hashes_file.read(mid * 32, 32)) == 32:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == count:
+            return
+
+        self.logger.info(f'hashing {count - lo:,d} headers to store their block hashes; '
+                         f'this is only done once...')
+        last = time.monotonic()
+        for start in range(lo, count, 10000):
+            n = min(10000, count - start)
+            offset = self.header_offset(start)
+            headers_concat = self.headers_file.read(offset, self.header_offset(start + n) - offset)
+            hashes = []
+            offset = 0
+            for height in range(start, start + n):
+                hlen = self.header_len(height)
+                hashes.append(self.coin.header_hash(headers_concat[offset:offset + hlen]))
+                offset += hlen
+            self.block_hashes_file.write(start * 32, b''.join(hashes))
+            now = time.monotonic()
+            if now > last + 10:
+                last = now
+                self.logger.info(f'block hashes stored to height {start + n - 1:,d}, '
+                                 f'{(start + n - lo) * 100 / (count - lo):.1f}% complete')
+        self.logger.info('block hashes stored')
 
     async def open_for_compacting(self):
-        await self._open_dbs(True, True)
+        await self._open_dbs(True)
 
     async def open_for_sync(self):
         '''Open the databases to sync to the daemon.
@@ -188,14 +292,25 @@ class DB(object):
         synchronization.  When serving clients we want the open files for
         serving network connections.
         '''
-        await self._open_dbs(True, False)
+        await self._open_dbs(True)
 
     async def open_for_serving(self):
         '''Open the databases for serving.  If they are already open they are
-        closed first.
+        switched to serving in place, keeping their caches warm, unless
+        the open file limit cannot allow for the files they may keep
+        open; then they are closed and reopened.
         '''
         if self.utxo_db:
+            dbs = (self.utxo_db, self.asset_db, self.asset_info_db, self.history.db)
+            # Allow ElectrumX 100 files for itself as in Env.sane_max_sessions()
+            file_count = sum(db.max_open_files for db in dbs) + self.env.max_sessions + 100
+            if self._allow_open_files(file_count):
+                for db in dbs:
+                    db.set_for_sync(False)
+                self.logger.info('switched DBs to serving')
+                return
             self.logger.info('closing DBs to re-open for serving')
+            self.read_view = None
             self.utxo_db.close()
             self.asset_db.close()
             self.asset_info_db.close()
@@ -203,7 +318,27 @@ class DB(object):
             self.utxo_db = None
             self.asset_db = None
             self.asset_info_db = None
-        await self._open_dbs(False, False)
+        await self._open_dbs(False)
+
+    def _allow_open_files(self, count):
+        '''Return True if the process can have count files open, raising its
+        soft limit if need be.'''
+        # No resource module on Windows
+        try:
+            import resource
+        except ImportError:
+            return False
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft == resource.RLIM_INFINITY or soft >= count:
+            return True
+        if hard != resource.RLIM_INFINITY and hard < count:
+            return False
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (count, hard))
+        except (ValueError, OSError):
+            return False
+        self.logger.info(f'raised open file limit from {soft:,d} to {count:,d}')
+        return True
 
     # Header merkle cache
     async def populate_header_merkle_cache(self):
@@ -225,6 +360,7 @@ class DB(object):
         assert flush_data.height == self.fs_height == self.db_height
         assert flush_data.tip == self.db_tip
         assert not flush_data.headers
+        assert not flush_data.block_hashes
         assert not flush_data.block_tx_hashes
         assert not flush_data.adds
         assert not flush_data.deletes
@@ -271,31 +407,48 @@ class DB(object):
         prior_flush = self.last_flush
         tx_delta = flush_data.tx_count - self.last_flush_tx_count
         asset_delta = flush_data.asset_count - self.last_flush_asset_count
+        # History flushed after the last UTXO flush is discarded after a crash (see
+        # History.clear_excess()), so when syncing only UTXO flushes need be durable.
+        # They are the checkpoints recovery rolls back to.
+        sync = flush_utxos or not self.utxo_db.for_sync
+        # Undo information leaving the reorg window is deleted with the UTXO flush
+        stale_heights = self.stale_undo_heights(flush_data.height) if flush_utxos else ()
 
         # Flush to file system
         self.flush_fs(flush_data)
 
-        # Then history
-        self.flush_history()
-
-        with self.asset_db.write_batch() as batch:
-            if flush_utxos:
-                self.flush_asset_db(batch, flush_data)
-            self.flush_asset_state(batch)
-
-        with self.asset_info_db.write_batch() as batch:
+        # Then history, assets and asset info, each DB in its own thread.  The UTXO
+        # batch is built meanwhile but only committed after them all, so the UTXO
+        # state is still the last thing written
+        futures = [
+            self.flush_executor.submit(self._timed_flush, self.flush_history,
+                                       flush_data.history, sync),
+            self.flush_executor.submit(self._timed_flush, self.commit_asset_db,
+                                       flush_data, flush_utxos, sync, stale_heights),
+            self.flush_executor.submit(self._timed_flush, self.commit_asset_info_db,
+                                       flush_data, flush_utxos, stale_heights),
+        ]
+
+        utxo_start = time.monotonic()
+        with self.utxo_db.write_batch(sync=sync) as batch:
             if flush_utxos:
-                self.flush_asset_info_db(batch, flush_data)
-
-        # Flush state last as it reads the wall time.
-        with self.utxo_db.write_batch() as batch:
+                self.flush_utxo_db(batch, flush_data, stale_heights)
+            wait_start = time.monotonic()
+            wait(futures)
+            timings = [future.result() for future in futures]
+            utxo_wait = time.monotonic() - wait_start
             if flush_utxos:
-                self.flush_utxo_db(batch, flush_data)
+                self.utxo_flush_count = self.history.flush_count
+                self.last_checkpoint = time.time()
+            # Flush state last as it reads the wall time.
             self.flush_state(batch)
+        utxo_elapsed = time.monotonic() - utxo_start - utxo_wait
 
         # Update and put the wall time again - otherwise we drop the
         # time it took to commit the batch
         self.flush_state(self.utxo_db)
+        if flush_utxos:
+            self.refresh_read_view()
 
         elapsed = self.last_flush - start_time
         self.logger.info(f'flush #{self.history.flush_count:,d} took '
@@ -313,9 +466,57 @@ class DB(object):
                              f'since last flush: {tx_per_sec_last:,d}')
             self.logger.info(f'sync time: {formatted_time(self.wall_time)}  '
                              f'ETA: {formatted_time(eta)}')
+            history_elapsed, asset_elapsed, asset_info_elapsed = timings
+            self.logger.info(f'DB flush times: history {history_elapsed:.2f}s, '
+                             f'assets {asset_elapsed:.2f}s, '
+                             f'asset info {asset_info_elapsed:.2f}s, '
+                             f'UTXOs {utxo_elapsed:.2f}s (after waiting {utxo_wait:.2f}s)')
+
+    def refresh_read_view(self):
+        '''Take the view of the DBs that queries read through.  Called when
+        they are all flushed to the same height.'''
+        self.read_view = ReadView(self.db_height, self.backup_count, self.utxo_db.snapshot(),
+                                  self.asset_db.snapshot(), self.history.db.snapshot())
+
+    def _view_is_current(self, view):
+        '''Return True if no reorg has begun since view was taken.  A reorg
+        pops tx_counts before the backup count is incremented.'''
+        return view.generation == self.backup_count and len(self.tx_counts) > view.height
+
+    async def run_with_view(self, func, *args):
+        '''Run func(view, *args) in a thread with the current read view and
+        return its result.
+
+        The view's snapshots and the tx hashes of its tx numbers are
+        consistent unless a reorg begins meanwhile.  Then func is run
+        again on the view taken after the reorg; flushes need no retry.
+        '''
+        while True:
+            view = self.read_view
+            result = await run_in_thread(func, view, *args)
+            if self._view_is_current(view):
+                return result
+
+    def checkpoint_due(self):
+        '''Return True if the UTXOs should be flushed when syncing to bound the
+        work lost to a crash, as history flushed since they were is not durable.'''
+        env = self.env
+        return bool(
+            (env.checkpoint_flushes
+             and self.history.flush_count - self.utxo_flush_count >= env.checkpoint_flushes)
+            or (env.checkpoint_secs
+                and time.time() - self.last_checkpoint >= env.checkpoint_secs))
+
+    @staticmethod
+    def _timed_flush(func, *args):
+        '''Call func and return the time it took.'''
+        start_time = time.monotonic()
+        func(*args)
+        return time.monotonic() - start_time
 
     def flush_fs(self, flush_data):
-        '''Write headers, tx counts and block tx hashes to the filesystem.
+        '''Write headers, block hashes, tx counts and block tx hashes to the
+        filesystem.
 
         The first height to write is self.fs_height + 1.  The FS
         metadata is all append-only, so in a crash we just pick up
@@ -324,25 +525,29 @@ class DB(object):
         prior_tx_count = (self.tx_counts[self.fs_height]
                           if self.fs_height >= 0 else 0)
         assert len(flush_data.block_tx_hashes) == len(flush_data.headers)
+        assert len(flush_data.block_hashes) == len(flush_data.headers)
         assert flush_data.height == self.fs_height + len(flush_data.headers)
-        assert flush_data.tx_count == (self.tx_counts[-1] if self.tx_counts
-                                       else 0)
-        assert len(self.tx_counts) == flush_data.height + 1
+        # Blocks processed since the flush began may follow in tx_counts
+        assert flush_data.tx_count == (self.tx_counts[flush_data.height]
+                                       if flush_data.height >= 0 else 0)
+        assert len(self.tx_counts) >= flush_data.height + 1
         hashes = b''.join(flush_data.block_tx_hashes)
         flush_data.block_tx_hashes.clear()
         assert len(hashes) % 32 == 0
         assert len(hashes) // 32 == flush_data.tx_count - prior_tx_count
 
-        # Write the headers, tx counts, and tx hashes
+        # Write the headers, block hashes, tx counts, and tx hashes
         start_time = time.monotonic()
         height_start = self.fs_height + 1
         offset = self.header_offset(height_start)
         self.headers_file.write(offset, b''.join(flush_data.headers))
         flush_data.headers.clear()
+        self.block_hashes_file.write(height_start * 32, b''.join(flush_data.block_hashes))
+        flush_data.block_hashes.clear()
 
         offset = height_start * self.tx_counts.itemsize
         self.tx_counts_file.write(offset,
-                                  self.tx_counts[height_start:].tobytes())
+                                  self.tx_counts[height_start:flush_data.height + 1].tobytes())
         offset = prior_tx_count * 32
         self.hashes_file.write(offset, hashes)
 
@@ -354,10 +559,38 @@ class DB(object):
             elapsed = time.monotonic() - start_time
             self.logger.info(f'flushed filesystem data in {elapsed:.2f}s')
 
-    def flush_history(self):
-        self.history.flush()
+    def flush_history(self, unflushed=None, sync=True):
+        self.history.flush(unflushed, sync, self.utxo_flush_count)
+
+    def compact_history(self, limit):
+        '''Compact the history of about limit bytes, starting a compaction if
+        none is in progress.  Return True if the compaction is complete.
+
+        No history must have been flushed since the UTXOs were.'''
+        history = self.history
+        assert history.flush_count == self.utxo_flush_count
+        history.start_compaction()
+        history._compact_history(limit)
+        if history.flush_count < self.utxo_flush_count:
+            self.set_flush_count(history.flush_count)
+        return history.comp_cursor == -1
+
+    def commit_asset_db(self, flush_data, flush_utxos, sync=True, stale_heights=()):
+        '''Commit the asset DB part of a flush.'''
+        with self.asset_db.write_batch(sync=sync) as batch:
+            if flush_utxos:
+                self.flush_asset_db(batch, flush_data, stale_heights)
+            self.flush_asset_state(batch)
+        if flush_utxos:
+            self.write_asset_filter()
+
+    def commit_asset_info_db(self, flush_data, flush_utxos, stale_heights=()):
+        '''Commit the asset info DB part of a flush.'''
+        if flush_utxos:
+            with self.asset_info_db.write_batch() as batch:
+                self.flush_asset_info_db(batch, flush_data, stale_heights)
 
-    def flush_asset_info_db(self, batch, flush_data: FlushData):
+    def flush_asset_info_db(self, batch, flush_data: FlushData, stale_heights=()):
         start_time = time.monotonic()
         adds = len(flush_data.asset_meta_adds)
         reissues = len(flush_data.asset_meta_reissues)
@@ -365,19 +598,16 @@ class DB(object):
         batch_delete = batch.delete
         for key in flush_data.asset_meta_deletes:
             batch_delete(key)
-        flush_data.asset_meta_deletes.clear()
+        self.delete_undo_infos(batch_delete, (self.undo_key, ), stale_heights)
 
         batch_put = batch.put
         for key, value in flush_data.asset_meta_reissues.items():
             batch_put(key, value)
-        flush_data.asset_meta_reissues.clear()
 
         for key, value in flush_data.asset_meta_adds.items():
             batch_put(key, value)
-        flush_data.asset_meta_adds.clear()
 
         self.flush_asset_meta_undos(batch_put, flush_data.asset_meta_undos)
-        flush_data.asset_meta_undos.clear()
 
         if self.asset_info_db.for_sync:
             elapsed = time.monotonic() - start_time
@@ -385,7 +615,7 @@ class DB(object):
                              f'{reissues:,d} assets\' metadata reissued, '
                              f'{elapsed:.1f}s, committing...')
 
-    def flush_asset_db(self, batch, flush_data: FlushData):
+    def flush_asset_db(self, batch, flush_data: FlushData, stale_heights=()):
         start_time = time.monotonic()
         add_count = len(flush_data.asset_adds)
         spend_count = len(flush_data.asset_deletes) // 2
@@ -400,27 +630,28 @@ class DB(object):
         batch_delete = batch.delete
         for key in sorted(flush_data.asset_deletes):
             batch_delete(key)
-        flush_data.asset_deletes.clear()
+        self.asset_filter_stale += spend_count
 
         # Qualifiers
         for key in sorted(flush_data.asset_restricted_freezes_del):
             batch_delete(key)
-        flush_data.asset_restricted_freezes_del.clear()
 
         for key in sorted(flush_data.asset_restricted2qual_del):
             batch_delete(key)
-        flush_data.asset_restricted2qual_del.clear()
 
         for key in sorted(flush_data.asset_tag2pub_del):
             batch_delete(key)
-        flush_data.asset_tag2pub_del.clear()
 
         for key in sorted(flush_data.asset_broadcasts_del):
             batch_delete(b'b' + key)
-        flush_data.asset_broadcasts_del.clear()
+
+        self.delete_undo_infos(batch_delete, (self.undo_key, self.undo_tag_key,
+                                              self.undo_freeze_key, self.undo_res2qual_key,
+                                              self.undo_key_broadcast), stale_heights)
 
         # New Assets
         batch_put = batch.put
+        filter_add = self.asset_filter.add
         for key, value in flush_data.asset_adds.items():
             # suffix = tx_idx + tx_num
             # key tx_hash (32), tx_idx (4)
@@ -429,11 +660,11 @@ class DB(object):
             suffix = key[-4:] + value[HASHX_LEN:5+HASHX_LEN]
             batch_put(b'h' + key[:4] + suffix, hashX)
             batch_put(b'u' + hashX + suffix, value[5+HASHX_LEN:])
-        flush_data.asset_adds.clear()
+            filter_add(key[:4] + key[-4:])
+        self.asset_flush_count += 1
 
         # New undo information
         self.flush_undo_infos(batch_put, flush_data.asset_undo_infos)
-        flush_data.asset_undo_infos.clear()
 
         # FIXME: For current values, maybe have them in the db if they are true
         # or omit them if they are false. For now, there are not enough qualifiers
@@ -449,29 +680,23 @@ class DB(object):
             tx_numb = key_parser.read_bytes(5)
             batch_put(b'p' + h160_len + h160 + idx + tx_numb, asset_len + asset + value)
             batch_put(b'a' + asset_len + asset + idx + tx_numb, h160_len + h160 + value)
-        flush_data.asset_tag2pub.clear()
 
         self.flush_t2p_undo_infos(batch_put, flush_data.asset_tag2pub_undo)
-        flush_data.asset_tag2pub_undo.clear()
 
         for key, value in flush_data.asset_tag2pub_current.items():
             # b't' h160 -> asset
             # b'Q' asset -> h160
             batch_put(key, value)
-        flush_data.asset_tag2pub_current.clear()
 
         for key, value in flush_data.asset_restricted_freezes.items():
             # b'f'
             batch_put(b'f' + key, value)
-        flush_data.asset_restricted_freezes.clear()
 
         self.flush_freezes_undo_info(batch_put, flush_data.asset_restricted_freezes_undo)
-        flush_data.asset_restricted_freezes_undo.clear()
 
         for key, value in flush_data.asset_restricted_freezes_current.items():
             #b'l'
             batch_put(b'l' + key, value)
-        flush_data.asset_restricted_freezes_current.clear()
 
         for key, value in flush_data.asset_restricted2qual.items():
             #b'1' res
@@ -498,23 +723,17 @@ class DB(object):
                     b'\0' + restricted_len + restricted_asset
                 )
 
-        flush_data.asset_restricted2qual.clear()
-
         self.flush_restricted2qual_undo_info(batch_put, flush_data.asset_restricted2qual_undo)
-        flush_data.asset_restricted2qual_undo.clear()
 
         for key, value in flush_data.asset_current_associations.items():
             # b'r' res
             # b'c' qual
             batch_put(key, value)
-        flush_data.asset_current_associations.clear()
 
         for key, value in flush_data.asset_broadcasts.items():
             batch_put(b'b' + key, value)
-        flush_data.asset_broadcasts.clear()
 
         self.flush_asset_broadcast_undos(batch_put, flush_data.asset_broadcasts_undo)
-        flush_data.asset_broadcasts_undo.clear()
 
         if self.asset_db.for_sync:
             elapsed = time.monotonic() - start_time
@@ -528,8 +747,9 @@ class DB(object):
 
         self.db_asset_count = flush_data.asset_count
 
-    def flush_utxo_db(self, batch, flush_data):
-        '''Flush the cached DB writes and UTXO set to the batch.'''
+    def flush_utxo_db(self, batch, flush_data, stale_heights=()):
+        '''Flush the cached DB writes and UTXO set to the batch, deleting the
+        undo information at stale_heights.'''
         # Care is needed because the writes generated by flushing the
         # UTXO state may have keys in common with our write cache or
         # may be in the DB already.
@@ -541,7 +761,7 @@ class DB(object):
         batch_delete = batch.delete
         for key in sorted(flush_data.deletes):
             batch_delete(key)
-        flush_data.deletes.clear()
+        self.delete_undo_infos(batch_delete, (self.undo_key, ), stale_heights)
 
         # New UTXOs
         batch_put = batch.put
@@ -551,11 +771,9 @@ class DB(object):
             suffix = key[-4:] + value[-13:-8]
             batch_put(b'h' + key[:4] + suffix, hashX)
             batch_put(b'u' + hashX + suffix, value[-8:])
-        flush_data.adds.clear()
 
         # New undo information
         self.flush_undo_infos(batch_put, flush_data.undo_infos)
-        flush_data.undo_infos.clear()
 
         if self.utxo_db.for_sync:
             block_count = flush_data.height - self.db_height
@@ -566,7 +784,6 @@ class DB(object):
                              f'{spend_count:,d} spends in '
                              f'{elapsed:.1f}s, committing...')
 
-        self.utxo_flush_count = self.history.flush_count
         self.db_height = flush_data.height
         self.db_tx_count = flush_data.tx_count
         self.db_tip = flush_data.tip
@@ -586,6 +803,7 @@ class DB(object):
     def flush_backup(self, flush_data, touched):
         '''Like flush_dbs() but when backing up.  All UTXOs are flushed.'''
         assert not flush_data.headers
+        assert not flush_data.block_hashes
         assert not flush_data.block_tx_hashes
         assert flush_data.height < self.db_height
         self.history.assert_flushed()
@@ -598,15 +816,19 @@ class DB(object):
         self.history.backup(touched, flush_data.tx_count)
         with self.utxo_db.write_batch() as batch:
             self.flush_utxo_db(batch, flush_data)
+            self.utxo_flush_count = self.history.flush_count
             # Flush state last as it reads the wall time.
             self.flush_state(batch)
 
         with self.asset_db.write_batch() as batch:
             self.flush_asset_db(batch, flush_data)
             self.flush_asset_state(batch)
+        self.write_asset_filter()
 
         with self.asset_info_db.write_batch() as batch:
             self.flush_asset_info_db(batch, flush_data)
+        flush_data.clear_utxos()
+        self.refresh_read_view()
 
         elapsed = self.last_flush - start_time
         self.logger.info(f'backup flush #{self.history.flush_count:,d} took '
@@ -619,6 +841,7 @@ class DB(object):
         self.fs_height = height
         self.fs_tx_count = tx_count
         self.fs_asset_count = asset_count
+        self.backup_count += 1
         # Truncate header_mc: header count is 1 more than the height.
         self.header_mc.truncate(height + 1)
 
@@ -663,12 +886,93 @@ class DB(object):
             tx_hash = self.hashes_file.read(tx_num * 32, 32)
         return tx_hash, tx_height
 
-    def fs_tx_hashes_at_blockheight(self, block_height):
+    def _tx_counts_array(self):
+        '''Return a numpy copy of the flushed tx_counts.
+
+        The copy is extended with the heights flushed since it was last
+        used, and only rebuilt after a reorg.  It has spare capacity so
+        new blocks rarely cause a reallocation.'''
+        backup_count = self.backup_count
+        length = self.db_height + 1
+        cached = self.tx_counts_array
+        if cached is None or cached[0] != backup_count:
+            counts, filled = numpy.empty(0, dtype=numpy.uint64), 0
+        else:
+            _, counts, filled = cached
+        if filled < length:
+            if len(counts) < length:
+                grown = numpy.empty(length + length // 8 + 1024, dtype=numpy.uint64)
+                grown[:filled] = counts[:filled]
+                counts = grown
+            # Copy as a view would stop tx_counts being resized
+            counts[filled:length] = self.tx_counts[filled:length]
+            self.tx_counts_array = (backup_count, counts, length)
+        return counts[:length]
+
+    def _tx_heights(self, tx_nums):
+        '''Return the heights of tx_nums, which must be sorted.'''
+        tx_counts = self.tx_counts
+        if numpy is not None and len(tx_nums) > 16:
+            counts = self._tx_counts_array()
+            heights = numpy.searchsorted(counts, numpy.array(tx_nums, dtype=numpy.uint64),
+                                         side='right').tolist()
+            # Unflushed tx numbers are placed past the copy; find their height
+            flushed = len(counts)
+            return [height if height < flushed else bisect_right(tx_counts, tx_num, flushed)
+                    for tx_num, height in zip(tx_nums, heights)]
+
+        # Without numpy this is no faster than fs_tx_hash(); only the
+        # coalesced reads of fs_tx_hashes() help.  Walking forward from
+        # the previous height measured no better than bisecting.
+        return [bisect_right(tx_counts, tx_num) for tx_num in tx_nums]
+
+    def fs_tx_hashes(self, tx_nums):
+        '''Return a list of (tx_hash, tx_height) pairs, one for each tx
+        number in tx_nums and in the same order.
+
+        As for fs_tx_hash(), tx_hash is None if tx_height is not on
+        disk.  The heights are found with one sorted search and the
+        hashes of nearby tx numbers are fetched with a single read.'''
+        if not tx_nums:
+            return []
+        sorted_nums = sorted(set(tx_nums))
+        heights = self._tx_heights(sorted_nums)
+        # Heights ascend so the tx numbers on disk are a prefix
+        count = bisect_right(heights, self.db_height)
+
+        tx_hashes = []
+        append = tx_hashes.append
+        read = self.hashes_file.read
+        gap = self.TX_HASHES_READ_GAP
+        data_first = data_end = 0
+        for n, tx_num in enumerate(sorted_nums[:count]):
+            if tx_num >= data_end:
+                # Read through the tx numbers that follow within the gap
+                last = tx_num
+                end = n + 1
+                while end < count and sorted_nums[end] - last <= gap:
+                    last = sorted_nums[end]
+                    end += 1
+                data_first, data_end = tx_num, last + 1
+                data = read(tx_num * 32, (data_end - tx_num) * 32)
+            offset = (tx_num - data_first) * 32
+            append(data[offset:offset + 32])
+        tx_hashes.extend([None] * (len(sorted_nums) - count))
+
+        pairs = list(zip(tx_hashes, heights))
+        if sorted_nums == tx_nums:
+            return pairs
+        pairs = dict(zip(sorted_nums, pairs))
+        return [pairs[tx_num] for tx_num in tx_nums]
+
+    def fs_tx_hashes_at_blockheight(self, block_height, view=None):
         '''Return a list of tx_hashes at given block height,
-        in the same order as in the block.
+        in the same order as in the block.  If view is given, blocks above
+        its height are not on disk.
         '''
-        if block_height > self.db_height:
-            raise self.DBError(f'block {block_height:,d} not on disk (>{self.db_height:,d})')
+        db_height = self.db_height if view is None else view.height
+        if block_height > db_height:
+            raise self.DBError(f'block {block_height:,d} not on disk (>{db_height:,d})')
         assert block_height >= 0
         if block_height > 0:
             first_tx_num = self.tx_counts[block_height - 1]
@@ -680,21 +984,25 @@ class DB(object):
         return [tx_hashes[idx * 32: (idx+1) * 32] for idx in range(num_txs_in_block)]
 
     async def tx_hashes_at_blockheight(self, block_height):
-        return await run_in_thread(self.fs_tx_hashes_at_blockheight, block_height)
+        def read_tx_hashes(view):
+            return self.fs_tx_hashes_at_blockheight(block_height, view)
+        return await self.run_with_view(read_tx_hashes)
 
     async def fs_block_hashes(self, height, count):
-        headers_concat, headers_count = await self.read_headers(height, count)
-        if headers_count != count:
-            raise self.DBError('only got {:,d} headers starting at {:,d}, not '
-                               '{:,d}'.format(headers_count, height, count))
-        offset = 0
-        headers = []
-        for n in range(count):
-            hlen = self.header_len(height + n)
-            headers.append(headers_concat[offset:offset + hlen])
-            offset += hlen
-
-        return [self.coin.header_hash(header) for header in headers]
+        '''Return the block hashes of count blocks starting at height.
+
+        They are read from the block hashes file as hashing headers is
+        expensive.'''
+        def read_block_hashes():
+            disk_count = max(0, min(count, self.db_height + 1 - height))
+            if height < 0 or disk_count != count:
+                raise self.DBError('only got {:,d} headers starting at {:,d}, not '
+                                   '{:,d}'.format(disk_count, height, count))
+            hashes = self.block_hashes_file.read(height * 32, count * 32)
+            assert len(hashes) == count * 32
+            return [hashes[n:n + 32] for n in range(0, len(hashes), 32)]
+
+        return await run_in_thread(read_block_hashes)
 
     async def limited_history(self, hashX, *, limit=1000):
         '''Return an unpruned, sorted list of (tx_hash, height) tuples of
@@ -703,17 +1011,11 @@ class DB(object):
         transactions.  By default returns at most 1000 entries.  Set
         limit to None to get them all.
         '''
-        def read_history():
-            tx_nums = list(self.history.get_txnums(hashX, limit))
-            fs_tx_hash = self.fs_tx_hash
-            return [fs_tx_hash(tx_num) for tx_num in tx_nums]
+        def read_history(view):
+            tx_nums = list(self.history.get_txnums(hashX, limit, view.history_db))
+            return self.fs_tx_hashes(tx_nums)
 
-        while True:
-            history = await run_in_thread(read_history)
-            if all(hash is not None for hash, height in history):
-                return history
-            self.logger.warning('limited_history: tx hash not found (reorg?), retrying...')
-            await sleep(0.25)
+        return await self.run_with_view(read_history)
 
     # -- Undo information
 
@@ -721,6 +1023,19 @@ class DB(object):
         '''Returns a height from which we should store undo info.'''
         return max_height - self.env.reorg_limit + 1
 
+    def stale_undo_heights(self, height):
+        '''Return the heights whose undo information, kept at the DB height,
+        is no longer needed once the DB is flushed to height.'''
+        return range(max(self.min_undo_height(self.db_height), 0),
+                     min(self.db_height + 1, self.min_undo_height(height)))
+
+    @staticmethod
+    def delete_undo_infos(batch_delete, key_funcs, heights):
+        '''Delete the undo information at heights under the keys of key_funcs.'''
+        for height in heights:
+            for key_func in key_funcs:
+                batch_delete(key_func(height))
+
     def undo_key_broadcast(self, height):
         return b'B' + pack_be_uint32(height)
 
@@ -813,7 +1128,11 @@ class DB(object):
             pass
 
     def clear_excess_undo_info(self):
-        '''Clear excess undo info.  Only most recent N are kept.'''
+        '''Clear excess undo info.  Only most recent N are kept.
+
+        Flushes delete undo information as it becomes stale, so this
+        only finds what a lower reorg limit, or older software, left.
+        Keys are in height order, so only the excess is read.'''
         prefix = b'U'
         min_height = self.min_undo_height(self.db_height)
         keys = []
@@ -902,10 +1221,80 @@ class DB(object):
             if not isinstance(state, dict):
                 raise self.DBError('failed reading state from asset DB')
             self.db_asset_count = state['asset_count']
+            self.asset_flush_count = state.get('asset_flush_count', 0)
 
         self.fs_asset_count = self.db_asset_count
         self.last_flush_asset_count = self.fs_asset_count
 
+    # -- Asset outpoint filter
+
+    def open_asset_filter(self):
+        '''Load the asset outpoint filter snapshot if it matches the asset
+        DB, otherwise build the filter from the DB.'''
+        try:
+            with util.open_file(self.ASSET_FILTER_FILE) as f:
+                header_len, = unpack_le_uint32(f.read(4))
+                header = ast.literal_eval(f.read(header_len).decode())
+                bits = bytearray(f.read())
+        except (FileNotFoundError, ValueError, SyntaxError, struct.error):
+            header = None
+        if (isinstance(header, dict)
+                and header.get('asset_flush_count') == self.asset_flush_count
+                and (header['capacity'] * util.BloomFilter.BITS_PER_ITEM + 7) // 8 == len(bits)):
+            self.asset_filter = util.BloomFilter(header['capacity'], bits, header['count'])
+            self.asset_filter_stale = header['stale']
+            self.logger.info(f'loaded asset outpoint filter of {header["count"]:,d} entries')
+        else:
+            self.build_asset_filter()
+
+    def build_asset_filter(self):
+        '''Build the asset outpoint filter from the 'h' keys of the asset DB.'''
+        start = time.monotonic()
+        # Key: b'h' + compressed_tx_hash + tx_idx + tx_num
+        items = [db_key[1:9] for db_key, _hashX in self.asset_db.iterator(prefix=b'h')]
+        self.asset_filter = util.BloomFilter(max(len(items) * 2, self.ASSET_FILTER_MIN_CAPACITY))
+        filter_add = self.asset_filter.add
+        for item in items:
+            filter_add(item)
+        self.asset_filter_stale = 0
+        self.logger.info(f'built asset outpoint filter of {len(items):,d} entries in '
+                         f'{time.monotonic() - start:.1f}s')
+        self.write_asset_filter()
+
+    def write_asset_filter(self):
+        '''Write a snapshot of the asset outpoint filter after the asset DB
+        is committed.  The filter is rebuilt first if it is too full.'''
+        asset_filter = self.asset_filter
+        if (asset_filter.count > asset_filter.capacity
+                or self.asset_filter_stale > asset_filter.count // 2 > 0):
+            self.build_asset_filter()
+            return
+        header = repr({
+            'asset_flush_count': self.asset_flush_count,
+            'capacity': asset_filter.capacity,
+            'count': asset_filter.count,
+            'stale': self.asset_filter_stale,
+        }).encode()
+        tmp_name = self.ASSET_FILTER_FILE + '.tmp'
+        with util.open_truncate(tmp_name) as f:
+            f.write(pack_le_uint32(len(header)) + header)
+            f.write(asset_filter.bits)
+        os.replace(tmp_name, self.ASSET_FILTER_FILE)
+
+    def asset_outpoint_may_exist(self, tx_hash, idx_packed):
+        '''Return False if the outpoint is certainly not in the asset DB.'''
+        self.asset_filter_probes += 1
+        if tx_hash[:4] + idx_packed in self.asset_filter:
+            self.asset_filter_passes += 1
+            return True
+        return False
+
+    def asset_filter_info(self):
+        '''A summary of the asset outpoint filter for getinfo.'''
+        return (f'{self.asset_filter_probes:,d} probes {self.asset_filter_passes:,d} passed '
+                f'{self.asset_filter_false_positives:,d} false positives '
+                f'{self.asset_filter.count - self.asset_filter_stale:,d} entries')
+
     # -- UTXO database
 
     def read_utxo_state(self):
@@ -1052,6 +1441,7 @@ class DB(object):
     def write_asset_state(self, batch):
         state = {
             'asset_count': self.db_asset_count,
+            'asset_flush_count': self.asset_flush_count,
         }
         batch.put(b'state', repr(state).encode())
 
@@ -1075,51 +1465,86 @@ class DB(object):
             self.write_utxo_state(batch)
 
     async def all_assets(self, hashX):
-        def read_assets():
-            assets = []
-            assets_append = assets.append
+        def read_assets(view):
+            rows = []
+            rows_append = rows.append
             prefix = b'u' + hashX
-            for db_key, db_value in self.asset_db.iterator(prefix=prefix):
+            for db_key, db_value in view.asset_db.iterator(prefix=prefix):
                 tx_pos, = unpack_le_uint32(db_key[-9:-5])
                 tx_num, = unpack_le_uint64(db_key[-5:] + bytes(3))
-                tx_hash, height = self.fs_tx_hash(tx_num)
                 value, = unpack_le_uint64(db_value[:8])
                 name = db_value[9:].decode('ascii')
-                assets_append(ASSET(tx_num, tx_pos, tx_hash, height, name, value))
-            return assets
+                rows_append((tx_num, tx_pos, name, value))
+            tx_hashes = self.fs_tx_hashes([row[0] for row in rows])
+            return [ASSET(tx_num, tx_pos, tx_hash, height, name, value)
+                    for (tx_num, tx_pos, name, value), (tx_hash, height)
+                    in zip(rows, tx_hashes)]
 
-        while True:
-            assets = await run_in_thread(read_assets)
-            if all(asset.tx_hash is not None for asset in assets):
-                return assets
-            self.logger.warning('all_assets: tx hash not found (reorg?), retrying...')
-            await sleep(0.25)
+        return await self.run_with_view(read_assets)
 
     async def all_utxos(self, hashX):
         '''Return all UTXOs for an address sorted in no particular order.'''
-        def read_utxos():
-            utxos = []
-            utxos_append = utxos.append
+        def read_utxos(view):
+            rows = []
+            rows_append = rows.append
             # Key: b'u' + address_hashX + tx_idx + tx_num
             # Value: the UTXO value as a 64-bit unsigned integer
             prefix = b'u' + hashX
-            for db_key, db_value in self.utxo_db.iterator(prefix=prefix):
+            for db_key, db_value in view.utxo_db.iterator(prefix=prefix):
                 value, = unpack_le_uint64(db_value)
                 if value > 0:
                     # Values of 0 will only be assets.
                     # Get them from all_assets
                     tx_pos, = unpack_le_uint32(db_key[-9:-5])
                     tx_num, = unpack_le_uint64(db_key[-5:] + bytes(3))
-                    tx_hash, height = self.fs_tx_hash(tx_num)
-                    utxos_append(UTXO(tx_num, tx_pos, tx_hash, height, value))
-            return utxos
+                    rows_append((tx_num, tx_pos, value))
+            tx_hashes = self.fs_tx_hashes([row[0] for row in rows])
+            return [UTXO(tx_num, tx_pos, tx_hash, height, value)
+                    for (tx_num, tx_pos, value), (tx_hash, height) in zip(rows, tx_hashes)]
 
-        while True:
-            utxos = await run_in_thread(read_utxos)
-            if all(utxo.tx_hash is not None for utxo in utxos):
-                return utxos
-            self.logger.warning('all_utxos: tx hash not found (reorg?), retrying...')
-            await sleep(0.25)
+        return await self.run_with_view(read_utxos)
+
+    def _lookup_hashXs(self, db, prevouts):
+        '''Return (hashX, suffix) pairs, or (None, None) if not found,
+        for each prevout in the UTXO or asset DB db.
+        '''
+        # Key: b'h' + compressed_tx_hash + tx_idx + tx_num
+        # Value: hashX
+        prefixes = [b'h' + tx_hash[:4] + pack_le_uint32(tx_idx)
+                    for tx_hash, tx_idx in prevouts]
+        candidates = defaultdict(list)
+        for prefix, db_key, hashX in db.iter_prefixes_many(prefixes):
+            candidates[prefix].append((db_key[-5:], hashX))
+
+        # Resolve the tx hashes of every candidate in one batch
+        tx_nums = [unpack_le_uint64(tx_num_packed + bytes(3))[0]
+                   for matches in candidates.values() for tx_num_packed, _hashX in matches]
+        fs_hashes = dict(zip(tx_nums, self.fs_tx_hashes(tx_nums)))
+
+        result = []
+        for (tx_hash, tx_idx), prefix in zip(prevouts, prefixes):
+            pair = None, None
+            # Find which entry, if any, the TX_HASH matches.
+            for tx_num_packed, hashX in candidates.get(prefix, ()):
+                tx_num, = unpack_le_uint64(tx_num_packed + bytes(3))
+                if fs_hashes[tx_num][0] == tx_hash:
+                    pair = hashX, pack_le_uint32(tx_idx) + tx_num_packed
+                    break
+            result.append(pair)
+        return result
+
+    def _lookup_values(self, db, prevouts):
+        '''Return (hashX, db_value) pairs, or (None, None) if not found, for
+        each prevout in the UTXO or asset DB db.
+
+        The DB is read in two sorted batches: the hashXs, then the values.
+        '''
+        hashX_pairs = self._lookup_hashXs(db, prevouts)
+        # Key: b'u' + address_hashX + tx_idx + tx_num
+        keys = [b'u' + hashX + suffix for hashX, suffix in hashX_pairs if hashX]
+        values = iter(db.get_many(keys))
+        return [(hashX, next(values)) if hashX else (None, None)
+                for hashX, _suffix in hashX_pairs]
 
     async def lookup_utxos(self, prevouts):
         '''For each prevout, lookup it up in the DB and return a (hashX,
@@ -1127,50 +1552,27 @@ class DB(object):
 
         Used by the mempool code.
         '''
-        def lookup_hashXs():
-            '''Return (hashX, suffix) pairs, or None if not found,
-            for each prevout.
-            '''
-            def lookup_hashX(tx_hash, tx_idx):
-                idx_packed = pack_le_uint32(tx_idx)
+        def lookup_utxo(hashX, db_value):
+            if not hashX:
+                # This can happen when the daemon is a block ahead
+                # of us and has mempool txs spending outputs from
+                # that new block
+                return None
+            if not db_value:
+                # This can happen if the DB was updated between
+                # getting the hashXs and getting the UTXOs
+                return None
+            # Value: the UTXO value as a 64-bit unsigned integer
+            value, = unpack_le_uint64(db_value)
+            if value == 0:
+                return None
+            return hashX, value
 
-                # Key: b'h' + compressed_tx_hash + tx_idx + tx_num
-                # Value: hashX
-                prefix = b'h' + tx_hash[:4] + idx_packed
-
-                # Find which entry, if any, the TX_HASH matches.
-                for db_key, hashX in self.utxo_db.iterator(prefix=prefix):
-                    tx_num_packed = db_key[-5:]
-                    tx_num, = unpack_le_uint64(tx_num_packed + bytes(3))
-                    fs_hash, _height = self.fs_tx_hash(tx_num)
-                    if fs_hash == tx_hash:
-                        return hashX, idx_packed + tx_num_packed
-                return None, None
-            return [lookup_hashX(*prevout) for prevout in prevouts]
-
-        def lookup_utxos(hashX_pairs):
-            def lookup_utxo(hashX, suffix):
-                if not hashX:
-                    # This can happen when the daemon is a block ahead
-                    # of us and has mempool txs spending outputs from
-                    # that new block
-                    return None
-                # Key: b'u' + address_hashX + tx_idx + tx_num
-                # Value: the UTXO value as a 64-bit unsigned integer
-                key = b'u' + hashX + suffix
-                db_value = self.utxo_db.get(key)
-                if not db_value:
-                    # This can happen if the DB was updated between
-                    # getting the hashXs and getting the UTXOs
-                    return None
-                value, = unpack_le_uint64(db_value)
-                if value == 0:
-                    return None
-                return hashX, value
-            return [lookup_utxo(*hashX_pair) for hashX_pair in hashX_pairs]
+        def lookup_utxos():
+            return [lookup_utxo(hashX, db_value) for hashX, db_value
+                    in self._lookup_values(self.utxo_db, prevouts)]
 
-        hashX_pairs = await run_in_thread(lookup_hashXs)
-        return [i for i in await run_in_thread(lookup_utxos, hashX_pairs) if i]
+        return await run_in_thread(lookup_utxos)
 
     # For external use
     async def get_associations_for_qualifier_current(self, asset: bytes):
@@ -1180,6 +1582,7 @@ class DB(object):
             if data is None:
                 return ret
             parser = util.DataParser(data)
+            rows = []
             for _ in range(parser.read_int()):
                 ass = parser.read_var_bytes_as_ascii()
                 res_idx, = unpack_le_uint32(parser.read_bytes(4))
@@ -1187,7 +1590,9 @@ class DB(object):
                 tx_numb = parser.read_bytes(5)
                 flag = parser.read_boolean()
                 tx_num, = unpack_le_uint64(tx_numb + bytes(3))
-                tx_hash, height = self.fs_tx_hash(tx_num)
+                rows.append((tx_num, ass, res_idx, qual_idx, flag))
+            tx_hashes = self.fs_tx_hashes([row[0] for row in rows])
+            for (_tx_num, ass, res_idx, qual_idx, flag), (tx_hash, height) in zip(rows, tx_hashes):
                 ret[ass] = {
                     'associated': flag,
                     'height': height,
@@ -1202,11 +1607,16 @@ class DB(object):
         def get_asset_history():
             ret = {}
             prefix = b'2' + bytes([len(asset)]) + asset
+            rows = []
             for db_key, db_value in self.asset_db.iterator(prefix=prefix):
                 res_tx_pos, = unpack_le_uint32(db_key[-13:-9])
                 qual_tx_pos, = unpack_le_uint32(db_key[-9:-5])
                 tx_num, = unpack_le_uint64(db_key[-5:] + bytes(3))
-                tx_hash, height = self.fs_tx_hash(tx_num)
+                rows.append((tx_num, res_tx_pos, qual_tx_pos, db_value))
+            tx_hashes = self.fs_tx_hashes([row[0] for row in rows])
+
+            for (_tx_num, res_tx_pos, qual_tx_pos, db_value), (tx_hash, height) \
+                    in zip(rows, tx_hashes):
                 parser = util.DataParser(db_value)
 
                 flag = parser.read_boolean()
@@ -1240,6 +1650,7 @@ class DB(object):
             if data is None:
                 return ret
             parser = util.DataParser(data)
+            rows = []
             for _ in range(parser.read_int()):
                 ass = parser.read_var_bytes_as_ascii()
                 res_idx, = unpack_le_uint32(parser.read_bytes(4))
@@ -1247,7 +1658,9 @@ class DB(object):
                 tx_numb = parser.read_bytes(5)
                 flag = parser.read_boolean()
                 tx_num, = unpack_le_uint64(tx_numb + bytes(3))
-                tx_hash, height = self.fs_tx_hash(tx_num)
+                rows.append((tx_num, ass, res_idx, qual_idx, flag))
+            tx_hashes = self.fs_tx_hashes([row[0] for row in rows])
+            for (_tx_num, ass, res_idx, qual_idx, flag), (tx_hash, height) in zip(rows, tx_hashes):
                 ret[ass] = {
                     'associated': flag,
                     'height': height,
@@ -1262,11 +1675,16 @@ class DB(object):
         def get_asset_history():
             ret = {}
             prefix = b'1' + bytes([len(asset)]) + asset
+            rows = []
             for db_key, db_value in self.asset_db.iterator(prefix=prefix):
                 res_tx_pos, = unpack_le_uint32(db_key[-13:-9])
                 qual_tx_pos, = unpack_le_uint32(db_key[-9:-5])
                 tx_num, = unpack_le_uint64(db_key[-5:] + bytes(3))
-                tx_hash, height = self.fs_tx_hash(tx_num)
+                rows.append((tx_num, res_tx_pos, qual_tx_pos, db_value))
+            tx_hashes = self.fs_tx_hashes([row[0] for row in rows])
+
+            for (_tx_num, res_tx_pos, qual_tx_pos, db_value), (tx_hash, height) \
+                    in zip(rows, tx_hashes):
                 parser = util.DataParser(db_value)
 
                 adds = []
@@ -1309,9 +1727,9 @@ class DB(object):
                 tx_pos, = unpack_le_uint32(parser.read_bytes(4))
                 tx_numb = parser.read_bytes(5)
                 flag = parser.read_boolean()
-                tx_num, = unpack_le_uint64(tx_numb + bytes(3))
-                tx_hash, height = self.fs_tx_hash(tx_num)
                 if hex == h160:
+                    tx_num, = unpack_le_uint64(tx_numb + bytes(3))
+                    (tx_hash, height), = self.fs_tx_hashes([tx_num])
                     return {
                         'flag': flag,
                         'height': height,
@@ -1329,13 +1747,16 @@ class DB(object):
             if data is None:
                 return ret
             parser = util.DataParser(data)
+            rows = []
             for _ in range(parser.read_int()):
                 h160 = parser.read_var_bytes()
                 tx_pos, = unpack_le_uint32(parser.read_bytes(4))
                 tx_numb = parser.read_bytes(5)
                 flag = parser.read_boolean()
                 tx_num, = unpack_le_uint64(tx_numb + bytes(3))
-                tx_hash, height = self.fs_tx_hash(tx_num)
+                rows.append((tx_num, h160, tx_pos, flag))
+            tx_hashes = self.fs_tx_hashes([row[0] for row in rows])
+            for (_tx_num, h160, tx_pos, flag), (tx_hash, height) in zip(rows, tx_hashes):
                 ret[h160.hex()] = {
                     'flag': flag,
                     'height': height,
@@ -1349,10 +1770,14 @@ class DB(object):
         def get_h160_history():
             ret = {}
             prefix = b'a' + bytes([len(asset)]) + asset
+            rows = []
             for db_key, db_value in self.asset_db.iterator(prefix=prefix):
                 tx_pos, = unpack_le_uint32(db_key[-9:-5])
                 tx_num, = unpack_le_uint64(db_key[-5:] + bytes(3))
-                tx_hash, height = self.fs_tx_hash(tx_num)
+                rows.append((tx_num, tx_pos, db_value))
+            tx_hashes = self.fs_tx_hashes([row[0] for row in rows])
+
+            for (_tx_num, tx_pos, db_value), (tx_hash, height) in zip(rows, tx_hashes):
                 parser = util.DataParser(db_value)
                 h160 = parser.read_var_bytes()
                 flag = parser.read_boolean()
@@ -1382,13 +1807,16 @@ class DB(object):
             if data is None:
                 return ret
             parser = util.DataParser(data)
+            rows = []
             for _ in range(parser.read_int()):
                 asset = parser.read_var_bytes_as_ascii()
                 tx_pos, = unpack_le_uint32(parser.read_bytes(4))
                 tx_numb = parser.read_bytes(5)
                 flag = parser.read_boolean()
                 tx_num, = unpack_le_uint64(tx_numb + bytes(3))
-                tx_hash, height = self.fs_tx_hash(tx_num)
+                rows.append((tx_num, asset, tx_pos, flag))
+            tx_hashes = self.fs_tx_hashes([row[0] for row in rows])
+            for (_tx_num, asset, tx_pos, flag), (tx_hash, height) in zip(rows, tx_hashes):
                 ret[asset] = {
                     'flag': flag,
                     'height': height,
@@ -1403,10 +1831,14 @@ class DB(object):
         def get_h160_history():
             ret = {}
             prefix = b'p' + bytes([len(h160)]) + h160
+            rows = []
             for db_key, db_value in self.asset_db.iterator(prefix=prefix):
                 tx_pos, = unpack_le_uint32(db_key[-9:-5])
                 tx_num, = unpack_le_uint64(db_key[-5:] + bytes(3))
-                tx_hash, height = self.fs_tx_hash(tx_num)
+                rows.append((tx_num, tx_pos, db_value))
+            tx_hashes = self.fs_tx_hashes([row[0] for row in rows])
+
+            for (_tx_num, tx_pos, db_value), (tx_hash, height) in zip(rows, tx_hashes):
                 parser = util.DataParser(db_value)
                 asset = parser.read_var_bytes_as_ascii()
                 flag = parser.read_boolean()
@@ -1439,7 +1871,7 @@ class DB(object):
             tx_numb = parser.read_bytes(5)
             flag = parser.read_boolean()
             tx_num, = unpack_le_uint64(tx_numb + bytes(3))
-            tx_hash, height = self.fs_tx_hash(tx_num)
+            (tx_hash, height), = self.fs_tx_hashes([tx_num])
             return {
                 'frozen': flag,
                 'height': height,
@@ -1453,10 +1885,14 @@ class DB(object):
         def get_frozen_history():
             ret = {}
             prefix = b'f' + bytes([len(asset)]) + asset
+            rows = []
             for db_key, db_value in self.asset_db.iterator(prefix=prefix):
                 tx_pos, = unpack_le_uint32(db_key[-9:-5])
                 tx_num, = unpack_le_uint64(db_key[-5:] + bytes(3))
-                tx_hash, height = self.fs_tx_hash(tx_num)
+                rows.append((tx_num, tx_pos, db_value))
+            tx_hashes = self.fs_tx_hashes([row[0] for row in rows])
+
+            for (_tx_num, tx_pos, db_value), (tx_hash, height) in zip(rows, tx_hashes):
                 parser = util.DataParser(db_value)
                 flag = parser.read_boolean()
                 if height in ret.keys():
@@ -1479,10 +1915,13 @@ class DB(object):
         def read_messages():
             prefix = b'b' + bytes([len(asset_name)]) + asset_name
             ret_val = {}
+            rows = []
             for db_key, db_value in self.asset_db.iterator(prefix=prefix):
                 tx_pos, = unpack_le_uint32(db_key[-9:-5])
                 tx_num, = unpack_le_uint64(db_key[-5:] + bytes(3))
-                tx_hash, height = self.fs_tx_hash(tx_num)
+                rows.append((tx_num, tx_pos, db_value))
+            tx_hashes = self.fs_tx_hashes([row[0] for row in rows])
+            for (_tx_num, tx_pos, db_value), (tx_hash, height) in zip(rows, tx_hashes):
                 ret_val[hash_to_hex_str(tx_hash)] = {
                     'data': base_encode(db_value, 58),
                     'height': height,
@@ -1521,13 +1960,7 @@ class DB(object):
 
             tx_pos, = unpack_le_uint32(idx)
             tx_num, = unpack_le_uint64(tx_numb + bytes(3))
-            tx_hash, height = self.fs_tx_hash(tx_num)
-
-            to_ret['source'] = {
-                'tx_hash': hash_to_hex_str(tx_hash),
-                'tx_pos': tx_pos,
-                'height': height
-            }
+            sources = [('source', tx_num, tx_pos)]
 
             if data_parser.read_boolean():
                 idx_prev = data_parser.read_bytes(4)
@@ -1535,8 +1968,11 @@ class DB(object):
 
                 tx_pos, = unpack_le_uint32(idx_prev)
                 tx_num_prev, = unpack_le_uint64(tx_numb_prev + bytes(3))
-                tx_hash, height = self.fs_tx_hash(tx_num_prev)
-                to_ret['source_prev'] = {
+                sources.append(('source_prev', tx_num_prev, tx_pos))
+
+            tx_hashes = self.fs_tx_hashes([tx_num for _key, tx_num, _tx_pos in sources])
+            for (key, _tx_num, tx_pos), (tx_hash, height) in zip(sources, tx_hashes):
+                to_ret[key] = {
                     'tx_hash': hash_to_hex_str(tx_hash),
                     'tx_pos': tx_pos,
                     'height': height
@@ -1546,53 +1982,28 @@ class DB(object):
         return await run_in_thread(read_assets_meta)
 
     async def lookup_assets(self, prevouts):
-        '''For each prevout, lookup it up in the DB and return a (hashX,
-        value) pair or None if not found.
+        '''For each prevout, lookup it up in the asset DB and return a (hashX,
+        value, name) triple or None if not found.
 
         Used by the mempool code.
         '''
-        def lookup_hashXs():
-            '''Return (hashX, suffix) pairs, or None if not found,
-            for each prevout.
-            '''
-            def lookup_hashX(tx_hash, tx_idx):
-                idx_packed = pack_le_uint32(tx_idx)
-
-                # Key: b'h' + compressed_tx_hash + tx_idx + tx_num
-                # Value: hashX
-                prefix = b'h' + tx_hash[:4] + idx_packed
-
-                # Find which entry, if any, the TX_HASH matches.
-                for db_key, hashX in self.asset_db.iterator(prefix=prefix):
-                    tx_num_packed = db_key[-5:]
-                    tx_num, = unpack_le_uint64(tx_num_packed + bytes(3))
-                    fs_hash, _height = self.fs_tx_hash(tx_num)
-                    if fs_hash == tx_hash:
-                        return hashX, idx_packed + tx_num_packed
-                return None, None
-            return [lookup_hashX(*prevout) for prevout in prevouts]
-
-        def lookup_assets(hashX_pairs):
-            def lookup_asset(hashX, suffix):
-                if not hashX:
-                    # This can happen when the daemon is a block ahead
-                    # of us and has mempool txs spending outputs from
-                    # that new block
-                    return None
-                # Key: b'u' + address_hashX + tx_idx + tx_num
-                # Value: the UTXO value as a 64-bit unsigned integer
-                key = b'u' + hashX + suffix
-                db_value = self.asset_db.get(key)
-                if not db_value:
-                    # This can happen if the DB was updated between
-                    # getting the hashXs and getting the UTXOs
-                    return None
-
-                value, = unpack_le_uint64(db_value[:8])
-                name = db_value[9:].decode('ascii')
-
-                return hashX, value, name
-            return [lookup_asset(*hashX_pair) for hashX_pair in hashX_pairs]
-
-        hashX_pairs = await run_in_thread(lookup_hashXs)
-        return [i for i in await run_in_thread(lookup_assets, hashX_pairs) if i]
\ No newline at end of file
+        def lookup_asset(hashX, db_value):
+            if not hashX:
+                # This can happen when the daemon is a block ahead
+                # of us and has mempool txs spending outputs from
+                # that new block
+                return None
+            if not db_value:
+                # This can happen if the DB was updated between
+                # getting the hashXs and getting the UTXOs
+                return None
+            # Value: the asset value as a 64-bit unsigned integer, then the name
+            value, = unpack_le_uint64(db_value[:8])
+            name = db_value[9:].decode('ascii')
+            return hashX, value, name
+
+        def lookup_assets():
+            return [lookup_asset(hashX, db_value) for hashX, db_value
+                    in self._lookup_values(self.asset_db, prevouts)]
+
+        return await run_in_thread(lookup_assets)
@@ -62,6 +62,7 @@ class Env(EnvBase):
         # Misc
 
         self.db_engine = self.default('DB_ENGINE', 'leveldb')
+        self.rocksdb_block_cache_MB = self.integer('ROCKSDB_BLOCK_CACHE_MB', 256)
         self.banner_file = self.default('BANNER_FILE', None)
         self.tor_banner_file = self.default('TOR_BANNER_FILE',
                                             self.banner_file)
@@ -71,7 +72,13 @@ class Env(EnvBase):
         self.donation_address = self.default('DONATION_ADDRESS', '')
         self.drop_client = self.custom("DROP_CLIENT", None, re.compile)
         self.cache_MB = self.integer('CACHE_MB', 1200)
+        self.deserialize_processes = self.integer('DESERIALIZE_PROCESSES', 0)
+        self.daemon_rest = self.boolean('DAEMON_REST', False)
+        self.daemon_blocks_dir = self.default('DAEMON_BLOCKS_DIR', None)
         self.reorg_limit = self.integer('REORG_LIMIT', self.coin.REORG_LIMIT)
+        self.checkpoint_flushes = self.integer('CHECKPOINT_FLUSHES', 0)
+        self.checkpoint_secs = self.integer('CHECKPOINT_SECS', 3600)
+        self.history_compaction_hours = self.integer('HISTORY_COMPACTION_HOURS', 24)
 
         # Server limits to help prevent DoS
 
@@ -8,45 +8,210 @@
 
 '''History by script hash (address).'''
 
-import array
 import ast
 import bisect
+import struct
+import sys
 import time
 from collections import defaultdict
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from electrumx.lib import util
 from electrumx.lib.hash import hash_to_hex_str, HASHX_LEN
 
-from electrumx.lib.util import (
-    pack_be_uint32, pack_le_uint64, unpack_be_uint32_from, unpack_le_uint64,
-)
+from electrumx.lib.util import pack_be_uint32, pack_le_uint64, unpack_be_uint32_from
+
+
+# Rows of at least this many bytes are decoded with numpy, if available
+NUMPY_DECODE_SIZE = 256
+# Bytes of version 0 rows read per batch of a DB upgrade
+UPGRADE_BATCH_SIZE = 50_000_000
+
+
+def encode_history(tx_nums):
+    '''Return the history row of tx_nums, which must be ascending: the first
+    tx_num, then the difference from each to the next, as varints.
+
+    A varint is an unsigned integer in little-endian groups of 7 bits,
+    all but the last with the top bit of their byte set.'''
+    parts = []
+    append = parts.append
+    prior = 0
+    for tx_num in tx_nums:
+        delta = tx_num - prior
+        prior = tx_num
+        while delta > 0x7f:
+            append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        append(delta)
+    return bytes(parts)
+
+
+def decode_history(row):
+    '''Return the list of tx_nums of a history row.'''
+    if numpy is not None and len(row) >= NUMPY_DECODE_SIZE:
+        return _decode_history_numpy(row)
+    tx_nums = []
+    append = tx_nums.append
+    tx_num = delta = shift = 0
+    for byte in row:
+        if byte & 0x80:
+            delta |= (byte & 0x7f) << shift
+            shift += 7
+        else:
+            tx_num += delta | (byte << shift)
+            append(tx_num)
+            delta = shift = 0
+    return tx_nums
+
+
+def _decode_history_numpy(row):
+    data = numpy.frombuffer(row, dtype=numpy.uint8)
+    ends = numpy.flatnonzero(data < 0x80)
+    starts = numpy.concatenate(([0], ends[:-1] + 1))
+    # The position of each byte in its varint
+    shifts = numpy.arange(len(data)) - numpy.repeat(starts, ends - starts + 1)
+    values = (data & 0x7f).astype(numpy.uint64) << (shifts * 7).astype(numpy.uint64)
+    return numpy.cumsum(numpy.add.reduceat(values, starts)).tolist()
+
+
+def _encode_history_numpy(tx_nums, starts):
+    '''Return (data, offsets) where data is the concatenated history rows of
+    the numpy array tx_nums split at starts, and row n is data[offsets[n]:
+    offsets[n + 1]].'''
+    deltas = numpy.diff(tx_nums, prepend=numpy.uint64(0))
+    deltas[starts] = tx_nums[starts]
+    # Six 7-bit groups are enough for 5-byte tx_nums
+    lengths = numpy.ones(len(deltas), dtype=numpy.uint8)
+    for group in range(1, 6):
+        lengths += deltas >= numpy.uint64(1 << group * 7)
+    encoded = numpy.empty((len(deltas), 6), dtype=numpy.uint8)
+    for group in range(6):
+        encoded[:, group] = (deltas >> numpy.uint64(group * 7)) & numpy.uint64(0x7f)
+        encoded[:, group] |= (lengths > group + 1).view(numpy.uint8) << 7
+    data = encoded[numpy.arange(6) < lengths[:, None]].tobytes()
+    offsets = numpy.concatenate(([0], numpy.cumsum(lengths, dtype=numpy.int64)))[
+        numpy.concatenate((starts, [len(tx_nums)]))].tolist()
+    return data, offsets
+
+
+def _encode_rows(tx_nums, row_entries):
+    '''Return the history rows of the list tx_nums split every row_entries
+    entries.'''
+    if numpy is not None and len(tx_nums) > row_entries:
+        starts = numpy.arange(0, len(tx_nums), row_entries)
+        data, offsets = _encode_history_numpy(numpy.array(tx_nums, dtype=numpy.uint64),
+                                              starts)
+        return [data[start: end] for start, end in zip(offsets, offsets[1:])]
+    return [encode_history(tx_nums[start: start + row_entries])
+            for start in range(0, len(tx_nums), row_entries)]
+
+
+def _unpack_tx_nums(tx_numbs):
+    '''Return the tx_nums of concatenated 5-byte little-endian tx_nums.'''
+    return [low + (high << 32) for low, high in struct.iter_unpack('<IB', tx_numbs)]
+
+
+class UnflushedHistory:
+    '''History not yet flushed, as an append-only buffer of (hashX, tx_num)
+    pairs held in two columns: the hashXs, and the tx_nums as 5-byte
+    little-endian integers.  Entries take 16 bytes, rather than the 5
+    bytes plus a dict entry, key and bytearray per hashX of a dict of
+    histories.
+
+    Pairs must be added in tx_num order.  rows() sorts and groups them
+    by hashX into history rows when the history is flushed.
+    '''
+
+    def __init__(self):
+        self.hashXs = bytearray()
+        self.tx_numbs = bytearray()
+
+    def __len__(self):
+        return len(self.tx_numbs) // 5
+
+    @property
+    def nbytes(self):
+        '''The memory allocated to the buffer.'''
+        return sys.getsizeof(self.hashXs) + sys.getsizeof(self.tx_numbs)
+
+    def add(self, hashXs, tx_numb):
+        '''Add the distinct hashXs touched by the transaction with packed
+        tx_num tx_numb.'''
+        self.hashXs.extend(b''.join(hashXs))
+        self.tx_numbs.extend(tx_numb * len(hashXs))
+
+    def rows(self):
+        '''Return a sorted list of (hashX, row) pairs, where row is the history
+        row of the hashX's tx_nums.'''
+        if numpy is not None and len(self) > 256:
+            return self._rows_numpy()
+        rows = defaultdict(list)
+        for hashX, tx_num in zip(util.chunks(bytes(self.hashXs), HASHX_LEN),
+                                 _unpack_tx_nums(self.tx_numbs)):
+            rows[hashX].append(tx_num)
+        return [(hashX, encode_history(rows[hashX])) for hashX in sorted(rows)]
+
+    def _rows_numpy(self):
+        count = len(self)
+        keys = numpy.frombuffer(self.hashXs, dtype=numpy.uint8).reshape(count, HASHX_LEN)
+        padded = numpy.zeros((count, 16), dtype=numpy.uint8)
+        padded[:, :HASHX_LEN] = keys
+        padded = padded.view('>u8').astype(numpy.uint64)
+        # Sorting is much faster unstable and on one integer.  Replace the low bits of
+        # the first 8 bytes of the hashXs with the entry index, which is in tx_num
+        # order, so the sort is on a hashX prefix and then by tx_num.  In the rare case
+        # that two hashXs share the prefix, do a slower stable sort on whole hashXs.
+        bits = count.bit_length()
+        mask = numpy.uint64((1 << bits) - 1)
+        order = numpy.argsort((padded[:, 0] & ~mask) | numpy.arange(count, dtype=numpy.uint64))
+        high, low = padded[order].T
+        same_prefix = ((high[1:] ^ high[:-1]) & ~mask) == 0
+        new_key = (high[1:] != high[:-1]) | (low[1:] != low[:-1])
+        if (same_prefix & new_key).any():
+            order = numpy.lexsort((padded[:, 1], padded[:, 0]))
+            high, low = padded[order].T
+            new_key = (high[1:] != high[:-1]) | (low[1:] != low[:-1])
+        starts = numpy.concatenate(([0], numpy.flatnonzero(new_key) + 1))
+        keys = numpy.frombuffer(self.hashXs, dtype=f'V{HASHX_LEN}')[order[starts]].tobytes()
+        tx_nums = numpy.zeros((count, 8), dtype=numpy.uint8)
+        tx_nums[:, :5] = numpy.frombuffer(
+            numpy.frombuffer(self.tx_numbs, dtype='V5')[order].tobytes(),
+            dtype=numpy.uint8).reshape(count, 5)
+        data, offsets = _encode_history_numpy(tx_nums.view('<u8').ravel(), starts)
+        return [(keys[pos: pos + HASHX_LEN], data[start: end])
+                for pos, start, end in zip(range(0, len(keys), HASHX_LEN), offsets,
+                                           offsets[1:])]
 
 
 class History(object):
 
-    DB_VERSIONS = [0]
+    # Version 0 rows are concatenated 5-byte little-endian tx_nums.
+    # Version 1 rows are as returned by encode_history().
+    DB_VERSIONS = [0, 1]
 
     def __init__(self):
         self.logger = util.class_logger(__name__, self.__class__.__name__)
         # For history compaction
         self.max_hist_row_entries = 12500
-        self.unflushed = defaultdict(bytearray)
-        self.unflushed_count = 0
+        self.unflushed = UnflushedHistory()
         self.flush_count = 0
         self.comp_flush_count = -1
         self.comp_cursor = -1
         self.db_version = max(self.DB_VERSIONS)
         self.upgrade_cursor = -1
+        # The lowest flush ID that may have a journal entry
+        self.journal_start = 0
         self.db = None
 
-    def open_db(self, db_class, for_sync, utxo_flush_count, compacting):
+    def open_db(self, db_class, for_sync, utxo_flush_count):
         self.db = db_class('hist', for_sync)
         self.read_state()
         self.clear_excess(utxo_flush_count)
-        # An incomplete compaction needs to be cancelled otherwise
-        # restarting it will corrupt the history
-        if not compacting:
-            self._cancel_compaction()
         return self.flush_count
 
     def close_db(self):
@@ -65,12 +230,14 @@ class History(object):
             self.comp_cursor = state.get('comp_cursor', -1)
             self.db_version = state.get('db_version', 0)
             self.upgrade_cursor = state.get('upgrade_cursor', -1)
+            self.journal_start = state.get('journal_start', self.flush_count + 1)
         else:
             self.flush_count = 0
             self.comp_flush_count = -1
             self.comp_cursor = -1
             self.db_version = max(self.DB_VERSIONS)
             self.upgrade_cursor = -1
+            self.journal_start = 0
 
         if self.db_version not in self.DB_VERSIONS:
             msg = (f'your history DB version is {self.db_version} but '
@@ -88,25 +255,67 @@ class History(object):
         if self.flush_count <= utxo_flush_count:
             return
 
-        self.logger.info('DB shut down uncleanly.  Scanning for '
+        self.logger.info('DB shut down uncleanly.  Reading the journal of '
                          'excess history flushes...')
 
-        keys = []
-        for key, _hist in self.db.iterator(prefix=b''):
-            flush_id, = unpack_be_uint32_from(key[-4:])
-            if flush_id > utxo_flush_count:
-                keys.append(key)
+        keys = self._excess_keys(utxo_flush_count)
+        if keys is None:
+            self.logger.info('flush journal incomplete.  Scanning for '
+                             'excess history flushes...')
+            keys = []
+            for key, _hist in self.db.iterator(prefix=b''):
+                if len(key) == HASHX_LEN + 4:
+                    flush_id, = unpack_be_uint32_from(key[-4:])
+                    if flush_id > utxo_flush_count:
+                        keys.append(key)
 
         self.logger.info(f'deleting {len(keys):,d} history entries')
 
-        self.flush_count = utxo_flush_count
         with self.db.write_batch() as batch:
             for key in keys:
                 batch.delete(key)
+            self._prune_journal(batch, self.flush_count)
+            self.flush_count = utxo_flush_count
+            self.journal_start = utxo_flush_count + 1
             self.write_state(batch)
 
         self.logger.info('deleted excess history entries')
 
+    #
+    # Flush journal
+    #
+
+    # Each flush writes, with its history, a journal entry of the hashXs
+    # it wrote rows for, so after a crash the flushes since the last
+    # UTXO flush can be deleted without scanning the DB.  Entries are
+    # keyed b'J' + flush ID; keys shorter than a hashX cannot be mistaken
+    # for history rows.  Entries from journal_start to the UTXO flush
+    # count are no longer needed and are deleted by the next flush.
+
+    @staticmethod
+    def journal_key(flush_id):
+        return b'J' + pack_be_uint32(flush_id)
+
+    def _excess_keys(self, utxo_flush_count):
+        '''Return the keys written by flushes after utxo_flush_count, from the
+        journal, or None if a journal entry is missing.'''
+        keys = []
+        for flush_id in range(utxo_flush_count + 1, self.flush_count + 1):
+            if flush_id < self.journal_start:
+                return None
+            hashXs = self.db.get(self.journal_key(flush_id))
+            if hashXs is None:
+                return None
+            suffix = pack_be_uint32(flush_id)
+            keys.extend(hashX + suffix for hashX in util.chunks(hashXs, HASHX_LEN))
+        return keys
+
+    def _prune_journal(self, batch, last):
+        '''Delete the journal entries up to flush ID last.'''
+        for flush_id in range(self.journal_start, last + 1):
+            batch.delete(self.journal_key(flush_id))
+        self.journal_start = max(self.journal_start, last + 1)
+
     def write_state(self, batch):
         '''Write state to the history DB.'''
         state = {
@@ -115,68 +324,79 @@ class History(object):
             'comp_cursor': self.comp_cursor,
             'db_version': self.db_version,
             'upgrade_cursor': self.upgrade_cursor,
+            'journal_start': self.journal_start,
         }
         # History entries are not prefixed; the suffix \0\0 ensures we
         # look similar to other entries and aren't interfered with
         batch.put(b'state\0\0\0\0', repr(state).encode())
 
     def add_unflushed(self, hashXs_by_tx, first_tx_num):
-        unflushed = self.unflushed
-        count = 0
+        add = self.unflushed.add
         for tx_num, hashXs in enumerate(hashXs_by_tx, start=first_tx_num):
-            tx_numb = pack_le_uint64(tx_num)[:5]
-            hashXs = set(hashXs)
-            for hashX in hashXs:
-                unflushed[hashX].extend(tx_numb)
-            count += len(hashXs)
-        self.unflushed_count += count
+            add(set(hashXs), pack_le_uint64(tx_num)[:5])
 
     def unflushed_memsize(self):
-        return len(self.unflushed) * 180 + self.unflushed_count * 5
+        return self.unflushed.nbytes
 
     def assert_flushed(self):
         assert not self.unflushed
 
-    def flush(self):
+    def take_unflushed(self):
+        '''Return the unflushed history and start afresh, so that more can be
+        added while it is flushed.'''
+        unflushed = self.unflushed
+        self.unflushed = UnflushedHistory()
+        return unflushed
+
+    def flush(self, unflushed=None, sync=True, utxo_flush_count=-1):
+        '''Flush unflushed, which defaults to all unflushed history.  If sync
+        is False the flush need not be durable.  Journal entries up to
+        utxo_flush_count are deleted.'''
+        if unflushed is None:
+            unflushed = self.take_unflushed()
         start_time = time.monotonic()
-        self.flush_count += 1
+        self._increment_flush_count()
         flush_id = pack_be_uint32(self.flush_count)
-        unflushed = self.unflushed
 
-        with self.db.write_batch() as batch:
-            for hashX in sorted(unflushed):
-                key = hashX + flush_id
-                batch.put(key, bytes(unflushed[hashX]))
+        rows = unflushed.rows()
+        with self.db.write_batch(sync=sync) as batch:
+            self._prune_journal(batch, utxo_flush_count)
+            for hashX, hist in rows:
+                batch.put(hashX + flush_id, hist)
+            batch.put(self.journal_key(self.flush_count),
+                      b''.join(hashX for hashX, _hist in rows))
             self.write_state(batch)
 
-        count = len(unflushed)
-        unflushed.clear()
-        self.unflushed_count = 0
+        count = len(rows)
 
         if self.db.for_sync:
             elapsed = time.monotonic() - start_time
             self.logger.info(f'flushed history in {elapsed:.1f}s '
                              f'for {count:,d} addrs')
 
+    def _increment_flush_count(self):
+        self.flush_count += 1
+        # History flushed during a compaction must not be reset to a lower flush count
+        if self.comp_cursor != -1:
+            self.comp_flush_count = max(self.comp_flush_count, self.flush_count)
+
     def backup(self, hashXs, tx_count):
         # Not certain this is needed, but it doesn't hurt
-        self.flush_count += 1
+        self._increment_flush_count()
         nremoves = 0
         bisect_left = bisect.bisect_left
-        chunks = util.chunks
 
         with self.db.write_batch() as batch:
             for hashX in sorted(hashXs):
                 deletes = []
                 puts = {}
                 for key, hist in self.db.iterator(prefix=hashX, reverse=True):
-                    a = array.array('Q')
-                    a.frombytes(b''.join(item + bytes(3) for item in chunks(hist, 5)))
+                    tx_nums = decode_history(hist)
                     # Remove all history entries >= tx_count
-                    idx = bisect_left(a, tx_count)
-                    nremoves += len(a) - idx
+                    idx = bisect_left(tx_nums, tx_count)
+                    nremoves += len(tx_nums) - idx
                     if idx > 0:
-                        puts[key] = hist[:5 * idx]
+                        puts[key] = encode_history(tx_nums[:idx])
                         break
                     deletes.append(key)
 
@@ -184,24 +404,27 @@ class History(object):
                     batch.delete(key)
                 for key, value in puts.items():
                     batch.put(key, value)
+            # Rows are only rewritten under their keys, so there are none to journal
+            batch.put(self.journal_key(self.flush_count), b'')
             self.write_state(batch)
 
         self.logger.info(f'backing up removed {nremoves:,d} history entries')
 
-    def get_txnums(self, hashX, limit=1000):
+    def get_txnums(self, hashX, limit=1000, db=None):
         '''Generator that returns an unpruned, sorted list of tx_nums in the
         history of a hashX.  Includes both spending and receiving
         transactions.  By default yields at most 1000 entries.  Set
-        limit to None to get them all.  '''
+        limit to None to get them all.  The history is read from db, a
+        snapshot of the history DB, if given.'''
         limit = util.resolve_limit(limit)
-        chunks = util.chunks
-        for _key, hist in self.db.iterator(prefix=hashX):
-            for tx_numb in chunks(hist, 5):
-                if limit == 0:
-                    return
-                tx_num, = unpack_le_uint64(tx_numb + bytes(3))
-                yield tx_num
-                limit -= 1
+        for _key, hist in (db or self.db).iterator(prefix=hashX):
+            if limit == 0:
+                return
+            tx_nums = decode_history(hist)
+            if 0 < limit < len(tx_nums):
+                tx_nums = tx_nums[:limit]
+            yield from tx_nums
+            limit -= len(tx_nums)
 
     #
     # History compaction
@@ -209,31 +432,47 @@ class History(object):
 
     # comp_cursor is a cursor into compaction progress.
     # -1: no compaction in progress
-    # 0-65535: Compaction in progress; all prefixes < comp_cursor have
-    #     been compacted, and later ones have not.
-    # 65536: compaction complete in-memory but not flushed
+    # 0 to 2**32 - 1: Compaction in progress; all hashXs whose first 4
+    #     bytes, as a big-endian integer, are < comp_cursor have been
+    #     compacted, and later ones have not.
+    #
+    # A compacted hashX has its history in rows of max_hist_row_entries
+    #     entries keyed by row number.  History flushed later has the
+    #     then flush count as its key suffix, so a hashX can only be
+    #     compacted into rows numbered up to the current flush count.
+    #     Compaction runs when no history has been flushed since the
+    #     UTXOs were, so the rows are not history that clear_excess()
+    #     would delete after a crash.
     #
-    # comp_flush_count applies during compaction, and is a flush count
-    #     for history with prefix < comp_cursor.  flush_count applies
-    #     to still uncompacted history.  It is -1 when no compaction is
-    #     taking place.  Key suffixes up to and including comp_flush_count
-    #     are used, so a parallel history flush must first increment this
+    # comp_flush_count applies during compaction, and is the highest key
+    #     suffix used by compacted rows or by history flushed since the
+    #     compaction started.  It is -1 when no compaction is taking place.
     #
     # When compaction is complete and the final flush takes place,
-    # flush_count is reset to comp_flush_count, and comp_flush_count to -1
+    # flush_count is reset to comp_flush_count if that is lower, and
+    # comp_flush_count to -1
+
+    def start_compaction(self):
+        '''Start compacting the history unless a compaction is in progress.'''
+        if self.comp_cursor == -1:
+            self.comp_cursor = 0
+            self.comp_flush_count = max(self.comp_flush_count, 1)
 
     def _flush_compaction(self, cursor, write_items, keys_to_delete):
         '''Flush a single compaction pass as a batch.'''
-        # Update compaction state
-        if cursor == (2**8)**4:  # 65536:
-            self.flush_count = self.comp_flush_count
-            self.comp_cursor = -1
-            self.comp_flush_count = -1
-        else:
-            self.comp_cursor = cursor
-
         # History DB.  Flush compacted history and updated state
         with self.db.write_batch() as batch:
+            # Update compaction state.  No history has been flushed since the UTXOs
+            # were, so the journal is not needed when the flush count is reset
+            if cursor == (2**8)**4:
+                self._prune_journal(batch, self.flush_count)
+                self.flush_count = min(self.flush_count, self.comp_flush_count)
+                self.journal_start = self.flush_count + 1
+                self.comp_cursor = -1
+                self.comp_flush_count = -1
+            else:
+                self.comp_cursor = cursor
+
             # Important: delete first!  The keyspace may overlap.
             for key in keys_to_delete:
                 batch.delete(key)
@@ -245,18 +484,25 @@ class History(object):
                        write_items, keys_to_delete):
         '''Compres history for a hashX.  hist_list is an ordered list of
         the histories to be compressed.'''
-        # History entries (tx numbers) are 4 bytes each.  Distribute
-        # over rows of up to 50KB in size.  A fixed row size means
+        # Distribute the history entries (tx numbers) over rows of up
+        # to max_hist_row_entries entries.  A fixed row length means
         # future compactions will not need to update the first N - 1
         # rows.
-        max_row_size = self.max_hist_row_entries * 5
-        full_hist = b''.join(hist_list)
-        nrows = (len(full_hist) + max_row_size - 1) // max_row_size
+        row_entries = self.max_hist_row_entries
+        tx_nums = []
+        for hist in hist_list:
+            tx_nums.extend(decode_history(hist))
+        nrows = (len(tx_nums) + row_entries - 1) // row_entries
         if nrows > 4:
             self.logger.info('hashX {} is large: {:,d} entries across '
                              '{:,d} rows'
                              .format(hash_to_hex_str(hashX),
-                                     len(full_hist) // 5, nrows))
+                                     len(tx_nums), nrows))
+        if nrows - 1 > self.flush_count:
+            # Later flushes would sort before its last rows.  Its keys are left as they are,
+            # so the flush count cannot be reset below them
+            self.comp_flush_count = max(self.comp_flush_count, self.flush_count)
+            return 0
 
         # Find what history needs to be written, and what keys need to
         # be deleted.  Start by assuming all keys are to be deleted,
@@ -265,7 +511,7 @@ class History(object):
         write_size = 0
         keys_to_delete.update(hist_map)
         n = 0   # In case of no loops
-        for n, chunk in enumerate(util.chunks(full_hist, max_row_size)):
+        for n, chunk in enumerate(_encode_rows(tx_nums, row_entries)):
             key = hashX + pack_be_uint32(n)
             if hist_map.get(key) == chunk:
                 keys_to_delete.remove(key)
@@ -278,16 +524,25 @@ class History(object):
 
         return write_size
 
-    def _compact_prefix(self, prefix, write_items, keys_to_delete):
-        '''Compact all history entries for hashXs beginning with the
-        given prefix.  Update keys_to_delete and write.'''
+    def _compact_history(self, limit):
+        '''Inner loop of history compaction.  Compacts hashXs from the cursor
+        on until limit bytes of history have been read, and returns the
+        bytes written.
+
+        Only the keys present are walked.  The batch ends between
+        hashXs with different 4-byte prefixes as the cursor is a prefix.
+        '''
+        keys_to_delete = set()
+        write_items = []   # A list of (key, value) pairs
+        write_size = 0
+        read_size = 0
+
+        key_len = HASHX_LEN + 4
+        cursor = (2**8)**4
         prior_hashX = None
         hist_map = {}
         hist_list = []
-
-        key_len = HASHX_LEN + 4
-        write_size = 0
-        for key, hist in self.db.iterator(prefix=prefix):
+        for key, hist in self.db.iterator(start=pack_be_uint32(self.comp_cursor)):
             # Ignore non-history entries
             if len(key) != key_len:
                 continue
@@ -298,30 +553,18 @@ class History(object):
                                                   keys_to_delete)
                 hist_map.clear()
                 hist_list.clear()
+                if read_size >= limit and hashX[:4] != prior_hashX[:4]:
+                    cursor, = unpack_be_uint32_from(hashX)
+                    prior_hashX = None
+                    break
             prior_hashX = hashX
             hist_map[key] = hist
             hist_list.append(hist)
+            read_size += len(hist)
 
         if prior_hashX:
             write_size += self._compact_hashX(prior_hashX, hist_map, hist_list,
                                               write_items, keys_to_delete)
-        return write_size
-
-    def _compact_history(self, limit):
-        '''Inner loop of history compaction.  Loops until limit bytes have
-        been processed.
-        '''
-        keys_to_delete = set()
-        write_items = []   # A list of (key, value) pairs
-        write_size = 0
-
-        # Loop over 2-byte prefixes
-        cursor = self.comp_cursor
-        while write_size < limit and cursor < (2**8)**4:  # 65536:
-            prefix = pack_be_uint32(cursor)
-            write_size += self._compact_prefix(prefix, write_items,
-                                               keys_to_delete)
-            cursor += 1
 
         max_rows = self.comp_flush_count + 1
         self._flush_compaction(cursor, write_items, keys_to_delete)
@@ -333,15 +576,51 @@ class History(object):
                                  100 * cursor / ((2**8)**4)))
         return write_size
 
-    def _cancel_compaction(self):
-        if self.comp_cursor != -1:
-            self.logger.warning('cancelling in-progress history compaction')
-            self.comp_flush_count = -1
-            self.comp_cursor = -1
-
     #
     # DB upgrade
     #
 
     def upgrade_db(self):
-        pass
\ No newline at end of file
+        self.logger.info(f'history DB version: {self.db_version}')
+        self.logger.info('Upgrading your history DB; this can take some time...')
+
+        if self.upgrade_cursor == -1:
+            self.upgrade_cursor = 0
+        while self.db_version != max(self.DB_VERSIONS):
+            self._upgrade_rows(UPGRADE_BATCH_SIZE)
+
+        self.logger.info('history DB upgraded successfully')
+
+    def _upgrade_rows(self, limit):
+        '''Rewrite version 0 rows as version 1 rows from the upgrade cursor
+        on until limit bytes have been read.  The cursor and rows are
+        written in one batch, so an interrupted upgrade resumes where it
+        stopped.'''
+        key_len = HASHX_LEN + 4
+        cursor = (2**8)**4
+        read_size = write_size = 0
+        prior_prefix = None
+        with self.db.write_batch() as batch:
+            for key, hist in self.db.iterator(start=pack_be_uint32(self.upgrade_cursor)):
+                # Ignore non-history entries
+                if len(key) != key_len:
+                    continue
+                if read_size >= limit and key[:4] != prior_prefix:
+                    cursor, = unpack_be_uint32_from(key)
+                    break
+                prior_prefix = key[:4]
+                row = encode_history(_unpack_tx_nums(hist))
+                batch.put(key, row)
+                read_size += len(hist)
+                write_size += len(row)
+
+            if cursor == (2**8)**4:
+                self.db_version = max(self.DB_VERSIONS)
+                self.upgrade_cursor = -1
+            else:
+                self.upgrade_cursor = cursor
+            self.write_state(batch)
+
+        self.logger.info(f'history DB upgrade: rewrote {read_size / 1000000:.1f} MB '
+                         f'as {write_size / 1000000:.1f} MB, '
+                         f'{100 * cursor / ((2**8)**4):.1f}% complete')
\ No newline at end of file
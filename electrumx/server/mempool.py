@@ -12,58 +12,18 @@ import os
 import time
 from abc import ABC, abstractmethod
 from collections import defaultdict
-from typing import Callable
 
 import attr
 from aiorpcx import TaskGroup, run_in_thread, sleep
 
 from electrumx.lib.addresses import public_key_to_address
+from electrumx.lib.assets import parse_script_asset, AssetError
 from electrumx.lib.hash import hash_to_hex_str, hex_str_to_hash
-from electrumx.lib.script import OpCodes, ScriptError, Script
+from electrumx.lib.script import classify_script, ScriptKind
 from electrumx.lib.util import class_logger, chunks, base_encode
 from electrumx.server.db import UTXO, ASSET
 
 
-class OPPushDataGeneric:
-    def __init__(self, pushlen: Callable = None):
-        if pushlen is not None:
-            self.check_data_len = pushlen
-
-    @classmethod
-    def check_data_len(cls, datalen: int) -> bool:
-        # Opcodes below OP_PUSHDATA4 all just push data onto stack, and are
-        return OpCodes.OP_PUSHDATA4 >= datalen >= 0
-
-    @classmethod
-    def is_instance(cls, item):
-        # accept objects that are instances of this class
-        # or other classes that are subclasses
-        return isinstance(item, cls) \
-               or (isinstance(item, type) and issubclass(item, cls))
-
-
-SCRIPTPUBKEY_TEMPLATE_P2PK = [OPPushDataGeneric(lambda x: x in (33, 65)), OpCodes.OP_CHECKSIG]
-
-
-# -1 if doesn't match, positive if does. Indicates index in script
-def match_script_against_template(script, template) -> int:
-    """Returns whether 'script' matches 'template'."""
-    if script is None:
-        return -1
-    if len(script) < len(template):
-        return -1
-    ctr = 0
-    for i in range(len(template)):
-        ctr += 1
-        template_item = template[i]
-        script_item = script[i]
-        if OPPushDataGeneric.is_instance(template_item) and template_item.check_data_len(script_item[0]):
-            continue
-        if template_item != script_item[0]:
-            return -1
-    return ctr
-
-
 @attr.s(slots=True)
 class MemPoolTx(object):
     prevouts = attr.ib()
@@ -125,7 +85,11 @@ class MemPoolAPI(ABC):
 
     @abstractmethod
     async def lookup_assets(self, prevouts):
-        pass
+        '''Return a list of (hashX, value, name) triples for each prevout if
+        an unspent asset output, otherwise None.
+
+        prevouts - an iterable of (hash, index) pairs
+        '''
 
     @abstractmethod
     async def on_mempool(self, touched, height):
@@ -303,53 +267,34 @@ class MemPool(object):
                 # mempool or it may have gotten in a block
                 if not raw_tx:
                     continue
-                tx, tx_size = deserializer(raw_tx).read_tx_and_vsize()
+                tx = deserializer(raw_tx).read_tx_view()
+                tx_size = tx.vsize()
                 # Convert the inputs and outputs into (hashX, value) pairs
                 # Drop generation-like inputs from MemPoolTx.prevouts
-                txin_pairs = tuple((txin.prev_hash, txin.prev_idx)
-                                   for txin in tx.inputs
-                                   if not txin.is_generation())
+                txin_pairs = tuple(tx.prevouts())
                 txout_tuple_list = []
-                for txout in tx.outputs:
-                    value = txout.value
-
+                for value, pk_script in tx.value_scripts():
                     # Every vout needs to be added for other methods to work properly
 
                     # Best effort for standard scripts
-                    ops = Script.get_ops(txout.pk_script)
-                    op_ptr = -1
-                    for i in range(len(ops)):
-                        op = ops[i][0]  # The OpCode
-                        if op == OpCodes.OP_RVN_ASSET:
-                            op_ptr = i
-                            break
-
-                    if op_ptr > 0:
-                        # This script has OP_RVN_ASSET. Use everything before this for the script hash.
-                        # Get the raw script bytes ending ptr from the previous opcode.
-                        script_hash_end = ops[op_ptr - 1][1]
-                        hashX = to_hashX(txout.pk_script[:script_hash_end])
+                    info = classify_script(pk_script)
+                    if info.kind == ScriptKind.P2PK:
+                        # Indexed as its P2PKH address, as by the block processor
+                        addr = public_key_to_address(info.data, self.coin.P2PKH_VERBYTE)
+                        hashX = self.coin.address_to_hashX(addr)
+                    elif info.kind == ScriptKind.PLAIN:
+                        # If the script has OP_RVN_ASSET, everything before it is hashed
+                        hashX = to_hashX(pk_script[:info.hash_end])
                     else:
-                        # There is no OP_RVN_ASSET. Hash as-is.
-                        hashX = to_hashX(txout.pk_script)
+                        hashX = to_hashX(pk_script)
 
                     # Best effort for standard asset portions
-                    if 0 < op_ptr < len(ops):
+                    if info.asset_start is not None:
                         try:
-                            next_op = ops[op_ptr + 1]
-                            asset_script = next_op[2]
-                            asset_deserializer = self.coin.DESERIALIZER(asset_script)
-                            asset_deserializer._read_byte()
-                            asset_deserializer._read_byte()
-                            asset_deserializer._read_byte()
-                            asset_type = asset_deserializer._read_byte()
-                            asset_name = asset_deserializer._read_varbytes()
-                            if asset_type == b'o'[0]:
-                                txout_tuple_list.append((hashX, 100_000_000, True, asset_name))
-                            else:
-                                value = asset_deserializer._read_le_int64()
-                                txout_tuple_list.append((hashX, value, True, asset_name))
-                        except:
+                            asset = parse_script_asset(pk_script, info.asset_start,
+                                                       info.asset_script)
+                            txout_tuple_list.append((hashX, asset.value, True, asset.name))
+                        except AssetError:
                             txout_tuple_list.append((hashX, value, False, None))
                     else:
                         txout_tuple_list.append((hashX, value, False, None))
@@ -371,15 +316,18 @@ class MemPool(object):
                          for prevout in tx.prevouts
                          if prevout[0] not in all_hashes)
 
-        utxos = []
-
-        for hX, v in await self.api.lookup_utxos(prevouts):
-            utxos.append((hX, v, False, None))
-
-        for hX, v, name in await self.api.lookup_assets(prevouts):
-            utxos.append((hX, v, True, name))
-
-        utxo_map = {prevout: utxo for prevout, utxo in zip(prevouts, utxos)}
+        utxo_map = {}
+        for prevout, utxo in zip(prevouts, await self.api.lookup_utxos(prevouts)):
+            if utxo:
+                hX, v = utxo
+                utxo_map[prevout] = (hX, v, False, None)
+
+        # Asset outputs have no value in the UTXO DB
+        prevouts = tuple(prevout for prevout in prevouts if prevout not in utxo_map)
+        for prevout, asset in zip(prevouts, await self.api.lookup_assets(prevouts)):
+            if asset:
+                hX, v, name = asset
+                utxo_map[prevout] = (hX, v, True, name)
 
         return self._accept_transactions(tx_map, utxo_map, touched)
 
@@ -294,7 +294,11 @@ class SessionManager:
         '''A summary of server state.'''
         cache_fmt = '{:,d} lookups {:,d} hits {:,d} entries'
         sessions = self.sessions
+        cache_sizes = self.bp.cache_sizes()
+        cache_sizes['flushing'] = self.bp.flushing_size
         return {
+            'asset filter': self.db.asset_filter_info(),
+            'block processor caches': cache_sizes,
             'coin': self.env.coin.__name__,
             'daemon': self.daemon.logged_url(),
             'daemon height': self.daemon.cached_height(),
@@ -781,17 +785,15 @@ class SessionManager:
             self._tx_hashes_hits += 1
             return tx_hashes, 0.1
 
-        # Ensure the tx_hashes are fresh before placing in the cache
-        while True:
-            reorg_count = self._reorg_count
-            try:
-                tx_hashes = await self.db.tx_hashes_at_blockheight(height)
-            except self.db.DBError as e:
-                raise RPCError(BAD_REQUEST, f'db error: {e!r}') from None
-            if reorg_count == self._reorg_count:
-                break
-
-        self._tx_hashes_cache[height] = tx_hashes
+        reorg_count = self._reorg_count
+        try:
+            tx_hashes = await self.db.tx_hashes_at_blockheight(height)
+        except self.db.DBError as e:
+            raise RPCError(BAD_REQUEST, f'db error: {e!r}') from None
+        # The hashes are consistent with the chain when read, but only cache
+        # them if the caches have not been cleared for a reorg since
+        if reorg_count == self._reorg_count:
+            self._tx_hashes_cache[height] = tx_hashes
 
         return tx_hashes, 0.25 + len(tx_hashes) * 0.0001
 
@@ -7,10 +7,14 @@
 
 '''Backend database abstraction.'''
 
+import heapq
 import os
+import time
 from functools import partial
+from operator import itemgetter
 
 from electrumx.lib import util
+from electrumx.lib.hash import HASHX_LEN
 
 
 def db_class(name):
@@ -25,16 +29,32 @@ def db_class(name):
 class Storage(object):
     '''Abstract base class of the DB backend abstraction.'''
 
+    # The most files a database keeps open when syncing and when serving
+    SYNC_MAX_OPEN_FILES = 512
+    SERVING_MAX_OPEN_FILES = 128
+
     def __init__(self, name, for_sync):
         self.is_new = not os.path.exists(name)
         self.for_sync = for_sync or self.is_new
+        self.max_open_files = (self.SYNC_MAX_OPEN_FILES if self.for_sync
+                               else self.SERVING_MAX_OPEN_FILES)
         self.open(name, create=self.is_new)
 
+    def set_for_sync(self, for_sync):
+        '''Switch between the sync and serving profiles without closing the
+        database, keeping its caches.  The open file limit cannot be
+        changed while open, so stays max_open_files.'''
+        self.for_sync = for_sync
+
     @classmethod
     def import_module(cls):
         '''Import the DB engine module.'''
         raise NotImplementedError
 
+    @classmethod
+    def configure(cls, env):
+        '''Apply the engine settings of env before any database is opened.'''
+
     def open(self, name, create):
         '''Open an existing database or create a new one.'''
         raise NotImplementedError
@@ -49,21 +69,52 @@ class Storage(object):
     def put(self, key, value):
         raise NotImplementedError
 
-    def write_batch(self):
+    def write_batch(self, sync=True):
         '''Return a context manager that provides `put` and `delete`.
 
         Changes should only be committed when the context manager
-        closes without an exception.
+        closes without an exception.  If sync is False the commit
+        need not be durable before returning.
         '''
         raise NotImplementedError
 
-    def iterator(self, prefix=b'', reverse=False):
+    def iterator(self, prefix=b'', reverse=False, start=None):
         '''Return an iterator that yields (key, value) pairs from the
         database sorted by key.
 
         If `prefix` is set, only keys starting with `prefix` will be
         included.  If `reverse` is True the items are returned in
-        reverse order.
+        reverse order.  If `start` is set iteration begins at the first
+        key not less than it; it cannot be used with `prefix` or
+        `reverse`.
+        '''
+        raise NotImplementedError
+
+    def snapshot(self):
+        '''Return a read-only view of the database as it is now, with get()
+        and iterator() as for the database.  It is released when no
+        longer referenced.'''
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        '''Return a list of the values of keys, in the same order, with None
+        for keys not in the database.
+
+        Keys are read in sorted order, which is faster than in random
+        order as neighbouring keys share blocks.
+        '''
+        get = self.get
+        values = [None] * len(keys)
+        for index in sorted(range(len(keys)), key=keys.__getitem__):
+            values[index] = get(keys[index])
+        return values
+
+    def iter_prefixes_many(self, prefixes):
+        '''Yield (prefix, key, value) triples for the keys starting with each
+        of prefixes, in key order.  Each distinct prefix is read once.
+
+        The prefixes are visited by seeking one iterator forward
+        rather than opening an iterator for each.
         '''
         raise NotImplementedError
 
@@ -79,23 +130,83 @@ class LevelDB(Storage):
         cls.module = plyvel
 
     def open(self, name, create):
-        mof = 512 if self.for_sync else 128
         # Use snappy compression (the default)
         self.db = self.module.DB(name, create_if_missing=create,
-                                 max_open_files=mof)
+                                 max_open_files=self.max_open_files)
         self.close = self.db.close
         self.get = self.db.get
         self.put = self.db.put
         self.iterator = self.db.iterator
+        self.snapshot = self.db.snapshot
         self.write_batch = partial(self.db.write_batch, transaction=True,
                                    sync=True)
 
+    def iter_prefixes_many(self, prefixes):
+        iterator = self.db.iterator()
+        for prefix in sorted(set(prefixes)):
+            iterator.seek(prefix)
+            for key, value in iterator:
+                if not key.startswith(prefix):
+                    break
+                yield prefix, key, value
+
 
 # pylint:disable=E1101
 
 
 class RocksDB(Storage):
-    '''RocksDB database engine.'''
+    '''RocksDB database engine.
+
+    The tables of a database, told apart by the first byte of their
+    keys, are kept in column families tuned to how they are read.  Keys
+    are stored unchanged, so iterating across families merges them back
+    into key order.
+
+    In a family with a prefix extractor, RocksDB only guarantees the keys
+    sharing the extracted prefix of a seek key at least as long as the
+    prefix.  Callers must not scan past it.  Iterators stop at the first
+    key without their prefix, so scans with a prefix that long never
+    leave it.  Shorter prefixes are outside the extractor's domain and
+    seek in total order.  Start keys must be shorter than any prefix
+    length, as iteration from them continues past their prefix.
+    '''
+
+    # Column families of each database: (name, first bytes of the keys it
+    # holds, prefix length, whole key filtering).  Keys of other first
+    # bytes go in the default family, which is listed first.  Bloom
+    # filters are built for prefixes of the given length, and for whole
+    # keys if set.
+    UTXO_FAMILIES = (
+        # Looked up by compressed tx hash, never by whole key
+        (b'h', b'h', 5, False),
+        # Read by hashX, and by whole key for mempool prevouts
+        (b'u', b'u', 1 + HASHX_LEN, True),
+    )
+    COLUMN_FAMILIES = {
+        'utxo': ((b'default', b'', None, True), ) + UTXO_FAMILIES + (
+            (b'undo', b'U', None, True),
+        ),
+        'asset': ((b'default', b'', None, True), ) + UTXO_FAMILIES + (
+            (b'undo', b'BFRTU', None, True),
+            # Tag, freeze and verifier state, read by whole key
+            (b'state', b'Qclrt', None, True),
+            # Tables listed by a length-prefixed asset name or h160.  Names
+            # are usually at least 3 bytes, so the prefix is within the name.
+            (b'lists', b'12abfp', 5, False),
+        ),
+        # History rows are read by hashX; the shorter state and journal
+        # keys are outside the prefix extractor's domain
+        'hist': ((b'default', b'', HASHX_LEN, False), ),
+    }
+    DEFAULT_FAMILIES = ((b'default', b'', None, True), )
+
+    # Keys moved to their column family per batch when migrating
+    MIGRATE_BATCH_SIZE = 100_000
+
+    # The block cache shared by all databases; set by configure()
+    block_cache = None
+    # If the bindings provide RocksDB's own fixed prefix extractor
+    prefix_extractors = True
 
     def __init__(self, *args):
         self.db = None
@@ -105,71 +216,222 @@ class RocksDB(Storage):
     def import_module(cls):
         import rocksdb    # pylint:disable=E0401
         cls.module = rocksdb
+        # Bindings that take a prefix length use RocksDB's own extractor.
+        # Extractors written in Python are not used: RocksDB calls them
+        # from background threads that need the GIL, so they are slow and
+        # deadlock with calls that wait on those threads holding it.
+        try:
+            rocksdb.ColumnFamilyOptions(prefix_extractor=1)
+        except TypeError:
+            cls.prefix_extractors = False
+
+    @classmethod
+    def configure(cls, env):
+        cls.block_cache = cls.module.LRUCache(env.rocksdb_block_cache_MB * 1024 * 1024)
+
+    def table_factory(self, whole_key_filtering):
+        return self.module.BlockBasedTableFactory(
+            filter_policy=self.module.BloomFilterPolicy(10),
+            block_cache=self.block_cache,
+            cache_index_and_filter_blocks=True,
+            whole_key_filtering=whole_key_filtering)
 
     def open(self, name, create):
-        mof = 512 if self.for_sync else 128
+        default, *families = self.COLUMN_FAMILIES.get(name, self.DEFAULT_FAMILIES)
+        _, _, prefix, whole_key_filtering = default
         # Use snappy compression (the default)
         options = self.module.Options(create_if_missing=create,
+                                      create_missing_column_families=True,
                                       use_fsync=True,
                                       target_file_size_base=33554432,
-                                      max_open_files=mof)
-        self.db = self.module.DB(name, options)
-        self.get = self.db.get
-        self.put = self.db.put
+                                      max_open_files=self.max_open_files,
+                                      table_factory=self.table_factory(whole_key_filtering))
+        if prefix and self.prefix_extractors:
+            options.prefix_extractor = prefix
+        column_families = {}
+        for family, _, prefix, whole_key_filtering in families:
+            family_options = self.module.ColumnFamilyOptions(
+                target_file_size_base=33554432,
+                table_factory=self.table_factory(whole_key_filtering))
+            if prefix and self.prefix_extractors:
+                family_options.prefix_extractor = prefix
+            column_families[family] = family_options
+        self.db = self.module.DB(name, options, column_families=column_families)
+
+        self.default_handle = self.db.get_column_family(b'default')
+        self.handles = []
+        # Maps of first key byte to column family handle, and of handle to
+        # the length of the prefixes extracted
+        self.routes = {}
+        self.prefix_lens = {}
+        for family, first_bytes, prefix, _ in [default] + families:
+            handle = self.db.get_column_family(family)
+            self.handles.append(handle)
+            for first_byte in first_bytes:
+                self.routes[bytes((first_byte, ))] = handle
+            if prefix and self.prefix_extractors:
+                self.prefix_lens[handle] = prefix
+        # Start keys must be shorter than this; see the class docstring
+        self.max_start_len = min(self.prefix_lens.values(), default=1024) - 1
+        if not create and self.routes:
+            self.migrate(name)
+
+    def migrate(self, name):
+        '''Move keys that earlier versions kept in the default column family
+        to their own.  Each batch is moved atomically, so an interrupted
+        migration continues where it left off.'''
+        logger = util.class_logger(__name__, self.__class__.__name__)
+        default = self.default_handle
+        count = 0
+        last = time.monotonic()
+        for first_byte, handle in self.routes.items():
+            while True:
+                iterator = self.db.iteritems(default)
+                iterator.seek(first_byte)
+                batch = self.module.WriteBatch()
+                moved = 0
+                for (_, key), value in iterator:
+                    if not key.startswith(first_byte) or moved == self.MIGRATE_BATCH_SIZE:
+                        break
+                    batch.put((handle, key), value)
+                    batch.delete((default, key))
+                    moved += 1
+                if not moved:
+                    break
+                if not count:
+                    logger.info(f'moving {name} DB keys to column families...')
+                self.db.write(batch, sync=True)
+                count += moved
+                if time.monotonic() > last + 10:
+                    logger.info(f'{name} DB: moved {count:,d} keys')
+                    last = time.monotonic()
+        if count:
+            logger.info(f'{name} DB: moved {count:,d} keys to column families')
 
     def close(self):
         # PyRocksDB doesn't provide a close method; hopefully this is enough
-        self.db = self.get = self.put = None
+        self.db = self.default_handle = self.handles = None
         import gc
         gc.collect()
 
-    def write_batch(self):
-        return RocksDBWriteBatch(self.db)
+    def handle(self, key):
+        '''The column family handle of key, or of keys with prefix key.'''
+        return self.routes.get(key[:1], self.default_handle)
 
-    def iterator(self, prefix=b'', reverse=False):
-        return RocksDBIterator(self.db, prefix, reverse)
+    def get(self, key, snapshot=None):
+        return self.db.get((self.handle(key), key), snapshot=snapshot)
+
+    def put(self, key, value):
+        self.db.put((self.handle(key), key), value)
+
+    def write_batch(self, sync=True):
+        return RocksDBWriteBatch(self, sync)
+
+    def iterator(self, prefix=b'', reverse=False, start=None, snapshot=None):
+        assert start is None or len(start) <= self.max_start_len
+        handles = [self.handle(prefix)] if prefix else self.handles
+        iterators = [RocksDBIterator(self.db, prefix, reverse, start, snapshot, handle,
+                                     self.prefix_lens.get(handle, 0))
+                     for handle in handles]
+        if len(iterators) == 1:
+            return iterators[0]
+        return heapq.merge(*iterators, key=itemgetter(0), reverse=reverse)
+
+    def snapshot(self):
+        return RocksDBSnapshot(self)
+
+    def get_many(self, keys):
+        handle = self.handle
+        keys = [(handle(key), key) for key in keys]
+        values = self.db.multi_get(keys)
+        return [values.get(key) for key in keys]
+
+    def iter_prefixes_many(self, prefixes):
+        iterators = {}
+        for prefix in sorted(set(prefixes)):
+            handle = self.handle(prefix)
+            iterator = iterators.get(handle)
+            if iterator is None:
+                iterator = iterators[handle] = self.db.iteritems(handle)
+            iterator.seek(prefix)
+            for (_, key), value in iterator:
+                if not key.startswith(prefix):
+                    break
+                yield prefix, key, value
 
 
 class RocksDBWriteBatch(object):
     '''A write batch for RocksDB.'''
 
-    def __init__(self, db):
+    def __init__(self, storage, sync):
         self.batch = RocksDB.module.WriteBatch()
-        self.db = db
+        self.storage = storage
+        self.sync = sync
 
     def __enter__(self):
-        return self.batch
+        return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if not exc_val:
-            self.db.write(self.batch)
+            self.storage.db.write(self.batch, sync=self.sync)
+
+    def put(self, key, value):
+        self.batch.put((self.storage.handle(key), key), value)
+
+    def delete(self, key):
+        self.batch.delete((self.storage.handle(key), key))
+
+
+class RocksDBSnapshot(object):
+    '''A snapshot of a RocksDB database.'''
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.snapshot = storage.db.snapshot()
+
+    def get(self, key):
+        return self.storage.get(key, snapshot=self.snapshot)
+
+    def iterator(self, prefix=b'', reverse=False, start=None):
+        return self.storage.iterator(prefix, reverse, start, self.snapshot)
 
 
 class RocksDBIterator(object):
-    '''An iterator for RocksDB.'''
+    '''An iterator for RocksDB over one column family.'''
 
-    def __init__(self, db, prefix, reverse):
+    def __init__(self, db, prefix, reverse, start, snapshot, handle, prefix_len):
         self.prefix = prefix
-        if reverse:
-            self.iterator = reversed(db.iteritems())
+        # A key before those with the prefix to pass over
+        self.skip = None
+        if start is not None:
+            self.iterator = db.iteritems(handle, snapshot=snapshot)
+            self.iterator.seek(start)
+        elif reverse:
+            self.iterator = reversed(db.iteritems(handle, snapshot=snapshot))
             nxt_prefix = util.increment_byte_string(prefix)
-            if nxt_prefix:
-                self.iterator.seek(nxt_prefix)
-                try:
-                    next(self.iterator)
-                except StopIteration:
-                    self.iterator.seek(nxt_prefix)
+            if prefix_len and len(prefix) >= prefix_len:
+                # Seek to the last key with the prefix.  The target shares
+                # the extracted prefix so prefix bloom filters still apply.
+                self.iterator.seek_for_prev(prefix + b'\xff' * 32)
+            elif nxt_prefix:
+                # Seek in total order, as a short target is outside the
+                # prefix extractor's domain
+                self.iterator.seek_for_prev(nxt_prefix)
+                self.skip = nxt_prefix
             else:
                 self.iterator.seek_to_last()
         else:
-            self.iterator = db.iteritems()
+            self.iterator = db.iteritems(handle, snapshot=snapshot)
             self.iterator.seek(prefix)
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        k, v = next(self.iterator)
+        (_, k), v = next(self.iterator)
         if not k.startswith(self.prefix):
-            raise StopIteration
+            if k != self.skip:
+                raise StopIteration
+            self.skip = None
+            return next(self)
         return k, v
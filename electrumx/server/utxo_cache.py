@@ -0,0 +1,251 @@
+# Copyright (c) 2021, the ElectrumX authors
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''In-memory caches of unflushed UTXOs and other DB writes that know
+the memory they take.'''
+
+import sys
+
+
+EMPTY_BYTES_SIZE = sys.getsizeof(b'')
+
+
+class UTXOCache:
+    '''A hash table of key_size-byte keys to values of at most value_size
+    bytes, with the dict methods the block processor and flushing use.
+
+    A dict of bytes objects spends about 200 bytes on a 36-byte key and
+    24-byte value, most of it object headers and hash table slots.
+    Here the entries of each bucket of a chained hash table are packed
+    one after another into a bytes object, and found with bytes.find(),
+    so an entry takes only its key and value sizes plus its share of
+    the bucket's header.  Buckets are small enough that replacing one
+    on every change is cheap, and unlike a bytearray a bytes object is
+    not over-allocated.  If not fixed, values are stored with a length
+    byte and padded; the rare values longer than value_size go in a
+    dict.
+
+    Keys must all be key_size bytes.
+    '''
+
+    # Average entries per bucket before the buckets are doubled
+    BUCKET_ENTRIES = 24
+
+    def __init__(self, key_size, value_size, fixed=True, capacity=0):
+        self.key_size = key_size
+        self.value_size = value_size
+        self.fixed = fixed
+        self.slot_size = key_size + value_size + (0 if fixed else 1)
+        self.count = 0
+        self.overflow = {}
+        self.overflow_size = 0
+        self.buckets = []
+        self._resize(max(capacity // self.BUCKET_ENTRIES, 64))
+
+    def _resize(self, bucket_count):
+        '''Redistribute the entries among bucket_count buckets.'''
+        old_buckets = self.buckets
+        old_count = len(old_buckets)
+        key_size, slot_size = self.key_size, self.slot_size
+        if bucket_count == old_count * 2:
+            # Old bucket n splits into buckets n and n + old_count.  Each is
+            # released once split, so the cache is never held twice over.
+            buckets = old_buckets
+            buckets.extend([b''] * old_count)
+            for n in range(old_count):
+                bucket = buckets[n]
+                buckets[n] = b''
+                low, high = [], []
+                for pos in range(0, len(bucket), slot_size):
+                    entry = bucket[pos:pos + slot_size]
+                    if hash(entry[:key_size]) % bucket_count == n:
+                        low.append(entry)
+                    else:
+                        high.append(entry)
+                del bucket
+                buckets[n] = b''.join(low)
+                buckets[n + old_count] = b''.join(high)
+        else:
+            parts = [[] for _ in range(bucket_count)]
+            for bucket in old_buckets:
+                for pos in range(0, len(bucket), slot_size):
+                    parts[hash(bucket[pos:pos + key_size]) % bucket_count].append(
+                        bucket[pos:pos + slot_size])
+            buckets = [b''.join(part) for part in parts]
+        self.buckets = buckets
+        self.grow_count = bucket_count * self.BUCKET_ENTRIES
+
+    def _find(self, bucket, key, pos):
+        '''Return the position of key in bucket, or -1, given that pos is the
+        first match of it.  Only a match at an entry's start counts.'''
+        while pos > 0 and pos % self.slot_size:
+            pos = bucket.find(key, pos + 1)
+        return pos
+
+    def _value(self, bucket, pos):
+        pos += self.key_size
+        if self.fixed:
+            return bucket[pos:pos + self.value_size]
+        return bucket[pos + 1:pos + 1 + bucket[pos]]
+
+    @property
+    def nbytes(self):
+        '''The memory allocated to the cache.'''
+        buckets = self.buckets
+        return (sys.getsizeof(buckets) + len(buckets) * EMPTY_BYTES_SIZE
+                + self.count * self.slot_size
+                + sys.getsizeof(self.overflow) + self.overflow_size)
+
+    def __len__(self):
+        return self.count + len(self.overflow)
+
+    def __contains__(self, key):
+        bucket = self.buckets[hash(key) % len(self.buckets)]
+        pos = bucket.find(key)
+        if pos >= 0 and pos % self.slot_size:
+            pos = self._find(bucket, key, pos)
+        return pos >= 0 or key in self.overflow
+
+    def __setitem__(self, key, value):
+        if len(value) != self.value_size and (self.fixed or len(value) > self.value_size):
+            if self.fixed:
+                raise ValueError(f'value of {len(value)} bytes in cache of '
+                                 f'{self.value_size}-byte values')
+            self.pop(key)
+            self.overflow[key] = value
+            self.overflow_size += sys.getsizeof(key) + sys.getsizeof(value)
+            return
+
+        buckets = self.buckets
+        n = hash(key) % len(buckets)
+        bucket = buckets[n]
+        if not self.fixed:
+            value = bytes((len(value), )) + value.ljust(self.value_size, b'\0')
+        pos = bucket.find(key)
+        if pos >= 0 and pos % self.slot_size:
+            pos = self._find(bucket, key, pos)
+        if pos >= 0:
+            pos += self.key_size
+            buckets[n] = b''.join((bucket[:pos], value, bucket[pos + len(value):]))
+            return
+
+        if self.overflow:
+            self._pop_overflow(key)
+        buckets[n] = b''.join((bucket, key, value))
+        self.count += 1
+        if self.count > self.grow_count:
+            self._resize(len(self.buckets) * 2)
+
+    def _pop_overflow(self, key):
+        value = self.overflow.pop(key, None)
+        if value is not None:
+            self.overflow_size -= sys.getsizeof(key) + sys.getsizeof(value)
+        return value
+
+    def get(self, key, default=None):
+        bucket = self.buckets[hash(key) % len(self.buckets)]
+        pos = bucket.find(key)
+        if pos >= 0 and pos % self.slot_size:
+            pos = self._find(bucket, key, pos)
+        if pos < 0:
+            return self.overflow.get(key, default) if self.overflow else default
+        return self._value(bucket, pos)
+
+    def pop(self, key, default=None):
+        buckets = self.buckets
+        n = hash(key) % len(buckets)
+        bucket = buckets[n]
+        pos = bucket.find(key)
+        if pos >= 0 and pos % self.slot_size:
+            pos = self._find(bucket, key, pos)
+        if pos < 0:
+            if self.overflow:
+                value = self._pop_overflow(key)
+                if value is not None:
+                    return value
+            return default
+        value = self._value(bucket, pos)
+        buckets[n] = bucket[:pos] + bucket[pos + self.slot_size:]
+        self.count -= 1
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __delitem__(self, key):
+        if self.pop(key) is None:
+            raise KeyError(key)
+
+    def items(self):
+        '''Yield (key, value) pairs in no particular order.'''
+        key_size, slot_size = self.key_size, self.slot_size
+        for bucket in self.buckets:
+            for pos in range(0, len(bucket), slot_size):
+                yield bucket[pos:pos + key_size], self._value(bucket, pos)
+        yield from self.overflow.items()
+
+    def keys(self):
+        return (key for key, _value in self.items())
+
+
+class SizedDict(dict):
+    '''A dict that keeps a running total of the sizes of its keys and
+    values, so the memory it takes is known without walking it.
+
+    Values are measured with sizeof, sys.getsizeof by default, when
+    added and removed, so must not change while in the dict.
+    '''
+
+    __slots__ = ('sizeof', 'item_size')
+
+    def __init__(self, sizeof=sys.getsizeof):
+        super().__init__()
+        self.sizeof = sizeof
+        self.item_size = 0
+
+    @property
+    def nbytes(self):
+        '''The memory allocated to the dict, its keys and values.'''
+        return sys.getsizeof(self) + self.item_size
+
+    def __setitem__(self, key, value):
+        if key in self:
+            self.item_size += self.sizeof(value) - self.sizeof(dict.__getitem__(self, key))
+        else:
+            self.item_size += sys.getsizeof(key) + self.sizeof(value)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def pop(self, key, *default):
+        if key in self:
+            value = dict.pop(self, key)
+            self.item_size -= sys.getsizeof(key) + self.sizeof(value)
+            return value
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self.item_size -= sys.getsizeof(key) + self.sizeof(value)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        dict.clear(self)
+        self.item_size = 0
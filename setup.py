@@ -16,6 +16,7 @@ setuptools.setup(
     python_requires='>=3.8',
     install_requires=requirements,
     extras_require={
+        'numpy': ['numpy>=1.17'],
         'rocksdb': ['python-rocksdb>=0.6.9'],
         'uvloop': ['uvloop>=0.14'],
     },
@@ -0,0 +1,129 @@
+import pytest
+
+from electrumx.lib.assets import (
+    parse_asset, parse_script_asset, parse_asset_tag, parse_asset_verifier, parse_asset_freeze,
+    parse_associations, pack_associations, AssetError, OwnerAsset, NewAsset, ReissueAsset,
+    TransferAsset, AssetTag, AssetVerifier, AssetFreeze, Association, OWNER_ASSET_VALUE
+)
+from electrumx.lib.script import classify_script, ScriptKind
+
+
+P2PKH = bytes.fromhex('76a914') + bytes(range(20)) + bytes.fromhex('88ac')
+IPFS = bytes.fromhex('1220') + bytes(range(32))
+
+
+def var_bytes(data):
+    return bytes([len(data)]) + data
+
+
+def asset_script(payload, drop=True):
+    push = var_bytes(payload) if len(payload) < 76 else b'\x4c' + var_bytes(payload)
+    return P2PKH + b'\xc0' + push + (b'\x75' if drop else b'')
+
+
+def payload(script_type, name, *parts):
+    return b'rvn' + script_type + var_bytes(name) + b''.join(parts)
+
+
+AMOUNT = (5 * 10**8).to_bytes(8, 'little')
+
+
+@pytest.mark.parametrize("data, asset", (
+    (payload(b'o', b'RAVEN!'), OwnerAsset(b'RAVEN!', OWNER_ASSET_VALUE)),
+    (payload(b'q', b'RAVEN', AMOUNT, b'\x00\x01\x00'), NewAsset(b'RAVEN', 5 * 10**8, 0, 1, 0, None)),
+    (payload(b'q', b'RAVEN', AMOUNT, b'\x08\x00\x01', IPFS),
+     NewAsset(b'RAVEN', 5 * 10**8, 8, 0, 1, IPFS)),
+    (payload(b'r', b'RAVEN', AMOUNT, b'\xff\x01'), ReissueAsset(b'RAVEN', 5 * 10**8, 255, 1, None)),
+    (payload(b'r', b'RAVEN', AMOUNT, b'\x02\x00', IPFS), ReissueAsset(b'RAVEN', 5 * 10**8, 2, 0, IPFS)),
+    (payload(b't', b'RAVEN', AMOUNT), TransferAsset(b'RAVEN', 5 * 10**8, None)),
+    (payload(b't', b'RAVEN~CHAN', AMOUNT, IPFS), TransferAsset(b'RAVEN~CHAN', 5 * 10**8, IPFS)),
+    (payload(b't', b'$RES', AMOUNT, IPFS, b'\x00' * 8), TransferAsset(b'$RES', 5 * 10**8, IPFS)),
+))
+def test_parse_asset(data, asset):
+    assert parse_asset(data) == asset
+    assert parse_asset(data, True) == asset
+    script = asset_script(data)
+    info = classify_script(script)
+    assert parse_script_asset(script, info.asset_start, info.asset_script) == asset
+
+
+@pytest.mark.parametrize("data", (
+    None,
+    b'',
+    b'rvt',
+    b'rvnt',
+    payload(b't', b''),
+    payload(b't', b'RAVEN')[:-1],
+    payload(b't', b'\xffRAVEN', AMOUNT),
+    payload(b'x', b'RAVEN', AMOUNT),
+    payload(b't', b'RAVEN', AMOUNT[:7]),
+    payload(b'q', b'RAVEN', AMOUNT, b'\x00\x01'),
+    payload(b'q', b'RAVEN', AMOUNT, b'\x00\x01\x01', IPFS[:-1]),
+    payload(b'r', b'RAVEN', AMOUNT, b'\x00'),
+))
+def test_parse_asset_bad(data):
+    with pytest.raises(AssetError):
+        parse_asset(data)
+
+
+def test_parse_asset_lenient():
+    data = payload(b'r', b'RAVEN', AMOUNT, b'\x00\x01', IPFS[:-1])
+    with pytest.raises(AssetError):
+        parse_asset(data)
+    assert parse_asset(data, True) == ReissueAsset(b'RAVEN', 5 * 10**8, 0, 1, None)
+    data = payload(b't', b'RAVEN~CHAN', AMOUNT, IPFS[:-1])
+    with pytest.raises(AssetError):
+        parse_asset(data)
+    assert parse_asset(data, True) == TransferAsset(b'RAVEN~CHAN', 5 * 10**8, None)
+
+
+def test_parse_script_asset_malformed():
+    # A push length that does not cover the payload; found from b'rvn'
+    data = payload(b't', b'RAVEN', AMOUNT)
+    script = P2PKH + b'\xc0' + bytes([len(data) + 5]) + data + b'\x75'
+    info = classify_script(script)
+    assert info.kind == ScriptKind.PLAIN and info.asset_script is None
+    assert parse_script_asset(script, info.asset_start, info.asset_script) == \
+        TransferAsset(b'RAVEN', 5 * 10**8, None)
+    # The lenient parse takes what follows as transfer data
+    data = payload(b't', b'RAVEN~CHAN', AMOUNT, IPFS[:-1])
+    script = asset_script(data)
+    info = classify_script(script)
+    assert parse_script_asset(script, info.asset_start, info.asset_script) == \
+        TransferAsset(b'RAVEN~CHAN', 5 * 10**8, IPFS[:-1] + b'\x75')
+
+    script = P2PKH + b'\xc0' + var_bytes(b'rv' + bytes(20))
+    info = classify_script(script)
+    with pytest.raises(AssetError):
+        parse_script_asset(script, info.asset_start, info.asset_script)
+
+
+def test_null_assets():
+    h160 = bytes(range(20))
+    assert parse_asset_tag(h160, var_bytes(b'#KYC') + b'\x01') == AssetTag(h160, b'#KYC', 1)
+    assert parse_asset_freeze(var_bytes(b'$RES') + b'\x00') == AssetFreeze(b'$RES', 0)
+    assert parse_asset_verifier(var_bytes(b'KYC&#ACCREDITED')) == \
+        AssetVerifier([b'#KYC', b'#ACCREDITED'])
+    assert parse_asset_verifier(var_bytes(b'true')) == AssetVerifier([b''])
+    for bad in (b'', var_bytes(b'#KYC'), var_bytes(b'#KY')[:-1]):
+        with pytest.raises(AssetError):
+            parse_asset_tag(h160, bad)
+        with pytest.raises(AssetError):
+            parse_asset_freeze(bad)
+    for bad in (b'', var_bytes(b'KYC&&AML'), var_bytes(b'kyc'), var_bytes(b'KYC')[:-1],
+                var_bytes(b'\xffKYC')):
+        with pytest.raises(AssetError):
+            parse_asset_verifier(bad)
+
+
+def test_associations():
+    idxs = bytes(range(13))
+    associations = [Association(b'#KYC', idxs, True), Association(b'#AML', bytes(13), False)]
+    data = pack_associations(associations)
+    assert data == (b'\x02' + var_bytes(b'#KYC') + idxs + b'\x01' +
+                    var_bytes(b'#AML') + bytes(13) + b'\x00')
+    assert parse_associations(data) == associations
+    assert parse_associations(pack_associations([])) == []
+    for bad in (b'', data[:-1], data[:-1] + b'\x02', b'\x01' + var_bytes(b'#KY')[:-1]):
+        with pytest.raises(AssetError):
+            parse_associations(bad)
@@ -1,6 +1,7 @@
 import pytest
 
-from electrumx.lib.script import OpCodes, is_unspendable_legacy, is_unspendable_genesis
+from electrumx.lib.script import OpCodes, is_unspendable_legacy, is_unspendable_genesis, \
+    classify_script, ScriptKind, _classify_ops
 
 
 @pytest.mark.parametrize("script, iug", (
@@ -24,3 +25,76 @@ def test_op_return_legacy(script, iug):
 def test_not_op_return(script):
     assert not is_unspendable_legacy(script)
     assert not is_unspendable_genesis(script)
+
+
+def _push(data):
+    if len(data) < OpCodes.OP_PUSHDATA1:
+        return bytes([len(data)]) + data
+    return bytes([OpCodes.OP_PUSHDATA1, len(data)]) + data
+
+
+def _classified_scripts():
+    h160 = bytes(range(20))
+    p2pkh = bytes([OpCodes.OP_DUP, OpCodes.OP_HASH160, 20]) + h160 + \
+        bytes([OpCodes.OP_EQUALVERIFY, OpCodes.OP_CHECKSIG])
+    p2sh = bytes([OpCodes.OP_HASH160, 20]) + h160 + bytes([OpCodes.OP_EQUAL])
+    asset = b'rvnt' + bytes([4]) + b'TEST' + bytes(8)
+    asset_op = bytes([OpCodes.OP_RVN_ASSET])
+    scripts = [
+        p2pkh, p2sh,
+        _push(bytes(33)) + bytes([OpCodes.OP_CHECKSIG]),
+        _push(bytes(65)) + bytes([OpCodes.OP_CHECKSIG]),
+        b'', bytes([OpCodes.OP_PUSHDATA1]),
+    ]
+    for data in (b'', asset, b'rvno' + bytes([4]) + b'TEST', bytes(80)):
+        for prefix in (p2pkh, p2sh):
+            scripts.append(prefix + asset_op + _push(data))
+            scripts.append(prefix + asset_op + _push(data) + bytes([OpCodes.OP_DROP]))
+        # Raw data and 'rvn' ops after OP_RVN_ASSET
+        scripts.append(p2pkh + asset_op + bytes([len(asset)]) + asset)
+        scripts.append(p2pkh + asset_op + _push(data)[:-1])
+        scripts.append(asset_op + bytes([20]) + h160 + _push(data))
+        scripts.append(asset_op + bytes([OpCodes.OP_RESERVED]) + _push(data))
+        scripts.append(asset_op + bytes([OpCodes.OP_RESERVED, OpCodes.OP_RESERVED]) + _push(data))
+    scripts.append(asset_op)
+    scripts.append(asset_op + bytes([OpCodes.OP_DROP]))
+    scripts.append(p2pkh + asset_op)
+    scripts.append(p2pkh + asset_op + bytes([OpCodes.OP_DROP]))
+    return scripts
+
+
+def test_classify_script():
+    '''classify_script() recognises the common forms from their bytes; check
+    it agrees with classifying any script from its ops.'''
+    scripts = _classified_scripts()
+    # Truncations, extensions and single byte changes
+    for script in list(scripts):
+        for n in range(len(script)):
+            scripts.append(script[:n])
+            for byte in (0, OpCodes.OP_DROP, OpCodes.OP_RVN_ASSET, OpCodes.OP_RESERVED, 255):
+                scripts.append(script[:n] + bytes([byte]) + script[n + 1:])
+        scripts.append(script + bytes([OpCodes.OP_DROP]))
+        scripts.append(script + bytes([OpCodes.OP_1]))
+    for script in scripts:
+        assert classify_script(script) == _classify_ops(script), script.hex()
+    # Empty and unparseable scripts are invalid rather than raising
+    for script in (b'', bytes([OpCodes.OP_PUSHDATA1])):
+        assert classify_script(script).kind == ScriptKind.INVALID
+    p2pk = _push(bytes(33)) + bytes([OpCodes.OP_CHECKSIG])
+    assert classify_script(p2pk + bytes([OpCodes.OP_DROP])) == \
+        (ScriptKind.P2PK, 36, None, None, bytes(33))
+
+
+def test_classify_script_kinds():
+    scripts = _classified_scripts()
+    p2pkh, p2sh, p2pk = scripts[:3]
+    assert classify_script(p2pkh) == (ScriptKind.PLAIN, 25, None, None, None)
+    assert classify_script(p2sh) == (ScriptKind.PLAIN, 23, None, None, None)
+    assert classify_script(p2pk) == (ScriptKind.P2PK, 35, None, None, bytes(33))
+    asset = b'rvnt' + bytes([4]) + b'TEST' + bytes(8)
+    script = p2pkh + bytes([OpCodes.OP_RVN_ASSET]) + _push(asset) + bytes([OpCodes.OP_DROP])
+    assert classify_script(script) == (ScriptKind.PLAIN, 25, 26, asset, None)
+    script = bytes([OpCodes.OP_RVN_ASSET, 20]) + bytes(20) + _push(b'tag')
+    assert classify_script(script) == (ScriptKind.NULL_TAG, len(script), None, b'tag', bytes(20))
+    assert classify_script(bytes([OpCodes.OP_PUSHDATA1])).kind == ScriptKind.INVALID
+    assert classify_script(bytes([OpCodes.OP_RVN_ASSET])).kind == ScriptKind.NULL_BAD
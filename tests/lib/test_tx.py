@@ -35,3 +35,19 @@ def test_tx_serialiazation():
         deser = tx_lib.Deserializer(test)
         tx = deser.read_tx()
         assert tx.serialize() == test
+
+
+def test_tx_view():
+    for test in tests:
+        test = bytes.fromhex(test)
+        tx, tx_hash = tx_lib.Deserializer(test).read_tx_and_hash()
+        for deserializer in (tx_lib.Deserializer, tx_lib.DeserializerSegWit):
+            view = deserializer(test).read_tx_view()
+            assert view.tx_hash() == tx_hash
+            assert view.vsize() == len(test)
+            assert (view.version, view.inputs, view.outputs, view.locktime) == tx
+            assert view.prevouts() == tx.prevouts()
+            assert view.value_scripts() == tx.value_scripts()
+            start, end = view.pk_script_span(1)
+            assert test[start:end] == tx.outputs[1].pk_script
+            assert view.value(1) == tx.outputs[1].value
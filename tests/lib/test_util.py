@@ -107,6 +107,38 @@ def test_LogicalFile(tmpdir):
     L.write(0, b'957' * 6)
     assert L.read(0, -1) == b'957' * 6
 
+
+def test_MappedLogicalFile(tmpdir):
+    prefix = os.path.join(tmpdir, 'log')
+    L = util.MappedLogicalFile(prefix, 2, 6)
+    assert L.read(0, -1) == b''
+    assert L.read(3, 2) == b''
+
+    L.write(0, b'987')
+    assert L.read(0, -1) == b'987'
+    assert L.read(0, 4) == b'987'
+    assert L.read(1, 1) == b'8'
+
+    # Appends extend the maps; overwrites are seen without remapping
+    L.write(3, b'6543210')
+    assert L.read(0, -1) == b'9876543210'
+    L.write(1, b'xy')
+    assert L.read(0, 4) == b'9xy6'
+    assert L.read(5, -1) == b'43210'
+    with util.open_file(prefix + '01') as f:
+        assert f.read(-1) == b'3210'
+
+    # Test file boundary
+    L.write(0, b'957' * 6)
+    assert L.read(0, -1) == b'957' * 6
+    assert L.read(4, 5) == b'57957'
+
+    # A plain LogicalFile sees the same data
+    assert util.LogicalFile(prefix, 2, 6).read(0, -1) == b'957' * 6
+    L.close()
+    assert L.read(0, -1) == b'957' * 6
+
+
 def test_open_fns(tmpdir):
     tmpfile = os.path.join(tmpdir, 'file1')
     with pytest.raises(FileNotFoundError):
@@ -216,3 +248,19 @@ def test_pack_varbytes():
         data = util.pack_varbytes(test)
         deser = tx.Deserializer(data)
         assert deser._read_varbytes() == test
+
+
+def test_BloomFilter():
+    bloom = util.BloomFilter(1000)
+    items = [os.urandom(8) for _ in range(1000)]
+    for item in items:
+        bloom.add(item)
+    assert bloom.count == 1000
+    assert all(item in bloom for item in items)
+    false_positives = sum(os.urandom(8) in bloom for _ in range(10000))
+    assert false_positives < 300
+
+    copy = util.BloomFilter(1000, bytearray(bloom.bits), bloom.count)
+    assert all(item in copy for item in items)
+    with pytest.raises(AssertionError):
+        util.BloomFilter(2000, bloom.bits)
@@ -0,0 +1,151 @@
+import asyncio
+import os
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from electrumx.lib.hash import double_sha256, hash_to_hex_str
+from electrumx.lib.util import pack_le_uint32
+from electrumx.server.block_files import BlockFiles
+from electrumx.server.block_processor import Prefetcher
+
+MAGIC = bytes.fromhex('5241564e')
+
+
+def make_chain(count):
+    blocks = []
+    prev_hash = bytes(32)
+    for _ in range(count):
+        header = pack_le_uint32(1) + prev_hash + os.urandom(44)
+        blocks.append(header + os.urandom(random.randrange(100, 2000)))
+        prev_hash = double_sha256(header)
+    return blocks
+
+
+def stale_sibling(block):
+    return block[:36] + os.urandom(44) + block[80:]
+
+
+def write_block_files(blocks_dir, blocks, per_file, preallocate=0):
+    '''Write the blocks in blk*.dat files as the daemon does.'''
+    for file_num in range(0, (len(blocks) + per_file - 1) // per_file):
+        records = [MAGIC + pack_le_uint32(len(block)) + block
+                   for block in blocks[file_num * per_file: (file_num + 1) * per_file]]
+        with open(os.path.join(blocks_dir, f'blk{file_num:05d}.dat'), 'wb') as f:
+            f.write(b''.join(records) + bytes(preallocate))
+
+
+def received_order(chain):
+    '''Return the chain's blocks shuffled a little, with some stale blocks.'''
+    blocks = list(chain)
+    for n in range(0, len(blocks) - 8, 8):
+        window = blocks[n: n + 8]
+        random.shuffle(window)
+        blocks[n: n + 8] = window
+    for n in range(5, len(chain), 17):
+        blocks.insert(blocks.index(chain[n]) + random.choice((0, 1)), stale_sibling(chain[n]))
+    return blocks
+
+
+def test_read_blocks(tmpdir):
+    chain = make_chain(200)
+    write_block_files(tmpdir, received_order(chain), 30, preallocate=1000)
+    block_files = BlockFiles(tmpdir)
+
+    headers = [block[:80] for block in chain]
+    for n in range(0, len(chain), 25):
+        assert block_files.read_blocks(headers[n: n + 25]) == chain[n: n + 25]
+    # Only stale blocks are left indexed
+    assert len(block_files.index) == len(range(5, len(chain), 17))
+
+    # An unknown block
+    assert block_files.read_blocks([stale_sibling(chain[10])[:80]]) is None
+    block_files.close()
+
+
+def test_read_blocks_being_written(tmpdir):
+    chain = make_chain(50)
+    write_block_files(tmpdir, chain[:20], 100)
+    path = os.path.join(tmpdir, 'blk00000.dat')
+    block_files = BlockFiles(tmpdir)
+    headers = [block[:80] for block in chain]
+    assert block_files.read_blocks(headers[:20]) == chain[:20]
+    assert block_files.read_blocks(headers[20:21]) is None
+
+    # Half a record, then the rest
+    record = MAGIC + pack_le_uint32(len(chain[20])) + chain[20]
+    with open(path, 'ab') as f:
+        f.write(record[:50])
+    assert block_files.read_blocks(headers[20:21]) is None
+    with open(path, 'ab') as f:
+        f.write(record[50:])
+    assert block_files.read_blocks(headers[20:21]) == chain[20:21]
+
+    # The daemon moves on to the next file
+    with open(os.path.join(tmpdir, 'blk00001.dat'), 'wb') as f:
+        f.write(b''.join(MAGIC + pack_le_uint32(len(block)) + block for block in chain[21:]))
+    assert block_files.read_blocks(headers[21:]) == chain[21:]
+    block_files.close()
+
+
+class FilesDaemon:
+    '''Serves the headers of a chain, and its blocks over RPC.'''
+
+    urls = ['url']
+
+    def __init__(self, chain):
+        self.chain = chain
+        self.hashes = [hash_to_hex_str(double_sha256(block[:80])) for block in chain]
+        self.heights = {hex_hash: height for height, hex_hash in enumerate(self.hashes)}
+        self.served = []
+
+    def current_url(self):
+        return self.urls[0]
+
+    async def height(self):
+        return len(self.chain) - 1
+
+    async def block_hex_hashes(self, first, count):
+        return self.hashes[first: first + count]
+
+    async def block_headers(self, hex_hashes):
+        return [self.chain[self.heights[hex_hash]][:80] for hex_hash in hex_hashes]
+
+    async def raw_blocks(self, hex_hashes, url=None):
+        self.served.extend(self.heights[hex_hash] for hex_hash in hex_hashes)
+        return [self.chain[self.heights[hex_hash]] for hex_hash in hex_hashes]
+
+
+async def prefetch_all(prefetcher, count):
+    blocks = []
+    task = asyncio.ensure_future(prefetcher.main_loop(-1))
+    try:
+        while len(blocks) < count:
+            await prefetcher.blocks_event.wait()
+            prefetcher.blocks_event.clear()
+            blocks.extend(prefetcher.get_prefetched_blocks())
+    finally:
+        task.cancel()
+    return blocks
+
+
+@pytest.mark.parametrize("files_count", [500, 300])
+@pytest.mark.asyncio
+async def test_prefetcher_block_files(tmpdir, files_count):
+    chain = make_chain(500)
+    # The block files lack later blocks if the daemon was pruned or is behind
+    write_block_files(tmpdir, received_order(chain[:files_count]), 40)
+    daemon = FilesDaemon(chain)
+    coin = SimpleNamespace(max_fetch_blocks=lambda height: 50,
+                           genesis_block=lambda block: block)
+    prefetcher = Prefetcher(daemon, coin, asyncio.Event(), BlockFiles(tmpdir), 20)
+    prefetcher.min_cache_size = prefetcher.target_cache_size = 20_000
+    prefetcher.ave_size = 1000
+
+    assert await prefetch_all(prefetcher, len(chain)) == chain
+    assert prefetcher.block_files is None
+    # The last blocks are fetched over RPC, and those missing from the files
+    assert min(daemon.served) <= min(files_count, len(chain) - 20)
+    assert min(daemon.served) > min(files_count, len(chain) - 20) - 50
+    assert max(daemon.served) == len(chain) - 1
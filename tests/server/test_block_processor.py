@@ -0,0 +1,389 @@
+import asyncio
+import os
+import random
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from electrumx.lib.coins import Coin
+from electrumx.lib.hash import double_sha256
+from electrumx.lib.tx import DeserializerSegWit, TxView
+from electrumx.lib.util import BloomFilter, pack_le_int32, pack_le_int64, pack_le_uint32, \
+    pack_varbytes, pack_varint
+from electrumx.server.block_processor import BlockDeserializer, BlockProcessor, Prefetcher
+from electrumx.server.daemon import DaemonError
+from electrumx.server.db import DB
+
+
+class SegWitCoin(Coin):
+    DESERIALIZER = DeserializerSegWit
+
+
+def random_tx(n_inputs, n_outputs, segwit=False):
+    parts = [pack_le_int32(2)]
+    if segwit:
+        parts.append(b'\0\1')
+    parts.append(pack_varint(n_inputs))
+    for _ in range(n_inputs):
+        parts.append(os.urandom(32) + pack_le_uint32(1) + pack_varbytes(os.urandom(107))
+                     + pack_le_uint32(0xffffffff))
+    parts.append(pack_varint(n_outputs))
+    for n in range(n_outputs):
+        script = b'\x76\xa9\x14' + os.urandom(20) + b'\x88\xac'
+        parts.append(pack_le_int64(n * 1000) + pack_varbytes(script))
+    if segwit:
+        for _ in range(n_inputs):
+            parts.append(pack_varint(2) + pack_varbytes(os.urandom(72))
+                         + pack_varbytes(os.urandom(33)))
+    parts.append(pack_le_uint32(0))
+    return b''.join(parts)
+
+
+def random_block(prev_hash):
+    txs = [random_tx(n % 3 + 1, n % 4 + 1, segwit=bool(n % 2)) for n in range(20)]
+    header = pack_le_int32(1) + prev_hash + os.urandom(44)
+    return header + pack_varint(len(txs)) + b''.join(txs)
+
+
+async def deserialize_all(deserializer, raw_blocks):
+    return [pair async for pair in deserializer.blocks(raw_blocks, 100)]
+
+
+@pytest.mark.asyncio
+async def test_block_deserializer_matches_in_process():
+    raw_blocks = []
+    prev_hash = bytes(32)
+    for _ in range(5):
+        raw_blocks.append(random_block(prev_hash))
+        prev_hash = double_sha256(raw_blocks[-1][:80])
+
+    def contents(result):
+        return [(block.raw, block.header, header_hash,
+                 [(tx.inputs, tx.outputs, tx.prevouts(), tx.value_scripts(), tx_hash)
+                  for tx, tx_hash in block.transactions])
+                for block, header_hash in result]
+
+    expected = [(SegWitCoin.block(raw_block, 100 + n), SegWitCoin.header_hash(raw_block[:80]))
+                for n, raw_block in enumerate(raw_blocks)]
+    expected = contents(expected)
+
+    in_process = BlockDeserializer(SegWitCoin, 0)
+    in_process.start()
+    assert contents(await deserialize_all(in_process, raw_blocks)) == expected
+    assert in_process.tx_count == 100
+
+    pooled = BlockDeserializer(SegWitCoin, 2)
+    pooled.start()
+    try:
+        result = await deserialize_all(pooled, raw_blocks)
+    finally:
+        pooled.shutdown()
+    assert contents(result) == expected
+    for block, _ in result:
+        for tx, _ in block.transactions:
+            assert isinstance(tx, TxView) and tx.raw is block.raw
+    assert pooled.tx_count == 100
+    assert pooled.wait_time > 0
+
+
+@pytest.mark.asyncio
+async def test_block_deserializer_early_stop():
+    raw_blocks = [random_block(bytes(32)) for _ in range(4)]
+    pooled = BlockDeserializer(SegWitCoin, 2)
+    pooled.start()
+    try:
+        blocks = pooled.blocks(raw_blocks, 0)
+        async for block, _ in blocks:
+            assert block.raw == raw_blocks[0]
+            break
+        await blocks.aclose()
+        assert pooled.tx_count == 20
+    finally:
+        pooled.shutdown()
+
+
+class MemoryStorage:
+    def __init__(self, items):
+        self.items = dict(items)
+
+    def get(self, key):
+        return self.items.get(key)
+
+    def iterator(self, prefix=b''):
+        return iter(sorted((key, value) for key, value in self.items.items()
+                           if key.startswith(prefix)))
+
+
+class SpendDB:
+    asset_outpoint_may_exist = DB.asset_outpoint_may_exist
+
+    def __init__(self, utxos, assets, tx_hashes):
+        self.utxo_db = MemoryStorage(utxos)
+        self.asset_db = MemoryStorage(assets)
+        self.tx_hashes = tx_hashes
+        self.asset_filter = BloomFilter(100)
+        for key in assets:
+            if key[:1] == b'h':
+                self.asset_filter.add(key[1:9])
+        self.asset_filter_probes = 0
+        self.asset_filter_passes = 0
+        self.asset_filter_false_positives = 0
+
+    def fs_tx_hash(self, tx_num):
+        return self.tx_hashes[tx_num], 0
+
+
+def spend_processor(block):
+    '''Return a block processor with the outputs spent by block on disk, two of
+    which share a compressed tx hash and one of which is an asset.'''
+    utxos, assets, tx_hashes = {}, {}, []
+    for tx, _tx_hash in block.transactions:
+        for txin in tx.inputs:
+            tx_hashes.append(txin.prev_hash)
+    tx_hashes.append(tx_hashes[0][:4] + bytes(28))
+    for tx_num, prev_hash in enumerate(tx_hashes):
+        suffix = pack_le_uint32(1) + pack_le_int64(tx_num)[:5]
+        hashX = prev_hash[4:15]
+        utxos[b'h' + prev_hash[:4] + suffix] = hashX
+        utxos[b'u' + hashX + suffix] = pack_le_int64(tx_num + 1)
+        if tx_num == 1:
+            assets[b'h' + prev_hash[:4] + suffix] = hashX
+            assets[b'u' + hashX + suffix] = pack_le_int64(5) + b'\x04NAME'
+
+    bp = BlockProcessor.__new__(BlockProcessor)
+    bp.db = SpendDB(utxos, assets, tx_hashes)
+    bp.utxo_cache, bp.asset_cache = {}, {}
+    bp.db_deletes, bp.asset_deletes = [], []
+    bp.prefetched_utxos, bp.prefetched_assets = {}, {}
+    bp.flushing = None
+    return bp
+
+
+def spend_all(bp, block):
+    spends = []
+    for tx, _tx_hash in block.transactions:
+        for txin in tx.inputs:
+            spends.append((bp.spend_utxo(txin.prev_hash, txin.prev_idx),
+                           bp.spend_asset(txin.prev_hash, txin.prev_idx)))
+    return spends
+
+
+@pytest.mark.asyncio
+async def test_prefetched_spends_match_lookups():
+    block = SegWitCoin.block(random_block(bytes(32)), 0)
+    bp = spend_processor(block)
+    expected = spend_all(bp, block)
+    assert expected[0][0][-8:] == pack_le_int64(1)
+    assert expected[1][1].endswith(b'\x04NAME')
+    assert sum(asset is not None for _utxo, asset in expected) == 1
+    # Only the asset spend and rare false positives reach the asset DB
+    assert bp.db.asset_filter_probes == len(expected)
+    assert bp.db.asset_filter_passes == 1 + bp.db.asset_filter_false_positives
+
+    bp = spend_processor(block)
+    first_tx = block.transactions[0][0]
+    cached_key = first_tx.inputs[0].prev_hash + pack_le_uint32(first_tx.inputs[0].prev_idx)
+    bp.utxo_cache[cached_key] = b'cached'
+    bp.prefetched_utxos, bp.prefetched_assets = await bp._prefetch_spends(block, None)
+    assert len(bp.prefetched_utxos) == len(expected) - 1
+    assert cached_key not in bp.prefetched_utxos
+    del bp.utxo_cache[cached_key]
+    assert spend_all(bp, block) == expected
+    assert not bp.prefetched_utxos and not bp.prefetched_assets
+    assert len(bp.db_deletes) == 2 * len(expected)
+
+    # Outputs created by the block advanced before it are not looked up
+    prior = SimpleNamespace(transactions=[(None, tx_hash) for tx_hash in bp.db.tx_hashes])
+    assert bp._prefetch_spends(block, prior) is None
+
+
+def test_spends_from_flush_in_progress():
+    block = SegWitCoin.block(random_block(bytes(32)), 0)
+    bp = spend_processor(block)
+    expected = spend_all(bp, block)
+
+    # The same outputs in a flush not yet committed spend the same and are
+    # deleted from the DB by the next flush
+    adds, asset_adds = {}, {}
+    for (tx, _tx_hash) in block.transactions:
+        for txin in tx.inputs:
+            key = txin.prev_hash + pack_le_uint32(txin.prev_idx)
+            utxo, asset = expected[len(adds)]
+            adds[key] = utxo
+            if asset:
+                asset_adds[key] = asset[36:]
+    flushing = spend_processor(block)
+    flushing.db.utxo_db.items.clear()
+    flushing.db.asset_db.items.clear()
+    flushing.flushing = SimpleNamespace(adds=adds, asset_adds=asset_adds)
+    assert spend_all(flushing, block) == expected
+    assert sorted(flushing.db_deletes) == sorted(bp.db_deletes)
+    assert sorted(flushing.asset_deletes) == sorted(bp.asset_deletes)
+    assert len(adds) == len(expected) and len(asset_adds) == 1
+
+
+@pytest.mark.asyncio
+async def test_release_flush():
+    bp = BlockProcessor.__new__(BlockProcessor)
+    loop = asyncio.get_event_loop()
+    bp.flushing, bp.flushing_size = SimpleNamespace(adds={}), 100
+    bp.flush_future = loop.create_future()
+    # Kept while the commit is in flight, and released once it completes
+    await bp.release_flush()
+    assert bp.flushing and bp.flushing_size == 100
+    bp.flush_future.set_result(None)
+    await bp.release_flush()
+    assert bp.flushing is None and bp.flush_future is None and bp.flushing_size == 0
+    await bp.release_flush()
+
+    bp.flush_future = loop.create_future()
+    bp.flush_future.set_exception(OSError('disk full'))
+    with pytest.raises(OSError):
+        await bp.release_flush()
+
+
+def test_check_cache_size_counts_flushing():
+    one_MB = 1000 * 1000
+    bp = BlockProcessor.__new__(BlockProcessor)
+    bp.logger = SimpleNamespace(info=lambda msg: None, debug=lambda msg: None)
+    bp.env = SimpleNamespace(cache_MB=1000)
+    bp.db = SimpleNamespace(checkpoint_due=lambda: False)
+    bp.daemon = SimpleNamespace(cached_height=lambda: 200)
+    bp.deserializer = SimpleNamespace(tx_count=0, wait_time=0.0, processes=0, executor=None)
+    bp.advance_time, bp.last_rate_report = 0.0, (0, 0.0, 0.0)
+    bp.height = 100
+    sizes = {'utxos': 600 * one_MB, 'utxo deletes': 0, 'history': 50 * one_MB,
+             'tx hashes': 0}
+    bp.cache_sizes = lambda: dict(sizes)
+    bp.flushing_size = 0
+    assert bp.check_cache_size() is None
+    # A flush in progress counts towards the UTXOs until committed
+    bp.flushing_size = 400 * one_MB
+    assert bp.check_cache_size() is True
+    bp.flushing_size = 0
+    sizes['history'] = 250 * one_MB
+    assert bp.check_cache_size() is False
+
+
+def test_check_cache_size_checkpoint():
+    one_MB = 1000 * 1000
+    bp = BlockProcessor.__new__(BlockProcessor)
+    bp.logger = SimpleNamespace(info=lambda msg: None)
+    bp.env = SimpleNamespace(cache_MB=1000)
+    bp.daemon = SimpleNamespace(cached_height=lambda: 200)
+    bp.deserializer = SimpleNamespace(tx_count=0, wait_time=0.0, processes=0, executor=None)
+    bp.advance_time, bp.last_rate_report = 0.0, (0, 0.0, 0.0)
+    bp.height = 100
+    sizes = {'utxos': 10 * one_MB, 'utxo deletes': 0, 'history': 10 * one_MB,
+             'tx hashes': 0}
+    bp.cache_sizes = lambda: dict(sizes)
+    bp.flushing_size = 0
+    db = bp.db = DB.__new__(DB)
+    db.env = SimpleNamespace(checkpoint_flushes=4, checkpoint_secs=600)
+    db.history = SimpleNamespace(flush_count=7)
+    db.utxo_flush_count = 4
+    db.last_checkpoint = time.time()
+    assert bp.check_cache_size() is None
+
+    # A due checkpoint flushes the UTXOs however small the caches
+    db.history.flush_count = 8
+    assert bp.check_cache_size() is True
+    db.utxo_flush_count = 8
+    assert bp.check_cache_size() is None
+    db.last_checkpoint -= 600
+    assert bp.check_cache_size() is True
+    # Even when only the history would otherwise be flushed
+    db.last_checkpoint = time.time()
+    sizes['history'] = 250 * one_MB
+    assert bp.check_cache_size() is False
+    db.history.flush_count = 12
+    assert bp.check_cache_size() is True
+
+
+def test_log_sync_rate():
+    bp = BlockProcessor.__new__(BlockProcessor)
+    messages = []
+    bp.logger = SimpleNamespace(info=messages.append)
+    bp.deserializer = SimpleNamespace(tx_count=0, wait_time=0.0, processes=4, executor=None)
+    bp.advance_time, bp.last_rate_report = 0.0, (0, 0.0, 0.0)
+    bp.log_sync_rate()
+    assert not messages
+
+    # The rate is over the time advancing blocks since the last report
+    bp.deserializer.tx_count, bp.deserializer.wait_time = 30_000, 4.0
+    bp.advance_time = 10.0
+    bp.log_sync_rate()
+    assert messages.pop() == ('processed 30,000 txs in 10.0s, 3,000 tx/s '
+                              '(deserializing in-process; 4.0s of it deserializing)')
+    bp.deserializer.executor = object()
+    bp.deserializer.tx_count, bp.deserializer.wait_time = 80_000, 4.5
+    bp.advance_time = 20.0
+    bp.log_sync_rate()
+    assert messages.pop() == ('processed 50,000 txs in 10.0s, 5,000 tx/s '
+                              '(4 deserializer processes; 0.5s of it deserializing)')
+
+
+class MultiDaemon:
+    '''Serves blocks from two URLs, one of them slow and one missing the
+    last blocks.'''
+
+    urls = ['fast', 'slow']
+
+    def __init__(self, height):
+        self._height = height
+        self.blocks = [os.urandom(random.randrange(1000, 50000)) for _ in range(height + 1)]
+        self.served = {url: 0 for url in self.urls}
+
+    def current_url(self):
+        return self.urls[0]
+
+    async def height(self):
+        return self._height
+
+    async def block_hex_hashes(self, first, count):
+        return [str(height) for height in range(first, first + count)]
+
+    async def raw_blocks(self, hex_hashes, url=None):
+        url = url or self.current_url()
+        if url == 'slow':
+            if int(hex_hashes[-1]) > self._height - 5:
+                raise DaemonError('block not found')
+            await asyncio.sleep(0.002)
+        await asyncio.sleep(0.001 * random.random())
+        self.served[url] += len(hex_hashes)
+        return [self.blocks[int(hex_hash)] for hex_hash in hex_hashes]
+
+
+@pytest.mark.asyncio
+async def test_prefetcher_multiple_daemons():
+    daemon = MultiDaemon(2000)
+    coin = SimpleNamespace(max_fetch_blocks=lambda height: 100,
+                           genesis_block=lambda block: block)
+    blocks_event = asyncio.Event()
+    prefetcher = Prefetcher(daemon, coin, blocks_event)
+    prefetcher.min_cache_size = 200_000
+    prefetcher.target_cache_size = prefetcher.min_cache_size
+    prefetcher.ave_size = 20_000
+
+    # Blocks taken as soon as they arrive grow the target
+    blocks = []
+    task = asyncio.ensure_future(prefetcher.main_loop(-1))
+    try:
+        while len(blocks) < len(daemon.blocks):
+            await blocks_event.wait()
+            blocks_event.clear()
+            blocks.extend(prefetcher.get_prefetched_blocks())
+    finally:
+        task.cancel()
+    assert blocks == daemon.blocks
+    assert prefetcher.caught_up
+    assert prefetcher.target_cache_size > prefetcher.min_cache_size
+    assert all(count > 100 for count in daemon.served.values())
+
+    # Blocks taken from a full cache shrink it
+    prefetcher.caught_up = False
+    target = prefetcher.target_cache_size
+    prefetcher.cache_size = target
+    prefetcher.get_prefetched_blocks()
+    assert prefetcher.target_cache_size < target
@@ -6,9 +6,10 @@ import random
 from os import environ, urandom
 
 from electrumx.lib.hash import HASHX_LEN
-from electrumx.lib.util import pack_be_uint16, pack_le_uint64
+from electrumx.lib.util import pack_be_uint32
 from electrumx.server.db import DB
 from electrumx.server.env import Env
+from electrumx.server.history import encode_history
 
 
 def create_histories(history, hashX_count=100):
@@ -17,15 +18,13 @@ def create_histories(history, hashX_count=100):
     hashXs = [urandom(HASHX_LEN) for n in range(hashX_count)]
     mk_array = lambda : array.array('Q')
     histories = {hashX : mk_array() for hashX in hashXs}
-    unflushed = history.unflushed
     tx_num = 0
     while hashXs:
-        tx_numb = pack_le_uint64(tx_num)[:5]
         hash_indexes = set(random.randrange(len(hashXs))
                            for n in range(1 + random.randrange(4)))
         for index in hash_indexes:
             histories[hashXs[index]].append(tx_num)
-            unflushed[hashXs[index]].extend(tx_numb)
+        history.add_unflushed([[hashXs[index] for index in hash_indexes]], tx_num)
 
         tx_num += 1
         # Occasionally flush and drop a random hashX if non-empty
@@ -40,8 +39,12 @@ def create_histories(history, hashX_count=100):
 
 def check_hashX_compaction(history):
     history.max_hist_row_entries = 40
-    row_size = history.max_hist_row_entries * 5
-    full_hist = b''.join(pack_le_uint64(tx_num)[:5] for tx_num in range(100))
+    history.flush_count = 56
+    row_entries = history.max_hist_row_entries
+    tx_nums = [tx_num * 1000 for tx_num in range(100)]
+    full_hist = encode_history(tx_nums)
+    rows = [encode_history(tx_nums[n * row_entries: (n + 1) * row_entries])
+            for n in range(3)]
     hashX = urandom(HASHX_LEN)
     pairs = ((1, 20), (26, 50), (56, 30))
 
@@ -49,8 +52,8 @@ def check_hashX_compaction(history):
     hist_list = []
     hist_map = {}
     for flush_count, count in pairs:
-        key = hashX + pack_be_uint16(flush_count)
-        hist = full_hist[cum * 5: (cum+count) * 5]
+        key = hashX + pack_be_uint32(flush_count)
+        hist = encode_history(tx_nums[cum: cum + count])
         hist_map[key] = hist
         hist_list.append(hist)
         cum += count
@@ -60,15 +63,14 @@ def check_hashX_compaction(history):
     write_size = history._compact_hashX(hashX, hist_map, hist_list,
                                         write_items, keys_to_delete)
     # Check results for sanity
-    assert write_size == len(full_hist)
+    assert write_size == sum(len(row) for row in rows)
     assert len(write_items) == 3
     assert len(keys_to_delete) == 3
     assert len(hist_map) == len(pairs)
     for n, item in enumerate(write_items):
-        assert item == (hashX + pack_be_uint16(n),
-                        full_hist[n * row_size: (n + 1) * row_size])
+        assert item == (hashX + pack_be_uint32(n), rows[n])
     for flush_count, count in pairs:
-        assert hashX + pack_be_uint16(flush_count) in keys_to_delete
+        assert hashX + pack_be_uint32(flush_count) in keys_to_delete
 
     # Check re-compaction is null
     hist_map = {key: value for key, value in write_items}
@@ -83,19 +85,29 @@ def check_hashX_compaction(history):
     assert len(hist_map) == len(pairs)
 
     # Check re-compaction adding a single tx writes the one row
-    hist_list[-1] += array.array('I', [100]).tobytes()
+    hist_list[-1] = encode_history(tx_nums[2 * row_entries:] + [100000])
     write_size = history._compact_hashX(hashX, hist_map, hist_list,
                                         write_items, keys_to_delete)
     assert write_size == len(hist_list[-1])
-    assert write_items == [(hashX + pack_be_uint16(2), hist_list[-1])]
+    assert write_items == [(hashX + pack_be_uint32(2), hist_list[-1])]
     assert len(keys_to_delete) == 1
     assert write_items[0][0] in keys_to_delete
     assert len(hist_map) == len(pairs)
 
+    # Rows numbered above the flush count are not written
+    history.flush_count = 1
+    write_items.clear()
+    keys_to_delete.clear()
+    hist_map = {hashX + pack_be_uint32(56): full_hist}
+    assert history._compact_hashX(hashX, hist_map, [full_hist],
+                                  write_items, keys_to_delete) == 0
+    assert not write_items and not keys_to_delete
+    history.max_hist_row_entries = 12500
+
 
 def check_written(history, histories):
     for hashX, hist in histories.items():
-        db_hist = array.array('I', history.get_txnums(hashX, limit=None))
+        db_hist = array.array('Q', history.get_txnums(hashX, limit=None))
         assert hist == db_hist
 
 def compact_history(history):
@@ -110,11 +122,30 @@ def compact_history(history):
         write_size += history._compact_history(limit)
     assert write_size != 0
 
+
+def compact_history_with_flushes(history, histories):
+    '''Compact the DB history in small batches with flushes between them.'''
+    history.start_compaction()
+    hashXs = list(histories)
+    tx_num = max(max(hist) for hist in histories.values() if hist) + 1
+    while history.comp_cursor != -1:
+        history._compact_history(1000)
+        hashX = random.choice(hashXs)
+        histories[hashX].append(tx_num)
+        history.add_unflushed([[hashX]], tx_num)
+        history.flush()
+        tx_num += 1
+
+
+def key_count(history):
+    return sum(1 for _ in history.db.iterator())
+
+
 async def run_test(db_dir):
     environ.clear()
     environ['DB_DIRECTORY'] = db_dir
     environ['DAEMON_URL'] = ''
-    environ['COIN'] = 'BitcoinSV'
+    environ['COIN'] = 'Ravencoin'
     db = DB(Env())
     await db.open_for_serving()
     history = db.history
@@ -126,9 +157,20 @@ async def run_test(db_dir):
     check_written(history, histories)
     compact_history(history)
     check_written(history, histories)
+    # Compact with flushes during the compaction.  The flush count is not reset.
+    histories.update(create_histories(history))
+    compact_history_with_flushes(history, histories)
+    assert history.flush_count > 1
+    check_written(history, histories)
+    # Without flushes during it, a compaction leaves a row per hashX, besides the
+    # state, and resets the flush count
+    compact_history(history)
+    check_written(history, histories)
+    assert history.flush_count == 1
+    assert key_count(history) == len(histories) + 1
+
 
 def test_compaction(tmpdir):
     db_dir = str(tmpdir)
     print('Temp dir: {}'.format(db_dir))
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(run_test(db_dir))
+    asyncio.run(run_test(db_dir))
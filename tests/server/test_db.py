@@ -0,0 +1,371 @@
+import array
+import ast
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pytest
+
+from electrumx.lib.coins import Coin
+from electrumx.lib.hash import double_sha256
+from electrumx.lib.merkle import Merkle, MerkleCache
+from electrumx.lib.util import MappedLogicalFile
+from electrumx.server import db as db_module
+from electrumx.server.db import DB
+
+
+def make_db(tmpdir, block_tx_counts, flushed_height):
+    db = DB.__new__(DB)
+    db.TX_HASHES_READ_GAP = 4
+    db.tx_counts = array.array('Q')
+    tx_count = 0
+    for count in block_tx_counts:
+        tx_count += count
+        db.tx_counts.append(tx_count)
+    db.db_height = flushed_height
+    db.tx_counts_array = None
+    db.backup_count = 0
+    db.hashes_file = MappedLogicalFile(os.path.join(tmpdir, 'hashes'), 4, 1000)
+    db.hashes_file.write(0, os.urandom(db.tx_counts[flushed_height] * 32))
+    return db
+
+
+@pytest.mark.parametrize("use_numpy", [False, True])
+def test_fs_tx_hashes(tmpdir, monkeypatch, use_numpy):
+    if use_numpy:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(db_module, 'numpy', None)
+
+    db = make_db(tmpdir, [random.randrange(1, 20) for _ in range(200)], 180)
+    assert db.fs_tx_hashes([]) == []
+
+    tx_nums = [random.randrange(db.tx_counts[-1]) for _ in range(500)]
+    tx_nums += [0, db.tx_counts[0], db.tx_counts[180] - 1, db.tx_counts[180]]
+    result = db.fs_tx_hashes(tx_nums)
+    assert result == [db.fs_tx_hash(tx_num) for tx_num in tx_nums]
+    assert any(tx_hash is None for tx_hash, _height in result)
+
+    # Flushed blocks extend any cached copy of tx_counts
+    cached = db.tx_counts_array
+    db.hashes_file.write(db.tx_counts[180] * 32,
+                         os.urandom((db.tx_counts[190] - db.tx_counts[180]) * 32))
+    db.db_height = 190
+    assert db.fs_tx_hashes(tx_nums) == [db.fs_tx_hash(tx_num) for tx_num in tx_nums]
+    if use_numpy:
+        assert db.tx_counts_array[1] is cached[1]
+        assert db.tx_counts_array[2] == 191
+    db.db_height = 180
+
+    # A reorg invalidates any cached copy of tx_counts
+    db.hashes_file.write(db.tx_counts[180] * 32, os.urandom(32))
+    db.tx_counts[180] += 1
+    db.backup_count += 1
+    assert db.fs_tx_hashes(tx_nums) == [db.fs_tx_hash(tx_num) for tx_num in tx_nums]
+
+
+class MemoryStorage:
+    def __init__(self, items):
+        self.items = dict(items)
+
+    def iterator(self, prefix=b''):
+        return iter(sorted((key, value) for key, value in self.items.items()
+                           if key.startswith(prefix)))
+
+
+def test_asset_filter_snapshot(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    os.mkdir('meta')
+    h_keys = [b'h' + os.urandom(13) for _ in range(100)]
+    db = DB.__new__(DB)
+    db.logger = logging.getLogger('test')
+    db.asset_db = MemoryStorage({key: bytes(11) for key in h_keys})
+    db.asset_flush_count = 3
+
+    db.open_asset_filter()
+    assert db.asset_filter.count == 100
+    assert all(key[1:9] in db.asset_filter for key in h_keys)
+    assert os.path.exists(DB.ASSET_FILTER_FILE)
+
+    # The snapshot is loaded, not rebuilt, if it matches the DB
+    extra = os.urandom(8)
+    db.asset_filter.add(extra)
+    db.asset_filter_stale = 7
+    db.write_asset_filter()
+    db.asset_filter = None
+    db.open_asset_filter()
+    assert db.asset_filter.count == 101 and db.asset_filter_stale == 7
+    assert extra in db.asset_filter
+
+    # A snapshot from another asset DB commit is rebuilt
+    db.asset_flush_count = 4
+    db.open_asset_filter()
+    assert db.asset_filter.count == 100 and db.asset_filter_stale == 0
+    assert all(key[1:9] in db.asset_filter for key in h_keys)
+
+    # As is one with too many stale entries
+    db.asset_filter_stale = 60
+    db.write_asset_filter()
+    assert db.asset_filter_stale == 0
+
+
+class CountingCoin(Coin):
+    hashed = []
+
+    @classmethod
+    def header_hash(cls, header):
+        cls.hashed.append(header)
+        return double_sha256(header)
+
+
+def make_fs_db(tmpdir):
+    db = DB.__new__(DB)
+    db.logger = logging.getLogger('test')
+    db.coin = CountingCoin
+    CountingCoin.hashed.clear()
+    db.header_offset = CountingCoin.static_header_offset
+    db.header_len = CountingCoin.static_header_len
+    db.utxo_db = SimpleNamespace(for_sync=False)
+    db.db_height = db.fs_height = -1
+    db.fs_tx_count = db.fs_asset_count = 0
+    db.backup_count = 0
+    db.tx_counts = array.array('Q')
+    db.headers_file = MappedLogicalFile(os.path.join(tmpdir, 'headers'), 2, 1000)
+    db.tx_counts_file = MappedLogicalFile(os.path.join(tmpdir, 'txcounts'), 2, 1000)
+    db.hashes_file = MappedLogicalFile(os.path.join(tmpdir, 'hashes'), 2, 1000)
+    reopen_block_hashes(db, tmpdir)
+    db.header_mc = MerkleCache(Merkle(), db.fs_block_hashes)
+    return db
+
+
+def reopen_block_hashes(db, tmpdir, keep=None):
+    '''Reopen the block hashes file as a restart would, first truncating
+    it to keep hashes if keep is not None.'''
+    prefix = os.path.join(tmpdir, 'blockhashes')
+    if keep is not None:
+        hashes = db.block_hashes_file.read(0, keep * 32)
+        for name in os.listdir(tmpdir):
+            if name.startswith('blockhashes'):
+                os.remove(os.path.join(tmpdir, name))
+        MappedLogicalFile(prefix, 2, 320).write(0, hashes)
+    db.block_hashes_file = MappedLogicalFile(prefix, 2, 320)
+
+
+def flush_headers(db, headers):
+    '''Flush headers, one tx per block, as the block processor would.'''
+    for _ in headers:
+        db.tx_counts.append(len(db.tx_counts) + 1)
+    height = db.fs_height + len(headers)
+    flush_data = SimpleNamespace(
+        height=height, tx_count=height + 1, asset_count=0, headers=list(headers),
+        block_hashes=[double_sha256(header) for header in headers],
+        block_tx_hashes=[os.urandom(32) for _ in headers])
+    db.flush_fs(flush_data)
+    db.db_height = height
+
+
+@pytest.mark.asyncio
+async def test_flush_fs_block_hashes(tmpdir):
+    db = make_fs_db(tmpdir)
+    headers = [os.urandom(80) for _ in range(25)]
+    flush_headers(db, headers[:10])
+    flush_headers(db, headers[10:])
+    assert not CountingCoin.hashed
+
+    # The block hashes are appended in height order
+    hashes = [double_sha256(header) for header in headers]
+    assert db.block_hashes_file.read(0) == b''.join(hashes)
+    assert await db.fs_block_hashes(0, 25) == hashes
+    assert await db.fs_block_hashes(7, 5) == hashes[7:12]
+    for height, count in ((-1, 2), (20, 6), (25, 1)):
+        with pytest.raises(DB.DBError):
+            await db.fs_block_hashes(height, count)
+
+    await db.header_mc.initialize(25)
+    assert await db.header_mc.branch_and_root(25, 17) == Merkle().branch_and_root(hashes, 17)
+
+
+def test_backfill_block_hashes(tmpdir):
+    db = make_fs_db(tmpdir)
+    headers = [os.urandom(80) for _ in range(30)]
+    flush_headers(db, headers)
+    hashes = b''.join(double_sha256(header) for header in headers)
+
+    # A DB that stopped backfilling part way only hashes the missing tail
+    reopen_block_hashes(db, tmpdir, keep=12)
+    CountingCoin.hashed.clear()
+    db._backfill_block_hashes()
+    assert CountingCoin.hashed == headers[12:]
+    assert db.block_hashes_file.read(0) == hashes
+
+    # Once complete nothing is hashed
+    CountingCoin.hashed.clear()
+    reopen_block_hashes(db, tmpdir)
+    db._backfill_block_hashes()
+    assert not CountingCoin.hashed
+
+    # An old DB hashes every header
+    reopen_block_hashes(db, tmpdir, keep=0)
+    db._backfill_block_hashes()
+    assert CountingCoin.hashed == headers
+    assert db.block_hashes_file.read(0) == hashes
+
+
+@pytest.mark.asyncio
+async def test_block_hashes_after_reorg(tmpdir):
+    db = make_fs_db(tmpdir)
+    headers = [os.urandom(80) for _ in range(20)]
+    flush_headers(db, headers)
+    await db.header_mc.initialize(20)
+
+    # Back up 6 blocks; their hashes stay in the file past db_height
+    db.backup_fs(13, 14, 0)
+    db.db_height = 13
+    del db.tx_counts[14:]
+    with pytest.raises(DB.DBError):
+        await db.fs_block_hashes(14, 1)
+    CountingCoin.hashed.clear()
+    db._backfill_block_hashes()
+    assert not CountingCoin.hashed
+
+    # The new chain overwrites the stale entries
+    headers[14:] = [os.urandom(80) for _ in range(8)]
+    flush_headers(db, headers[14:])
+    hashes = [double_sha256(header) for header in headers]
+    assert db.block_hashes_file.read(0) == b''.join(hashes)
+    assert await db.fs_block_hashes(0, 22) == hashes
+    assert await db.header_mc.branch_and_root(22, 15) == Merkle().branch_and_root(hashes, 15)
+
+
+class RecordingStorage:
+    '''Records its commits in log as (name, sync) tuples.'''
+
+    def __init__(self, name, log, for_sync):
+        self.name = name
+        self.log = log
+        self.for_sync = for_sync
+        self.items = {}
+
+    def put(self, key, value):
+        self.items[key] = value
+
+    @contextmanager
+    def write_batch(self, sync=True):
+        batch = {}
+        yield SimpleNamespace(put=batch.__setitem__, delete=lambda key: None)
+        # Only reached if the batch is not abandoned on an exception
+        self.items.update(batch)
+        self.log.append((self.name, sync))
+
+
+def make_flush_db(log, for_sync=True, delays=(0, 0, 0), fail=None):
+    '''Return a DB whose flush_dbs() commits the history, asset and asset
+    info DBs after the given delays, logging (name, sync) for each.  The
+    one named fail raises instead.'''
+    db = DB.__new__(DB)
+    db.logger = logging.getLogger('test')
+    db.coin = Coin
+    db.env = SimpleNamespace(reorg_limit=10, checkpoint_flushes=0, checkpoint_secs=0)
+    db.flush_executor = ThreadPoolExecutor(max_workers=3)
+    db.utxo_db = RecordingStorage('utxo', log, for_sync)
+    db.history = SimpleNamespace(flush_count=0)
+    db.db_height, db.db_tx_count, db.db_tip = 100, 100, bytes(32)
+    db.fs_tx_count = db.last_flush_tx_count = db.last_flush_asset_count = 0
+    db.utxo_flush_count = 0
+    db.first_sync, db.db_version = True, max(DB.DB_VERSIONS)
+    db.last_flush = db.last_checkpoint = time.time() - 10
+    db.wall_time = 10
+
+    def commit(name, delay, sync_arg):
+        def func(*args):
+            time.sleep(delay)
+            if name == fail:
+                raise OSError(f'{name} commit failed')
+            if name == 'history':
+                db.history.flush_count += 1
+            log.append((name, None if sync_arg is None else args[sync_arg]))
+        return func
+
+    db.flush_history = commit('history', delays[0], 1)
+    db.commit_asset_db = commit('asset', delays[1], 2)
+    db.commit_asset_info_db = commit('asset_info', delays[2], None)
+    db.flush_fs = lambda flush_data: log.append(('fs', None))
+
+    def flush_utxo_db(batch, flush_data, stale_heights):
+        batch.put(b'u', b'')
+        db.db_height = flush_data.height
+    db.flush_utxo_db = flush_utxo_db
+    db.refresh_read_view = lambda: log.append(('read view', None))
+    return db
+
+
+def flush(db, flush_utxos):
+    height = db.db_height + 5
+    flush_data = SimpleNamespace(height=height, tx_count=height, asset_count=0, history=None)
+    db.flush_dbs(flush_data, flush_utxos, lambda: 1000)
+
+
+def test_checkpoint_due():
+    db = make_flush_db([])
+    assert not db.checkpoint_due()
+
+    db.env.checkpoint_flushes = 3
+    db.history.flush_count = 2
+    assert not db.checkpoint_due()
+    db.history.flush_count = 3
+    assert db.checkpoint_due()
+    db.utxo_flush_count = 1
+    assert not db.checkpoint_due()
+
+    db.env.checkpoint_secs = 60
+    assert not db.checkpoint_due()
+    db.last_checkpoint = time.time() - 60
+    assert db.checkpoint_due()
+
+
+@pytest.mark.parametrize("for_sync, flush_utxos, sync", [
+    (True, False, False), (True, True, True), (False, False, True), (False, True, True)])
+def test_flush_dbs_sync(for_sync, flush_utxos, sync):
+    log = []
+    db = make_flush_db(log, for_sync)
+    db.env.checkpoint_secs = 5
+    assert db.checkpoint_due()
+    flush(db, flush_utxos)
+    # Only a flush without UTXOs while syncing skips syncing to disk
+    assert ('history', sync) in log and ('asset', sync) in log and ('utxo', sync) in log
+
+    state = ast.literal_eval(db.utxo_db.items[b'state'].decode())
+    assert state['height'] == (105 if flush_utxos else 100)
+    assert state['utxo_flush_count'] == (1 if flush_utxos else 0)
+    # A UTXO flush is a checkpoint
+    assert db.checkpoint_due() is not flush_utxos
+
+
+@pytest.mark.parametrize("fail", ['history', 'asset', 'asset_info'])
+def test_flush_dbs_failed_commit(fail):
+    log = []
+    db = make_flush_db(log, delays=(0.02, 0.04, 0.01), fail=fail)
+    last_checkpoint = db.last_checkpoint
+    with pytest.raises(OSError):
+        flush(db, True)
+    # The other DBs are committed, but neither the UTXOs nor the state are
+    assert {name for name, _sync in log} == {'fs', 'history', 'asset', 'asset_info'} - {fail}
+    assert not db.utxo_db.items
+    assert db.utxo_flush_count == 0 and db.last_checkpoint == last_checkpoint
+
+
+def test_flush_dbs_commits_utxos_last():
+    log = []
+    # The UTXO batch is built at once, so each commit finishes after it
+    db = make_flush_db(log, delays=(0.05, 0.1, 0.02))
+    flush(db, True)
+    names = [name for name, _sync in log]
+    assert names[0] == 'fs'
+    assert set(names[1:4]) == {'history', 'asset', 'asset_info'}
+    assert names[4:] == ['utxo', 'read view']
+    state = ast.literal_eval(db.utxo_db.items[b'state'].decode())
+    assert state['height'] == 105 and state['utxo_flush_count'] == 1
@@ -16,7 +16,7 @@ BASE_DB_DIR = '/some/dir'
 base_environ = {
     'DB_DIRECTORY': BASE_DB_DIR,
     'DAEMON_URL': BASE_DAEMON_URL,
-    'COIN': 'BitcoinSV',
+    'COIN': 'Ravencoin',
 }
 
 
@@ -85,17 +85,25 @@ def test_DAEMON_URL():
     assert e.daemon_url == BASE_DAEMON_URL
 
 
+def test_DAEMON_REST():
+    assert_boolean('DAEMON_REST', 'daemon_rest', False)
+
+
+def test_DAEMON_BLOCKS_DIR():
+    assert_default('DAEMON_BLOCKS_DIR', 'daemon_blocks_dir', None)
+
+
 def test_COIN_NET():
     '''Test COIN and NET defaults and redirection.'''
     setup_base_env()
     e = Env()
-    assert e.coin == lib_coins.BitcoinSV
+    assert e.coin == lib_coins.Ravencoin
     os.environ['NET'] = 'testnet'
     e = Env()
-    assert e.coin == lib_coins.BitcoinSVTestnet
+    assert e.coin == lib_coins.RavencoinTestnet
     os.environ['NET'] = ' testnet '
     e = Env()
-    assert e.coin == lib_coins.BitcoinSVTestnet
+    assert e.coin == lib_coins.RavencoinTestnet
 
 
 def test_CACHE_MB():
@@ -227,7 +235,19 @@ def test_REPORT_SERVICES_localhost():
 
 def test_REORG_LIMIT():
     assert_integer('REORG_LIMIT', 'reorg_limit',
-                   lib_coins.BitcoinSV.REORG_LIMIT)
+                   lib_coins.Ravencoin.REORG_LIMIT)
+
+
+def test_CHECKPOINT_FLUSHES():
+    assert_integer('CHECKPOINT_FLUSHES', 'checkpoint_flushes', 0)
+
+
+def test_CHECKPOINT_SECS():
+    assert_integer('CHECKPOINT_SECS', 'checkpoint_secs', 3600)
+
+
+def test_HISTORY_COMPACTION_HOURS():
+    assert_integer('HISTORY_COMPACTION_HOURS', 'history_compaction_hours', 24)
 
 
 def test_COST_HARD_LIMIT():
@@ -258,8 +278,12 @@ def test_DB_ENGINE():
     assert_default('DB_ENGINE', 'db_engine', 'leveldb')
 
 
+def test_ROCKSDB_BLOCK_CACHE_MB():
+    assert_integer('ROCKSDB_BLOCK_CACHE_MB', 'rocksdb_block_cache_MB', 256)
+
+
 def test_MAX_SEND():
-    assert_integer('MAX_SEND', 'max_send', 1000000)
+    assert_integer('MAX_SEND', 'max_send', lib_coins.Ravencoin.DEFAULT_MAX_SEND)
 
 
 def test_LOG_LEVEL():
@@ -361,5 +385,5 @@ def test_ban_versions():
 
 
 def test_coin_class_provided():
-    e = Env(lib_coins.BitcoinSV)
-    assert e.coin == lib_coins.BitcoinSV
+    e = Env(lib_coins.Ravencoin)
+    assert e.coin == lib_coins.Ravencoin
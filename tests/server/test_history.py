@@ -0,0 +1,136 @@
+import random
+from collections import defaultdict
+from os import urandom
+
+import pytest
+
+from electrumx.lib.hash import HASHX_LEN
+from electrumx.lib.util import pack_be_uint32, pack_le_uint64
+import electrumx.server.history as history_module
+from electrumx.server.history import History, encode_history, decode_history
+from electrumx.server.storage import db_class
+
+
+@pytest.mark.parametrize("use_numpy", [False, True])
+@pytest.mark.parametrize("tx_count", [10, 5000])
+def test_unflushed_rows(monkeypatch, use_numpy, tx_count):
+    if use_numpy:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(history_module, 'numpy', None)
+    hashXs = [urandom(HASHX_LEN) for _ in range(200)]
+    # Some share a prefix longer than that sorted on first
+    hashXs.extend(hashXs[0][:9] + urandom(HASHX_LEN - 9) for _ in range(5))
+    hashXs.append(hashXs[0][:-1] + bytes([hashXs[0][-1] ^ 1]))
+    hashXs_by_tx = [[random.choice(hashXs) for _ in range(random.randrange(1, 5))]
+                    for _ in range(tx_count)]
+
+    expected = defaultdict(list)
+    for tx_num, tx_hashXs in enumerate(hashXs_by_tx, start=1000):
+        for hashX in set(tx_hashXs):
+            expected[hashX].append(tx_num)
+
+    history = History()
+    history.add_unflushed(hashXs_by_tx[:tx_count // 2], 1000)
+    history.add_unflushed(hashXs_by_tx[tx_count // 2:], 1000 + tx_count // 2)
+    unflushed = history.take_unflushed()
+    assert not history.unflushed
+    assert len(unflushed) == sum(len(hist) for hist in expected.values())
+    assert unflushed.nbytes >= len(unflushed) * (HASHX_LEN + 5)
+    assert unflushed.rows() == sorted((hashX, encode_history(hist))
+                                      for hashX, hist in expected.items())
+
+
+def test_encode_history():
+    assert encode_history([]) == b''
+    assert encode_history([0, 0x7f, 0x80, 0x4000]) == b'\x00\x7f\x01\x80\x7f'
+    assert encode_history([2**40 - 1]) == b'\xff\xff\xff\xff\xff\x1f'
+    assert decode_history(b'\x00\x7f\x01\x80\x7f') == [0, 0x7f, 0x80, 0x4000]
+
+
+@pytest.mark.parametrize("use_numpy", [False, True])
+def test_history_codec(monkeypatch, use_numpy):
+    if use_numpy:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(history_module, 'numpy', None)
+    for count in (1, 10, 1000):
+        tx_nums = sorted(random.sample(range(2**40), count))
+        row = encode_history(tx_nums)
+        assert decode_history(row) == tx_nums
+        rows = history_module._encode_rows(tx_nums, 300)
+        assert rows == [encode_history(tx_nums[n: n + 300]) for n in range(0, count, 300)]
+        # Small deltas take a byte each
+        tx_nums = list(range(tx_nums[0], tx_nums[0] + count))
+        assert len(encode_history(tx_nums)) < count + 6
+
+
+def test_upgrade_db(monkeypatch, tmpdir):
+    leveldb = db_class('leveldb')
+    monkeypatch.chdir(tmpdir)
+    histories = {urandom(HASHX_LEN): sorted(random.sample(range(2**36), random.randrange(1, 20)))
+                 for _ in range(500)}
+    history = History()
+    history.open_db(leveldb, False, 0)
+    # Write version 0 rows; a hashX's history is split over two flushes
+    with history.db.write_batch() as batch:
+        for hashX, tx_nums in histories.items():
+            for flush_id, part in enumerate((tx_nums[:5], tx_nums[5:]), start=1):
+                if part:
+                    batch.put(hashX + pack_be_uint32(flush_id),
+                              b''.join(pack_le_uint64(tx_num)[:5] for tx_num in part))
+        history.flush_count = 2
+        history.db_version = 0
+        history.write_state(batch)
+    history.close_db()
+
+    # Upgrade in several batches
+    monkeypatch.setattr(history_module, 'UPGRADE_BATCH_SIZE', 2000)
+    history = History()
+    history.open_db(leveldb, False, 2)
+    assert history.db_version == max(History.DB_VERSIONS)
+    assert history.upgrade_cursor == -1
+    for hashX, tx_nums in histories.items():
+        assert list(history.get_txnums(hashX, limit=None)) == tx_nums
+        assert list(history.get_txnums(hashX, limit=7)) == tx_nums[:7]
+    history.close_db()
+
+
+def read_rows(history):
+    return {key: hist for key, hist in history.db.iterator() if len(key) == HASHX_LEN + 4}
+
+
+@pytest.mark.parametrize("journal", [True, False])
+def test_clear_excess(monkeypatch, tmpdir, caplog, journal):
+    leveldb = db_class('leveldb')
+    monkeypatch.chdir(tmpdir)
+    hashXs = [urandom(HASHX_LEN) for _ in range(50)]
+    history = History()
+    history.open_db(leveldb, False, 0)
+    tx_num = 0
+    for utxo_flush_count in (0, 1, 2, 3, 3, 3):
+        for _ in range(20):
+            history.add_unflushed([random.sample(hashXs, 3)], tx_num)
+            tx_num += 1
+        history.flush(utxo_flush_count=utxo_flush_count)
+        if history.flush_count == 4:
+            rows = read_rows(history)
+    assert history.flush_count == 6
+    # Journal entries before the UTXO flush count are pruned
+    assert history.db.get(history.journal_key(2)) is None
+    assert history.db.get(history.journal_key(5)) is not None
+    if not journal:
+        with history.db.write_batch() as batch:
+            batch.delete(history.journal_key(5))
+    history.close_db()
+
+    # Reopen after a crash that left the UTXOs flushed at flush 4
+    history = History()
+    with caplog.at_level('INFO'):
+        history.open_db(leveldb, False, 4)
+    assert ('flush journal incomplete' in caplog.text) is not journal
+    assert history.flush_count == 4
+    assert read_rows(history) == rows
+    for flush_id in range(7):
+        assert history.db.get(history.journal_key(flush_id)) is None
+    history.close_db()
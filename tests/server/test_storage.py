@@ -69,8 +69,155 @@ def test_iterator_reverse(db):
         ]
 
 
+def test_iterator_start(db):
+    for key in (b"a", b"abc", b"abd", b"b"):
+        db.put(key, key)
+    assert [key for key, _value in db.iterator(start=b"abc")] == [b"abc", b"abd", b"b"]
+    assert [key for key, _value in db.iterator(start=b"abca")] == [b"abd", b"b"]
+    assert not list(db.iterator(start=b"c"))
+
+
+def test_get_many(db):
+    for key in (b"a", b"abc", b"b"):
+        db.put(key, key + b"!")
+    assert db.get_many([b"b", b"x", b"a", b"b", b"ab"]) == [b"b!", None, b"a!", b"b!", None]
+    assert db.get_many([]) == []
+
+
+def test_iter_prefixes_many(db):
+    for key in (b"a", b"abc", b"abd", b"b", b"bc", b"c"):
+        db.put(key, key + b"!")
+    assert list(db.iter_prefixes_many([b"b", b"ab", b"x", b"b", b"abd"])) == [
+        (b"ab", b"abc", b"abc!"), (b"ab", b"abd", b"abd!"), (b"abd", b"abd", b"abd!"),
+        (b"b", b"b", b"b!"), (b"b", b"bc", b"bc!"),
+    ]
+    assert not list(db.iter_prefixes_many([]))
+
+
+def test_snapshot(db):
+    db.put(b"a", b"1")
+    db.put(b"ab", b"2")
+    snapshot = db.snapshot()
+    with db.write_batch() as b:
+        b.put(b"a", b"3")
+        b.put(b"abc", b"4")
+        b.delete(b"ab")
+    assert snapshot.get(b"a") == b"1"
+    assert snapshot.get(b"abc") is None
+    assert list(snapshot.iterator(prefix=b"a")) == [(b"a", b"1"), (b"ab", b"2")]
+    assert list(snapshot.iterator(prefix=b"a", reverse=True)) == [(b"ab", b"2"), (b"a", b"1")]
+    assert list(snapshot.iterator(start=b"aa")) == [(b"ab", b"2")]
+    assert list(db.iterator(prefix=b"a")) == [(b"a", b"3"), (b"abc", b"4")]
+
+
+def test_set_for_sync(db):
+    # New databases are opened for sync
+    assert db.for_sync
+    assert db.max_open_files == db.SYNC_MAX_OPEN_FILES
+    db.put(b"a", b"1")
+    db.set_for_sync(False)
+    assert not db.for_sync
+    assert db.get(b"a") == b"1"
+
+
 def test_close(db):
     db.put(b"a", b"b")
     db.close()
     db = db_class(db.__class__.__name__)("db", False)
     assert db.get(b"a") == b"b"
+
+
+@pytest.fixture
+def rocksdb_class(tmpdir, monkeypatch):
+    if 'RocksDB' not in db_engines:
+        raise pytest.skip()
+    monkeypatch.chdir(str(tmpdir))
+    return db_class('rocksdb')
+
+
+ASSET_ITEMS = [
+    (b"B" + bytes(4), b"1"),
+    (b"Q\x05RAVEN", b"2"),
+    (b"U" + bytes(4), b"3"),
+    (b"a\x05RAVEN" + bytes(9), b"4"),
+    (b"h" + bytes(13), bytes(11)),
+    (b"p\x14" + bytes(29), b"5"),
+    (b"state", b"6"),
+    (b"u" + bytes(19), b"7"),
+]
+
+
+def check_asset_items(db):
+    assert sorted(ASSET_ITEMS) == ASSET_ITEMS
+    assert list(db.iterator()) == ASSET_ITEMS
+    assert list(db.iterator(reverse=True)) == ASSET_ITEMS[::-1]
+    assert list(db.iterator(start=b"S")) == ASSET_ITEMS[2:]
+    assert list(db.iterator(prefix=b"p\x14")) == [ASSET_ITEMS[5]]
+    assert list(db.iterator(prefix=b"a\x05RAVEN", reverse=True)) == [ASSET_ITEMS[3]]
+    keys = [key for key, _value in ASSET_ITEMS]
+    assert db.get_many(keys) == [value for _key, value in ASSET_ITEMS]
+    snapshot = db.snapshot()
+    assert [snapshot.get(key) for key in keys] == db.get_many(keys)
+    assert list(snapshot.iterator()) == ASSET_ITEMS
+
+
+def default_family_keys(db):
+    iterator = db.db.iterkeys(db.default_handle)
+    iterator.seek_to_first()
+    return [key for _handle, key in iterator]
+
+
+def test_rocksdb_column_families(rocksdb_class):
+    db = rocksdb_class("asset", False)
+    with db.write_batch() as b:
+        for key, value in ASSET_ITEMS:
+            b.put(key, value)
+    check_asset_items(db)
+    # Each table is in its own column family
+    assert default_family_keys(db) == [b"state"]
+    assert db.handle(b"h") != db.handle(b"u") != db.handle(b"U") != db.default_handle
+    assert db.handle(b"U") == db.handle(b"B")
+    db.close()
+
+
+def test_rocksdb_migrate(rocksdb_class, monkeypatch):
+    # Write the keys as earlier versions did, all in the default family
+    column_families = rocksdb_class.COLUMN_FAMILIES
+    monkeypatch.setattr(rocksdb_class, "COLUMN_FAMILIES", {})
+    db = rocksdb_class("asset", False)
+    for key, value in ASSET_ITEMS:
+        db.put(key, value)
+    db.close()
+    monkeypatch.setattr(rocksdb_class, "COLUMN_FAMILIES", column_families)
+
+    monkeypatch.setattr(rocksdb_class, "MIGRATE_BATCH_SIZE", 2)
+    db = rocksdb_class("asset", False)
+    check_asset_items(db)
+    assert default_family_keys(db) == [b"state"]
+    db.close()
+
+
+def test_rocksdb_prefix_scans(rocksdb_class):
+    # History rows have an 11-byte prefix extractor.  Spread the rows over
+    # table files and the memtable so prefix bloom filters are consulted.
+    db = rocksdb_class("hist", False)
+    rows = {}
+    for n in range(3):
+        with db.write_batch() as b:
+            for _ in range(500):
+                key = os.urandom(2) + bytes(n) + os.urandom(13 - n)
+                rows[key] = os.urandom(8)
+                b.put(key, rows[key])
+        if n < 2:
+            db.db.compact_range()
+    items = sorted(rows.items())
+    for prefix in [key[:length] for key in list(rows)[:50] for length in (1, 2, 11)]:
+        expected = [item for item in items if item[0].startswith(prefix)]
+        assert list(db.iterator(prefix=prefix)) == expected
+        assert list(db.iterator(prefix=prefix, reverse=True)) == expected[::-1]
+    start = items[100][0][:4]
+    assert list(db.iterator(start=start)) == [item for item in items if item[0] >= start]
+    if db.prefix_lens:
+        with pytest.raises(AssertionError):
+            db.iterator(start=items[0][0])
+    db.close()
@@ -0,0 +1,118 @@
+import os
+import random
+import sys
+
+import pytest
+
+from electrumx.lib.util import deep_getsizeof
+from electrumx.server.utxo_cache import UTXOCache, SizedDict
+
+
+def check_same(cache, d):
+    assert len(cache) == len(d)
+    assert sorted(cache.items()) == sorted(d.items())
+    for key, value in d.items():
+        assert key in cache
+        assert cache.get(key) == cache[key] == value
+
+
+@pytest.mark.parametrize("fixed", (True, False))
+def test_utxo_cache(fixed):
+    cache = UTXOCache(36, 24, fixed)
+    d = {}
+    keys = []
+    for n in range(20000):
+        op = random.random()
+        if op < 0.6 or not keys:
+            key = os.urandom(36)
+            keys.append(key)
+        else:
+            key = random.choice(keys)
+        if op < 0.8:
+            size = 24 if fixed else random.choice((0, 5, 24, 25, 40))
+            value = os.urandom(size)
+            cache[key] = value
+            d[key] = value
+        else:
+            assert cache.pop(key) == d.pop(key, None)
+            assert cache.pop(key, 'missing') == 'missing'
+    check_same(cache, d)
+    assert len(cache.buckets) > 64
+    assert bool(cache.overflow) is not fixed
+
+    for key in list(d):
+        del cache[key]
+    assert not cache and not list(cache.items())
+    with pytest.raises(KeyError):
+        del cache[keys[0]]
+    with pytest.raises(KeyError):
+        cache[keys[0]]
+
+
+def test_utxo_cache_fixed_size():
+    cache = UTXOCache(36, 24)
+    with pytest.raises(ValueError):
+        cache[bytes(36)] = bytes(23)
+
+
+def test_utxo_cache_unaligned_match():
+    '''A key appearing across two entries is not a match.'''
+    cache = UTXOCache(4, 4)
+    cache._resize(1)
+    cache[b'abcd'] = b'efgh'
+    cache[b'ijkl'] = b'mnop'
+    for key in (b'cdef', b'ghij', b'fghi', b'ponm'):
+        assert key not in cache
+        assert cache.get(key) is None
+        assert cache.pop(key) is None
+    cache[b'ghij'] = b'qrst'
+    assert cache.pop(b'ghij') == b'qrst'
+    assert dict(cache.items()) == {b'abcd': b'efgh', b'ijkl': b'mnop'}
+    # Overwrites replace the value in place
+    cache[b'abcd'] = b'wxyz'
+    assert cache.buckets == [b'abcdwxyzijklmnop']
+
+
+def test_utxo_cache_nbytes():
+    cache = UTXOCache(36, 24, capacity=100000)
+    empty = cache.nbytes
+    for _ in range(100000):
+        cache[os.urandom(36)] = os.urandom(24)
+    # Within a few bytes of the entries' own size
+    assert 60 < (cache.nbytes - empty) / len(cache) < 64
+    buckets = cache.buckets
+    assert cache.nbytes == sys.getsizeof(buckets) + sum(map(sys.getsizeof, buckets)) + \
+        sys.getsizeof(cache.overflow)
+
+
+def dict_size(d, sizeof=sys.getsizeof):
+    return sys.getsizeof(d) + sum(sys.getsizeof(key) + sizeof(value) for key, value in d.items())
+
+
+@pytest.mark.parametrize("sizeof", (sys.getsizeof, deep_getsizeof))
+def test_sized_dict(sizeof):
+    d = SizedDict(sizeof)
+    keys = [os.urandom(random.randrange(1, 40)) for _ in range(1000)]
+    for n in range(10000):
+        key = random.choice(keys)
+        op = random.random()
+        if op < 0.6:
+            d[key] = os.urandom(random.randrange(0, 100))
+        elif op < 0.7:
+            d[key] = ([os.urandom(20)], {os.urandom(3)})
+        elif op < 0.9:
+            d.pop(key, None)
+        elif key in d:
+            del d[key]
+        assert d.nbytes == dict_size(d, sizeof)
+    d.update({b'a': b'b'}, c=b'd')
+    assert d.setdefault(b'a') == b'b'
+    d.setdefault(b'e', b'f')
+    d.popitem()
+    assert d.nbytes == dict_size(d, sizeof)
+    with pytest.raises(KeyError):
+        del d[b'']
+    with pytest.raises(KeyError):
+        d.pop(b'')
+    d.clear()
+    assert d.nbytes == sys.getsizeof(d)